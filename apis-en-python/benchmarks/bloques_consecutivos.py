@@ -0,0 +1,123 @@
+"""
+Benchmark de validar_bloques_consecutivos (dentalink.py)
+
+Compara la implementación anterior (doble ciclo con strptime/timedelta) contra la
+versión de una sola pasada sobre segundos enteros, usando días sintéticos de 500+
+horarios y valores altos de bloques_necesarios. Antes de medir verifica que ambas
+entreguen exactamente la misma salida.
+
+Uso:
+    python apis-en-python/benchmarks/bloques_consecutivos.py
+"""
+
+import importlib.util
+import logging
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+from typing import List
+
+RUTA_DENTALINK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dentalink.py")
+
+
+def cargar_dentalink():
+    """Carga dentalink.py como módulo (la carpeta apis-en-python no es un paquete)"""
+    spec = importlib.util.spec_from_file_location("dentalink", RUTA_DENTALINK)
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules["dentalink"] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def validar_bloques_consecutivos_original(horarios_str: List[str], tiempo_cita: int, intervalo_profesional: int) -> List[str]:
+    """Implementación anterior, O(n·k), conservada como referencia"""
+    if not horarios_str or not tiempo_cita or not intervalo_profesional:
+        return horarios_str
+
+    bloques_necesarios = (tiempo_cita + intervalo_profesional - 1) // intervalo_profesional
+    if bloques_necesarios <= 1:
+        return horarios_str
+
+    horarios_dt = []
+    for hora_str in horarios_str:
+        try:
+            if len(hora_str.split(':')) == 3:
+                dt = datetime.strptime(hora_str, "%H:%M:%S")
+            else:
+                dt = datetime.strptime(hora_str, "%H:%M")
+            horarios_dt.append(dt)
+        except ValueError:
+            continue
+
+    horarios_dt.sort()
+
+    horarios_validos = []
+    for i in range(len(horarios_dt)):
+        es_valido = True
+        for j in range(1, bloques_necesarios):
+            if i + j >= len(horarios_dt):
+                es_valido = False
+                break
+            diferencia_esperada = timedelta(minutes=intervalo_profesional * j)
+            diferencia_real = horarios_dt[i + j] - horarios_dt[i]
+            if diferencia_real != diferencia_esperada:
+                es_valido = False
+                break
+        if es_valido:
+            horarios_validos.append(horarios_dt[i].strftime("%H:%M"))
+
+    return horarios_validos
+
+
+def generar_dia(cantidad: int, intervalo: int, prob_hueco: float, semilla: int) -> List[str]:
+    """Genera un día de `cantidad` horarios cada `intervalo` minutos con huecos aleatorios"""
+    rng = random.Random(semilla)
+    horarios = []
+    minuto = 0
+    while len(horarios) < cantidad:
+        if rng.random() >= prob_hueco:
+            segundos = minuto * 60
+            horarios.append(f"{segundos // 3600 % 24:02d}:{segundos % 3600 // 60:02d}")
+        minuto += intervalo
+    rng.shuffle(horarios)
+    return horarios
+
+
+def main():
+    dentalink = cargar_dentalink()
+    logging.disable(logging.CRITICAL)
+
+    escenarios = [
+        # (horarios, intervalo, prob_hueco, tiempo_cita)
+        (500, 1, 0.02, 60),
+        (500, 1, 0.00, 240),
+        (720, 2, 0.05, 120),
+        (1000, 1, 0.01, 480),
+        (1440, 1, 0.00, 720),
+    ]
+
+    print(f"{'horarios':>9} {'interv.':>8} {'bloques':>8} {'original (ms)':>14} {'nuevo (ms)':>11} {'speedup':>8}")
+    for semilla, (cantidad, intervalo, prob_hueco, tiempo_cita) in enumerate(escenarios):
+        horarios = generar_dia(cantidad, intervalo, prob_hueco, semilla)
+        bloques = (tiempo_cita + intervalo - 1) // intervalo
+
+        esperado = validar_bloques_consecutivos_original(horarios, tiempo_cita, intervalo)
+        obtenido = dentalink.validar_bloques_consecutivos(horarios, tiempo_cita, intervalo)
+        assert obtenido == esperado, f"Salida distinta para {cantidad} horarios / {bloques} bloques"
+
+        repeticiones = 3
+        t_original = min(timeit.repeat(
+            lambda: validar_bloques_consecutivos_original(horarios, tiempo_cita, intervalo),
+            number=1, repeat=repeticiones))
+        t_nuevo = min(timeit.repeat(
+            lambda: dentalink.validar_bloques_consecutivos(horarios, tiempo_cita, intervalo),
+            number=1, repeat=repeticiones))
+
+        print(f"{cantidad:>9} {intervalo:>8} {bloques:>8} {t_original * 1000:>14.2f} "
+              f"{t_nuevo * 1000:>11.2f} {t_original / t_nuevo:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
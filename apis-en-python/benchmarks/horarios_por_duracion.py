@@ -0,0 +1,152 @@
+"""
+Benchmark de filtrar_horarios_por_duracion (dentalinkymedilink.py)
+
+Compara la implementación anterior (para cada slot, recorrer hacia adelante con
+strptime/timedelta) contra la versión de una pasada sobre minutos enteros. Antes de
+medir verifica, sobre miles de agendas aleatorias (intervalos variables por slot,
+huecos, slots sin intervalo y horas mal formadas), que ambas entreguen exactamente
+la misma salida.
+
+Uso:
+    python apis-en-python/benchmarks/horarios_por_duracion.py
+"""
+
+import importlib.util
+import logging
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+RUTA_DENTALINKYMEDILINK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dentalinkymedilink.py")
+
+
+def cargar_dentalinkymedilink():
+    """Carga dentalinkymedilink.py como módulo (la carpeta apis-en-python no es un paquete)"""
+    spec = importlib.util.spec_from_file_location("dentalinkymedilink", RUTA_DENTALINKYMEDILINK)
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules["dentalinkymedilink"] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def filtrar_horarios_por_duracion_original(horarios: List[Dict], tiempo_cita: int) -> List[str]:
+    """Implementación anterior, O(n²) en el peor caso, conservada como referencia"""
+    if not horarios or not tiempo_cita:
+        return [datetime.strptime(h.get("hora_inicio", ""), "%H:%M:%S").strftime("%H:%M") for h in horarios]
+
+    horarios_ordenados = sorted(horarios, key=lambda x: x.get("hora_inicio", ""))
+
+    horarios_validos = []
+    for i, horario in enumerate(horarios_ordenados):
+        try:
+            intervalo = horario.get("intervalo")
+            if not intervalo:
+                continue
+
+            hora_inicio = datetime.strptime(horario.get("hora_inicio", ""), "%H:%M:%S")
+            tiempo_disponible = intervalo
+            hora_esperada = hora_inicio + timedelta(minutes=intervalo)
+
+            for j in range(i + 1, len(horarios_ordenados)):
+                siguiente_horario = horarios_ordenados[j]
+                hora_siguiente = datetime.strptime(siguiente_horario.get("hora_inicio", ""), "%H:%M:%S")
+                intervalo_siguiente = siguiente_horario.get("intervalo")
+                if not intervalo_siguiente:
+                    break
+                if hora_siguiente == hora_esperada:
+                    tiempo_disponible += intervalo_siguiente
+                    hora_esperada = hora_siguiente + timedelta(minutes=intervalo_siguiente)
+                    if tiempo_disponible >= tiempo_cita:
+                        break
+                else:
+                    break
+
+            if tiempo_disponible >= tiempo_cita:
+                horarios_validos.append(hora_inicio.strftime("%H:%M"))
+        except Exception:
+            continue
+
+    return horarios_validos
+
+
+def generar_agenda(rng: random.Random, cantidad: int, intervalos: List[int], prob_hueco: float,
+                   prob_sin_intervalo: float = 0.0, prob_hora_invalida: float = 0.0) -> List[Dict]:
+    """Genera `cantidad` slots con intervalo variable, huecos y, opcionalmente, datos defectuosos"""
+    slots = []
+    minuto = rng.randrange(0, 60)
+    while len(slots) < cantidad and minuto < 24 * 60:
+        intervalo = rng.choice(intervalos)
+        hora = f"{minuto // 60:02d}:{minuto % 60:02d}:00"
+        if rng.random() < prob_hora_invalida:
+            hora = rng.choice(["25:00:00", "", "9:5", f"{minuto // 60}:{minuto % 60:02d}:00", "xx:yy:zz"])
+        valor_intervalo = rng.choice([None, 0]) if rng.random() < prob_sin_intervalo else intervalo
+        slots.append({"hora_inicio": hora, "intervalo": valor_intervalo})
+        minuto += intervalo
+        if rng.random() < prob_hueco:
+            minuto += rng.choice([1, 5, intervalo, 2 * intervalo])
+    rng.shuffle(slots)
+    return slots
+
+
+def verificar_equivalencia(modulo, casos: int = 5000) -> None:
+    """Compara ambas implementaciones sobre agendas aleatorias pequeñas y con defectos"""
+    rng = random.Random(2024)
+    for caso in range(casos):
+        horarios = generar_agenda(
+            rng,
+            cantidad=rng.randrange(1, 40),
+            intervalos=rng.choice([[15], [30], [10, 20], [5, 10, 15, 30, 45], [60, 90]]),
+            prob_hueco=rng.choice([0.0, 0.1, 0.4]),
+            prob_sin_intervalo=rng.choice([0.0, 0.05, 0.2]),
+            prob_hora_invalida=rng.choice([0.0, 0.05, 0.2]),
+        )
+        tiempo_cita = rng.choice([1, 10, 15, 30, 45, 60, 61, 90, 120, 240])
+        try:
+            esperado = filtrar_horarios_por_duracion_original(horarios, tiempo_cita)
+        except Exception:
+            continue
+        obtenido = modulo.filtrar_horarios_por_duracion(horarios, tiempo_cita)
+        assert obtenido == esperado, f"Caso {caso}: salida distinta para {horarios!r} / {tiempo_cita}min"
+    print(f"✅ {casos} agendas aleatorias con salida idéntica")
+
+
+def main():
+    modulo = cargar_dentalinkymedilink()
+    logging.disable(logging.CRITICAL)
+
+    verificar_equivalencia(modulo)
+
+    escenarios = [
+        # (slots, intervalos posibles, prob_hueco, tiempo_cita)
+        (96, [15], 0.05, 60),
+        (288, [5], 0.02, 120),
+        (500, [1, 2, 3], 0.01, 240),
+        (720, [1, 2], 0.00, 480),
+        (1440, [1], 0.00, 720),
+    ]
+
+    print(f"{'slots':>6} {'cita':>6} {'original (ms)':>14} {'nuevo (ms)':>11} {'speedup':>8}")
+    for semilla, (cantidad, intervalos, prob_hueco, tiempo_cita) in enumerate(escenarios):
+        horarios = generar_agenda(random.Random(semilla), cantidad, intervalos, prob_hueco)
+
+        esperado = filtrar_horarios_por_duracion_original(horarios, tiempo_cita)
+        obtenido = modulo.filtrar_horarios_por_duracion(horarios, tiempo_cita)
+        assert obtenido == esperado, f"Salida distinta para {cantidad} slots / {tiempo_cita}min"
+
+        repeticiones = 3
+        t_original = min(timeit.repeat(
+            lambda: filtrar_horarios_por_duracion_original(horarios, tiempo_cita),
+            number=1, repeat=repeticiones))
+        t_nuevo = min(timeit.repeat(
+            lambda: modulo.filtrar_horarios_por_duracion(horarios, tiempo_cita),
+            number=1, repeat=repeticiones))
+
+        print(f"{len(horarios):>6} {tiempo_cita:>6} {t_original * 1000:>14.2f} "
+              f"{t_nuevo * 1000:>11.2f} {t_original / t_nuevo:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,12 +13,23 @@ Funciones principales:
 import logging
 import json
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import pytz
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import os
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import threading
+import time
+import random
+from contextvars import ContextVar, copy_context
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import closing
+import sqlite3
 import unicodedata
 import locale
 
@@ -52,6 +63,139 @@ GHL_ACCESS_TOKEN = os.getenv('GHL_ACCESS_TOKEN', 'pit-6f501c7a-6f49-44e0-bbbe-96
 GHL_CALENDAR_ID = os.getenv('GHL_CALENDAR_ID', '7U0Cv0cyOIBktrn4qihl')
 GHL_LOCATION_ID = os.getenv('GHL_LOCATION_ID', 'Y6SfrX5Wf5M9eaz8LSq4')
 
+# ============================
+# CLIENTE HTTP (SESIONES POR HOST)
+# ============================
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+HTTP_GET_RETRIES = int(os.getenv('HTTP_GET_RETRIES', '2'))
+
+_sesiones_http: Dict[str, requests.Session] = {}
+_sesiones_http_lock = threading.Lock()
+
+def _crear_sesion_http() -> requests.Session:
+    """Crea una sesión keep-alive con pool de conexiones y reintentos solo para GET"""
+    reintentos = Retry(
+        total=HTTP_GET_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False
+    )
+    adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=reintentos)
+    sesion = requests.Session()
+    sesion.mount("https://", adaptador)
+    sesion.mount("http://", adaptador)
+    return sesion
+
+def obtener_sesion_http(url: str) -> requests.Session:
+    """Devuelve la sesión compartida del host de la URL, creándola la primera vez"""
+    host = urlsplit(url).netloc
+    sesion = _sesiones_http.get(host)
+    if sesion is None:
+        with _sesiones_http_lock:
+            sesion = _sesiones_http.get(host)
+            if sesion is None:
+                sesion = _crear_sesion_http()
+                _sesiones_http[host] = sesion
+    return sesion
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Ejecuta una petición por la sesión del host, con timeout de conexión/lectura por defecto"""
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    inicio = time.monotonic()
+    try:
+        return obtener_sesion_http(url).request(method, url, **kwargs)
+    finally:
+        sumar_registro("llamadas_upstream")
+        sumar_registro("tiempo_upstream_ms", (time.monotonic() - inicio) * 1000)
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    return http_request("GET", url, **kwargs)
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    return http_request("POST", url, **kwargs)
+
+def http_put(url: str, **kwargs) -> requests.Response:
+    return http_request("PUT", url, **kwargs)
+
+# ============================
+# REGISTRO POR PETICIÓN
+# ============================
+
+# Fracción (0-1) de peticiones que registran además el detalle por horario/profesional
+LOG_DETALLE_MUESTREO = float(os.getenv('LOG_DETALLE_MUESTREO', '0'))
+
+_registro_peticion: ContextVar[Optional[Dict[str, Any]]] = ContextVar('registro_peticion', default=None)
+_registro_lock = threading.Lock()
+
+def _detalle_solicitado() -> bool:
+    """El detalle se activa con el header X-Log-Detalle, con "debug": true en el body o por muestreo"""
+    if request.headers.get('X-Log-Detalle', '').lower() in ('1', 'true', 'si'):
+        return True
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and body.get('debug'):
+        return True
+    return LOG_DETALLE_MUESTREO > 0 and random.random() < LOG_DETALLE_MUESTREO
+
+@app.before_request
+def _iniciar_registro_peticion():
+    registro = {
+        "ruta": request.path,
+        "metodo": request.method,
+        "detalle": _detalle_solicitado(),
+        "llamadas_upstream": 0,
+        "tiempo_upstream_ms": 0.0
+    }
+    g.registro_inicio = time.monotonic()
+    g.registro_token = _registro_peticion.set(registro)
+
+@app.after_request
+def _anotar_status_peticion(response):
+    anotar_registro(status=response.status_code)
+    return response
+
+@app.teardown_request
+def _emitir_registro_peticion(exc):
+    """Emite una única línea JSON con el resumen de la petición"""
+    token = g.pop('registro_token', None)
+    if token is None:
+        return
+    registro = _registro_peticion.get()
+    _registro_peticion.reset(token)
+    
+    registro.setdefault("status", 500)
+    if exc is not None:
+        registro["error"] = repr(exc)
+    registro["duracion_ms"] = round((time.monotonic() - g.pop('registro_inicio')) * 1000, 1)
+    registro["tiempo_upstream_ms"] = round(registro["tiempo_upstream_ms"], 1)
+    logging.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+def anotar_registro(**campos) -> None:
+    """Agrega campos al resumen de la petición en curso (no hace nada fuera de una petición)"""
+    registro = _registro_peticion.get()
+    if registro is not None:
+        with _registro_lock:
+            registro.update(campos)
+
+def sumar_registro(campo: str, cantidad: float = 1) -> None:
+    """Acumula un contador en el resumen de la petición en curso"""
+    registro = _registro_peticion.get()
+    if registro is not None:
+        with _registro_lock:
+            registro[campo] = registro.get(campo, 0) + cantidad
+
+def detalle_activo() -> bool:
+    """True si la petición en curso registra el detalle por ítem"""
+    registro = _registro_peticion.get()
+    return registro is not None and registro["detalle"]
+
+def log_detalle(mensaje: str) -> None:
+    if detalle_activo():
+        logging.info(mensaje)
+
 # ============================
 # UTILIDADES
 # ============================
@@ -127,25 +271,47 @@ def formatear_fecha_espanol(fecha_str: str) -> str:
         logging.warning(f"⚠️ Error formateando fecha {fecha_str}: {e}")
         return fecha_str
 
-def filtrar_horarios_futuros(horarios: List[Dict], fecha: str, hora_actual: datetime) -> List[Dict]:
-    """Filtra horarios para que solo incluya los que son en el futuro"""
-    horarios_futuros = []
-    
-    for horario in horarios:
-        try:
-            hora_inicio = horario.get("hora_inicio", "")
-            hora_cita = datetime.strptime(f"{fecha} {hora_inicio}", "%Y-%m-%d %H:%M:%S")
-            
-            if hora_actual.tzinfo is not None:
-                hora_cita = hora_actual.tzinfo.localize(hora_cita)
-            
-            if hora_cita > hora_actual:
-                horarios_futuros.append(horario)
-        except ValueError as e:
-            logging.warning(f"⚠️ Error al procesar horario {horario}: {e}")
-            continue
+def _hora_a_segundos(hora_str: str) -> Optional[int]:
+    """Convierte "HH:MM" o "HH:MM:SS" a segundos desde medianoche. Retorna None si es inválida."""
+    partes = hora_str.split(':')
+    
+    # Camino rápido para el formato que entrega la API (dos dígitos por componente)
+    if len(partes) in (2, 3) and all(len(parte) == 2 and parte.isascii() and parte.isdigit() for parte in partes):
+        horas, minutos = int(partes[0]), int(partes[1])
+        segundos = int(partes[2]) if len(partes) == 3 else 0
+        if horas < 24 and minutos < 60 and segundos < 60:
+            return horas * 3600 + minutos * 60 + segundos
+        return None
+    
+    # Formatos menos comunes ("9:5", etc.): delegar en strptime
+    try:
+        dt = datetime.strptime(hora_str, "%H:%M:%S" if len(partes) == 3 else "%H:%M")
+    except ValueError:
+        return None
+    return dt.hour * 3600 + dt.minute * 60 + dt.second
+
+def _segundos_a_hora(segundos: int) -> str:
+    """Formatea segundos desde medianoche como "HH:MM" """
+    return f"{segundos // 3600:02d}:{segundos % 3600 // 60:02d}"
+
+def _inicios_bloques_consecutivos(horarios_seg: List[int], bloques_necesarios: int, paso_seg: int) -> List[int]:
+    """
+    Retorna los inicios (en segundos, ordenados) desde los que hay `bloques_necesarios`
+    horarios separados exactamente por `paso_seg`.
     
-    return horarios_futuros
+    Recorre la lista ordenada una sola vez de atrás hacia adelante, llevando el largo
+    de la racha de bloques consecutivos que empieza en cada posición.
+    """
+    inicios = []
+    racha = 0
+    siguiente = None
+    for segundos in reversed(horarios_seg):
+        racha = racha + 1 if siguiente is not None and siguiente - segundos == paso_seg else 1
+        if racha >= bloques_necesarios:
+            inicios.append(segundos)
+        siguiente = segundos
+    inicios.reverse()
+    return inicios
 
 def validar_bloques_consecutivos(horarios_str: List[str], tiempo_cita: int, intervalo_profesional: int) -> List[str]:
     """
@@ -165,65 +331,524 @@ def validar_bloques_consecutivos(horarios_str: List[str], tiempo_cita: int, inte
     # Calcular cuántos bloques consecutivos se necesitan
     bloques_necesarios = (tiempo_cita + intervalo_profesional - 1) // intervalo_profesional
     
-    logging.info(f"🔢 Tiempo cita: {tiempo_cita} min, Intervalo: {intervalo_profesional} min, Bloques necesarios: {bloques_necesarios}")
+    log_detalle(f"🔢 Tiempo cita: {tiempo_cita} min, Intervalo: {intervalo_profesional} min, Bloques necesarios: {bloques_necesarios}")
     
     if bloques_necesarios <= 1:
         # Si solo necesita 1 bloque o menos, todos los horarios son válidos
         return horarios_str
     
-    # Convertir horarios a datetime para comparación
-    horarios_dt = []
+    # Convertir horarios a segundos desde medianoche para comparación
+    horarios_seg = []
     for hora_str in horarios_str:
-        try:
-            # Normalizar formato (puede venir HH:MM:SS o HH:MM)
-            if len(hora_str.split(':')) == 3:
-                dt = datetime.strptime(hora_str, "%H:%M:%S")
-            else:
-                dt = datetime.strptime(hora_str, "%H:%M")
-            horarios_dt.append(dt)
-        except ValueError:
+        segundos = _hora_a_segundos(hora_str)
+        if segundos is None:
             logging.warning(f"⚠️ Formato de hora inválido: {hora_str}")
             continue
+        horarios_seg.append(segundos)
     
-    # Ordenar horarios
-    horarios_dt.sort()
+    horarios_seg.sort()
     
     # Encontrar secuencias consecutivas
-    horarios_validos = []
+    inicios = _inicios_bloques_consecutivos(horarios_seg, bloques_necesarios, intervalo_profesional * 60)
+    horarios_validos = [_segundos_a_hora(segundos) for segundos in inicios]
     
-    for i in range(len(horarios_dt)):
-        es_valido = True
-        
-        # Verificar si hay bloques consecutivos suficientes desde este horario
-        for j in range(1, bloques_necesarios):
-            if i + j >= len(horarios_dt):
-                es_valido = False
-                break
-            
-            # Calcular la diferencia esperada
-            diferencia_esperada = timedelta(minutes=intervalo_profesional * j)
-            diferencia_real = horarios_dt[i + j] - horarios_dt[i]
+    log_detalle(f"📊 Horarios totales: {len(horarios_str)}, Horarios válidos con bloques consecutivos: {len(horarios_validos)}")
+    
+    return horarios_validos
+
+# ============================
+# URL DE HORARIOS DISPONIBLES
+# ============================
+
+# Variante de URL de horariosdisponibles (con o sin "/" final) que respondió, por URL base
+_variante_horarios: Dict[str, str] = {}
+_variante_horarios_lock = threading.Lock()
+
+def consultar_horarios_disponibles(api_base: str, headers_api: Dict, **kwargs) -> Tuple[Optional[requests.Response], Optional[str]]:
+    """
+    Hace GET a horariosdisponibles usando la variante de URL que ya funcionó para esta API.
+    
+    Solo si la variante recordada falla (404 o error de conexión) se vuelven a probar
+    ambas variantes; en régimen normal es exactamente una llamada por consulta.
+    
+    Returns:
+        tuple: (response o None, url que respondió o None)
+    """
+    with _variante_horarios_lock:
+        recordada = _variante_horarios.get(api_base)
+    
+    variantes = [f"{api_base}horariosdisponibles/", f"{api_base}horariosdisponibles"]
+    urls_to_try = ([recordada] + [url for url in variantes if url != recordada]) if recordada else variantes
+    response = None
+    
+    for url_horarios in urls_to_try:
+        try:
+            log_detalle(f"🌐 Intentando URL: {url_horarios}")
+            response = http_get(url_horarios, headers=headers_api, **kwargs)
+            log_detalle(f"📊 Status Code: {response.status_code}")
             
-            # Verificar si los bloques son consecutivos
-            if diferencia_real != diferencia_esperada:
-                es_valido = False
-                break
-        
-        if es_valido:
-            # Agregar el horario de inicio de la secuencia válida
-            hora_formateada = horarios_dt[i].strftime("%H:%M")
-            horarios_validos.append(hora_formateada)
-            logging.info(f"✅ Horario válido encontrado: {hora_formateada} (tiene {bloques_necesarios} bloques consecutivos)")
+            if response.status_code != 404:
+                if url_horarios != recordada:
+                    with _variante_horarios_lock:
+                        _variante_horarios[api_base] = url_horarios
+                return response, url_horarios
+        except requests.exceptions.RequestException as e:
+            logging.error(f"❌ Error al conectar con {url_horarios}: {e}")
+        
+        if url_horarios == recordada:
+            # La variante recordada dejó de responder: volver a probar ambas
+            with _variante_horarios_lock:
+                _variante_horarios.pop(api_base, None)
+    
+    return response, None
+
+# ============================
+# CACHÉ DE PROFESIONALES
+# ============================
+
+# Segundos que el directorio de /dentistas se considera fresco
+PROFESIONALES_CACHE_TTL = int(os.getenv('PROFESIONALES_CACHE_TTL', '600'))
+
+_directorio_profesionales: Dict[int, Dict[str, Any]] = {}
+_directorio_actualizado_en: float = 0.0
+_directorio_lock = threading.Lock()
+_directorio_carga_lock = threading.Lock()  # Evita descargas simultáneas en la carga inicial
+_directorio_refrescando = False
+
+def _descargar_directorio_profesionales() -> Optional[Dict[int, Dict[str, Any]]]:
+    """Descarga /dentistas y lo indexa por ID. Retorna None si la API falla."""
+    api_base, headers_api = obtener_configuracion_api()
+    try:
+        prof_resp = http_get(f"{api_base}dentistas", headers=headers_api)
+        if prof_resp.status_code != 200:
+            logging.warning(f"⚠️ No se pudieron obtener los profesionales: {prof_resp.status_code}")
+            return None
+
+        directorio = {}
+        for dentista in prof_resp.json().get("data", []):
+            apellido = dentista.get('apellido') or dentista.get('apellidos', '')
+            directorio[dentista.get("id")] = {
+                "nombre": f"{dentista.get('nombre', 'Desconocido')} {apellido}".strip(),
+                "intervalo": dentista.get("intervalo")  # Sin default, debe venir del profesional
+            }
+        return directorio
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo información de profesionales: {e}")
+        return None
+
+def _refrescar_directorio_profesionales() -> None:
+    """Descarga el directorio y reemplaza la caché si la descarga fue exitosa"""
+    global _directorio_profesionales, _directorio_actualizado_en, _directorio_refrescando
+    try:
+        directorio = _descargar_directorio_profesionales()
+        if directorio is not None:
+            with _directorio_lock:
+                _directorio_profesionales = directorio
+                _directorio_actualizado_en = time.monotonic()
+            logging.info(f"🔄 Directorio de profesionales actualizado: {len(directorio)} profesionales")
+    finally:
+        with _directorio_lock:
+            _directorio_refrescando = False
+
+def obtener_directorio_profesionales() -> Dict[int, Dict[str, Any]]:
+    """
+    Retorna el directorio de profesionales indexado por ID ({id: {"nombre", "intervalo"}}).
+
+    La primera llamada descarga /dentistas de forma síncrona. Cuando la caché expira
+    se sigue sirviendo el directorio anterior mientras se refresca en segundo plano.
+    """
+    global _directorio_refrescando
+
+    with _directorio_lock:
+        cargado = _directorio_actualizado_en > 0
+        expirado = time.monotonic() - _directorio_actualizado_en > PROFESIONALES_CACHE_TTL
+        lanzar_refresco = cargado and expirado and not _directorio_refrescando
+        if lanzar_refresco:
+            _directorio_refrescando = True
+        directorio = _directorio_profesionales
+
+    if not cargado:
+        with _directorio_carga_lock:
+            if _directorio_actualizado_en == 0:
+                _refrescar_directorio_profesionales()
+        with _directorio_lock:
+            return _directorio_profesionales
+
+    if lanzar_refresco:
+        threading.Thread(target=_refrescar_directorio_profesionales, daemon=True).start()
+
+    return directorio
+
+def obtener_profesional(id_profesional: int) -> Optional[Dict[str, Any]]:
+    """Retorna {"nombre", "intervalo"} del profesional o None si no está en el directorio"""
+    return obtener_directorio_profesionales().get(id_profesional)
+
+def invalidar_cache_profesionales() -> None:
+    """Descarta el directorio en memoria; la próxima consulta vuelve a descargar /dentistas"""
+    global _directorio_profesionales, _directorio_actualizado_en
+    with _directorio_lock:
+        _directorio_profesionales = {}
+        _directorio_actualizado_en = 0.0
+    logging.info("🗑️ Caché de profesionales invalidada")
+
+# ============================
+# CACHÉ DE SUCURSALES
+# ============================
+
+# Cada cuántos segundos se vuelve a descargar el listado completo de sucursales
+SUCURSALES_REFRESCO = int(os.getenv('SUCURSALES_REFRESCO', '3600'))
+
+_nombres_sucursales: Dict[int, str] = {}
+_nombres_sucursales_lock = threading.Lock()
+_sucursales_consultadas: set = set()  # IDs ausentes del listado que ya se descargaron por separado
+_refresco_sucursales_iniciado = False
+
+def _descargar_sucursales(api_base: str, headers_api: Dict[str, str], nombre_api: str) -> Optional[Dict[int, str]]:
+    """Descarga el listado de sucursales de una API como {id: nombre}. Retorna None si la API falla."""
+    try:
+        suc_resp = http_get(f"{api_base}sucursales", headers=headers_api)
+        if suc_resp.status_code != 200:
+            logging.warning(f"⚠️ No se pudieron obtener las sucursales de {nombre_api}: {suc_resp.status_code}")
+            return None
+        return {
+            sucursal["id"]: sucursal["nombre"]
+            for sucursal in suc_resp.json().get("data", [])
+            if sucursal.get("id") is not None and sucursal.get("nombre")
+        }
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo sucursales de {nombre_api}: {e}")
+        return None
+
+def refrescar_sucursales() -> int:
+    """Descarga el listado de sucursales de Dentalink y lo agrega al mapa; retorna cuántas hay en memoria"""
+    nombres = _descargar_sucursales(DENTALINK_API_URL, DENTALINK_HEADERS, "Dentalink v1")
+    if not nombres:
+        return len(_nombres_sucursales)
+    with _nombres_sucursales_lock:
+        # Se agrega sobre el mapa anterior: una sucursal que deja de venir conserva su nombre
+        _nombres_sucursales.update(nombres)
+        _sucursales_consultadas.clear()
+        total = len(_nombres_sucursales)
+    logging.info(f"🔄 Mapa de sucursales actualizado: {total} sucursales")
+    return total
+
+def _refrescar_sucursales_periodicamente() -> None:
+    while True:
+        refrescar_sucursales()
+        time.sleep(SUCURSALES_REFRESCO)
+
+def iniciar_cache_sucursales() -> None:
+    """Precarga el mapa de sucursales y lo refresca cada SUCURSALES_REFRESCO segundos (una vez por proceso)"""
+    global _refresco_sucursales_iniciado
+    with _nombres_sucursales_lock:
+        if _refresco_sucursales_iniciado:
+            return
+        _refresco_sucursales_iniciado = True
+    threading.Thread(target=_refrescar_sucursales_periodicamente, name="sucursales", daemon=True).start()
+
+def _consultar_sucursal(id_sucursal: int) -> None:
+    """Descarga una sucursal que no vino en el listado y la agrega al mapa"""
+    try:
+        suc_resp = http_get(f"{DENTALINK_API_URL}sucursales/{id_sucursal}", headers=DENTALINK_HEADERS)
+        if suc_resp.status_code != 200:
+            logging.warning(f"⚠️ No se pudo obtener la sucursal {id_sucursal}: {suc_resp.status_code}")
+            return
+        nombre = suc_resp.json().get("data", {}).get("nombre")
+        if nombre:
+            with _nombres_sucursales_lock:
+                _nombres_sucursales[id_sucursal] = nombre
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo la sucursal {id_sucursal}: {e}")
+
+def obtener_nombre_sucursal(id_sucursal: int) -> Optional[str]:
+    """
+    Nombre de la sucursal desde el mapa precargado, sin consultar la API.
+    
+    Si el ID no está, su descarga se lanza en segundo plano (una sola vez por ID hasta el
+    próximo refresco del listado) y se retorna None; quien llama usa un nombre genérico.
+    """
+    with _nombres_sucursales_lock:
+        nombre = _nombres_sucursales.get(id_sucursal)
+        if nombre or id_sucursal in _sucursales_consultadas:
+            return nombre
+        _sucursales_consultadas.add(id_sucursal)
+    threading.Thread(target=_consultar_sucursal, args=(id_sucursal,), daemon=True).start()
+    return None
+
+# ============================
+# CACHÉ DE DISPONIBILIDAD
+# ============================
+
+# Segundos que se reutiliza una respuesta de horariosdisponibles
+DISPONIBILIDAD_CACHE_TTL = int(os.getenv('DISPONIBILIDAD_CACHE_TTL', '60'))
+DISPONIBILIDAD_CACHE_MAX = int(os.getenv('DISPONIBILIDAD_CACHE_MAX', '500'))
+
+# Clave: (ids_profesionales ordenados, id_sucursal, fecha_inicio, fecha_fin) -> (expira_en, horarios_data)
+_cache_disponibilidad: "OrderedDict[Tuple, Tuple[float, Dict]]" = OrderedDict()
+_cache_disponibilidad_lock = threading.Lock()
+# Se incrementa en cada invalidación para descartar respuestas que estaban en vuelo
+_cache_disponibilidad_generacion = 0
+
+def _clave_disponibilidad(ids_profesionales: List[int], id_sucursal: int, fecha_inicio: str, fecha_fin: str) -> Tuple:
+    """Construye la clave de caché de una ventana de disponibilidad"""
+    return (tuple(sorted(set(ids_profesionales))), id_sucursal, fecha_inicio, fecha_fin)
+
+def obtener_disponibilidad_cacheada(clave: Tuple) -> Optional[Dict]:
+    """Retorna los horarios_data cacheados para la ventana o None si no hay entrada vigente"""
+    with _cache_disponibilidad_lock:
+        entrada = _cache_disponibilidad.get(clave)
+        if entrada is None:
+            return None
+        expira_en, horarios_data = entrada
+        if time.monotonic() > expira_en:
+            del _cache_disponibilidad[clave]
+            return None
+        return horarios_data
+
+def generacion_cache_disponibilidad() -> int:
+    """Retorna la generación actual de la caché (tomarla antes de consultar la API)"""
+    return _cache_disponibilidad_generacion
+
+def guardar_disponibilidad_cacheada(clave: Tuple, horarios_data: Dict, generacion: int) -> None:
+    """Guarda los horarios_data de una ventana si no hubo invalidaciones desde `generacion`"""
+    with _cache_disponibilidad_lock:
+        if generacion != _cache_disponibilidad_generacion:
+            return
+        _cache_disponibilidad[clave] = (time.monotonic() + DISPONIBILIDAD_CACHE_TTL, horarios_data)
+        _cache_disponibilidad.move_to_end(clave)
+        while len(_cache_disponibilidad) > DISPONIBILIDAD_CACHE_MAX:
+            _cache_disponibilidad.popitem(last=False)
+
+def invalidar_cache_disponibilidad(id_profesional: int = None, id_sucursal: int = None, fecha: str = None) -> int:
+    """
+    Elimina las ventanas cacheadas afectadas por una cita agendada o cancelada.
     
-    logging.info(f"📊 Horarios totales: {len(horarios_str)}, Horarios válidos con bloques consecutivos: {len(horarios_validos)}")
+    Args:
+        id_profesional: Solo ventanas que incluyen a este profesional (opcional)
+        id_sucursal: Solo ventanas de esta sucursal (opcional)
+        fecha: Solo ventanas que contienen esta fecha YYYY-MM-DD (opcional)
     
-    return horarios_validos
+    Returns:
+        Cantidad de ventanas eliminadas
+    """
+    global _cache_disponibilidad_generacion
+    # Las claves guardan IDs int; los datos de una cita pueden traerlos como texto
+    if id_profesional is not None:
+        id_profesional = extraer_id(id_profesional)
+    if id_sucursal is not None:
+        id_sucursal = extraer_id(id_sucursal)
+    
+    with _cache_disponibilidad_lock:
+        _cache_disponibilidad_generacion += 1
+        afectadas = [
+            clave for clave in _cache_disponibilidad
+            if (id_profesional is None or id_profesional in clave[0])
+            and (id_sucursal is None or id_sucursal == clave[1])
+            and (fecha is None or clave[2] <= fecha <= clave[3])
+        ]
+        for clave in afectadas:
+            del _cache_disponibilidad[clave]
+    if afectadas:
+        logging.info(f"🗑️ Disponibilidad invalidada: {len(afectadas)} ventanas (profesional={id_profesional}, sucursal={id_sucursal}, fecha={fecha})")
+    return len(afectadas)
 
 # ============================
 # FUNCIÓN 1: BUSCAR DISPONIBILIDAD
 # ============================
 
-def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_inicio: str = None, tiempo_cita: int = None) -> Dict[str, Any]:
+# Semanas consultadas por search_availability (ventanas de 7 días)
+SEMANAS_BUSQUEDA = 4
+
+# Activa el modo paralelo (las 4 semanas a la vez); por defecto está apagado y se buscan en orden
+BUSQUEDA_PARALELA = os.getenv('BUSQUEDA_PARALELA', 'false').lower() in ('1', 'true', 'si', 'yes')
+
+# Pool compartido y acotado para las consultas de semanas en paralelo
+SEMANAS_POOL_SIZE = int(os.getenv('SEMANAS_POOL_SIZE', '8'))
+_pool_semanas = ThreadPoolExecutor(max_workers=SEMANAS_POOL_SIZE, thread_name_prefix="semanas")
+
+def _normalizar_slots(horarios_data: Dict, hora_actual: datetime) -> Iterator[Tuple[int, str, List[int]]]:
+    """
+    Recorre la respuesta cruda de horariosdisponibles parseando cada horario una sola vez.
+    
+    Genera registros (id_profesional, fecha, slots) donde slots son los horarios futuros
+    de esa fecha como segundos desde medianoche truncados al minuto, en el orden de la API.
+    """
+    # Hora actual de Santiago como fecha + segundos, calculada una vez por respuesta
+    hoy = hora_actual.date()
+    ahora_seg = (hora_actual.hour * 3600 + hora_actual.minute * 60 + hora_actual.second
+                 + hora_actual.microsecond / 1_000_000)
+    
+    for id_profesional_str, fechas_horarios in horarios_data.items():
+        id_profesional = int(id_profesional_str)
+        if not isinstance(fechas_horarios, dict):
+            logging.warning(f"⚠️ fechas_horarios no es un dict: {type(fechas_horarios)}")
+            continue
+        
+        for fecha, horarios in fechas_horarios.items():
+            if not isinstance(horarios, list):
+                logging.warning(f"⚠️ Horarios para fecha {fecha} no es una lista: {type(horarios)}")
+                continue
+            
+            try:
+                dia = datetime.strptime(fecha, "%Y-%m-%d").date()
+            except (TypeError, ValueError) as e:
+                logging.warning(f"⚠️ Error al procesar fecha {fecha}: {e}")
+                continue
+            if dia < hoy:
+                continue
+            
+            slots = []
+            invalidos = 0
+            for horario in horarios:
+                hora_inicio = horario.get("hora_inicio", "")
+                segundos = _hora_a_segundos(hora_inicio) if isinstance(hora_inicio, str) and hora_inicio.count(':') == 2 else None
+                if segundos is None:
+                    invalidos += 1
+                    continue
+                if dia == hoy and segundos <= ahora_seg:
+                    continue
+                slots.append(segundos - segundos % 60)
+            
+            if invalidos:
+                sumar_registro("horarios_invalidos", invalidos)
+                log_detalle(f"⚠️ {invalidos} horarios con formato inválido para el profesional {id_profesional} el {fecha}")
+            if slots:
+                yield id_profesional, fecha, slots
+
+def _procesar_horarios_semana(horarios_data: Dict, profesionales_info: Dict[int, str],
+                              profesionales_intervalos: Dict[int, int], hora_actual: datetime,
+                              tiempo_cita: int = None) -> List[Dict[str, Any]]:
+    """Convierte la respuesta de horariosdisponibles de una semana en la lista de disponibilidad"""
+    disponibilidad_por_profesional: Dict[int, Dict[str, Any]] = {}
+    detalle = detalle_activo()
+    horarios_entregados = 0
+    if detalle:
+        logging.info(f"🔍 Procesando horarios para {len(horarios_data)} profesionales")
+    
+    for id_profesional, fecha, slots in _normalizar_slots(horarios_data, hora_actual):
+        intervalo_profesional = profesionales_intervalos.get(id_profesional)
+        
+        # Validar bloques consecutivos si se especificó tiempo_cita Y el profesional tiene intervalo
+        if tiempo_cita and intervalo_profesional:
+            bloques_necesarios = (tiempo_cita + intervalo_profesional - 1) // intervalo_profesional
+            if bloques_necesarios > 1:
+                slots = _inicios_bloques_consecutivos(sorted(slots), bloques_necesarios, intervalo_profesional * 60)
+        elif tiempo_cita and not intervalo_profesional:
+            logging.warning(f"⚠️ Se solicitó tiempo_cita={tiempo_cita} min pero el profesional {id_profesional} no tiene intervalo configurado. No se puede validar bloques consecutivos.")
+        
+        if not slots:
+            if detalle:
+                logging.info(f"❌ Fecha {fecha} sin horarios válidos después de validar bloques consecutivos")
+            continue
+        
+        disponibilidad_profesional = disponibilidad_por_profesional.get(id_profesional)
+        if disponibilidad_profesional is None:
+            disponibilidad_profesional = disponibilidad_por_profesional[id_profesional] = {
+                "id_profesional": id_profesional,
+                "nombre_profesional": profesionales_info.get(id_profesional, f"Profesional {id_profesional}"),
+                "fechas": {}
+            }
+        
+        # Formatear fecha en español
+        fecha_formateada = formatear_fecha_espanol(fecha)
+        disponibilidad_profesional["fechas"][fecha_formateada] = [_segundos_a_hora(segundos) for segundos in slots]
+        horarios_entregados += len(slots)
+        if detalle:
+            logging.info(f"✅ Profesional {id_profesional}: fecha {fecha} ({fecha_formateada}) agregada con {len(slots)} horarios")
+    
+    disponibilidad_final = list(disponibilidad_por_profesional.values())
+    sumar_registro("horarios_procesados", horarios_entregados)
+    if detalle:
+        logging.info(f"📊 Total profesionales con disponibilidad: {len(disponibilidad_final)}")
+    return disponibilidad_final
+
+def _buscar_semana(api_base: str, headers_api: Dict, ids_profesionales: List[int], id_sucursal: int,
+                   fecha_inicio_dt: datetime, profesionales_info: Dict[int, str],
+                   profesionales_intervalos: Dict[int, int], hora_actual: datetime,
+                   tiempo_cita: int = None) -> Optional[Dict[str, Any]]:
+    """
+    Consulta y procesa una ventana de 7 días a partir de fecha_inicio_dt.
+    
+    Returns:
+        Dict con la disponibilidad de la semana, Dict con "error" si el endpoint no
+        existe, o None si la semana no tiene horarios disponibles
+    """
+    fecha_fin_dt = fecha_inicio_dt + timedelta(days=6)  # 1 semana
+    
+    # Preparar body JSON para la API según documentación de Dentalink
+    body_data = {
+        "ids_dentista": ids_profesionales,
+        "id_sucursal": id_sucursal,
+        "fecha_inicio": fecha_inicio_dt.strftime("%Y-%m-%d"),
+        "fecha_fin": fecha_fin_dt.strftime("%Y-%m-%d")
+    }
+    
+    log_detalle(f"📋 Body JSON enviado: {body_data}")
+    sumar_registro("semanas_consultadas")
+    
+    clave_cache = _clave_disponibilidad(ids_profesionales, id_sucursal, body_data["fecha_inicio"], body_data["fecha_fin"])
+    horarios_data = obtener_disponibilidad_cacheada(clave_cache)
+    if horarios_data is not None:
+        sumar_registro("semanas_desde_cache")
+        log_detalle(f"💾 Horarios obtenidos desde caché para la semana del {body_data['fecha_inicio']}")
+    else:
+        horarios_data = _consultar_horarios_semana(api_base, headers_api, body_data, clave_cache)
+        if "error" in horarios_data:
+            return horarios_data
+    
+    if not horarios_data:
+        log_detalle(f"⚠️ No hay datos de horarios en la respuesta para la semana del {body_data['fecha_inicio']}")
+        return None
+    
+    disponibilidad_final = _procesar_horarios_semana(
+        horarios_data, profesionales_info, profesionales_intervalos, hora_actual, tiempo_cita
+    )
+    if not disponibilidad_final:
+        return None
+    
+    return {
+        "disponibilidad": disponibilidad_final,
+        "fecha_desde": fecha_inicio_dt.strftime('%Y-%m-%d'),
+        "fecha_hasta": fecha_fin_dt.strftime('%Y-%m-%d')
+    }
+
+def _consultar_horarios_semana(api_base: str, headers_api: Dict, body_data: Dict, clave_cache: Tuple) -> Dict:
+    """
+    Consulta horariosdisponibles para una ventana y guarda la respuesta en caché.
+    
+    Returns:
+        horarios_data de la API ({} si no hubo datos) o Dict con "error" si el endpoint no existe
+    """
+    generacion = generacion_cache_disponibilidad()
+    
+    # Obtener horarios disponibles
+    response, url_usado = consultar_horarios_disponibles(api_base, headers_api, json=body_data)
+    
+    if response is None or response.status_code == 404:
+        logging.error("❌ Endpoint horariosdisponibles no encontrado en ninguna URL")
+        return {"error": "Endpoint horariosdisponibles no encontrado"}
+    
+    log_detalle(f"✅ URL exitosa: {url_usado}")
+    
+    if response.status_code != 200:
+        logging.error(f"❌ Status code no exitoso en horariosdisponibles: {response.status_code}")
+        log_detalle(f"📄 Response text: {response.text[:500]}")
+        return {}
+    
+    try:
+        data_response = response.json()
+        horarios_data = data_response.get("data", {})
+        log_detalle(f"📊 Cantidad de profesionales con horarios: {len(horarios_data) if horarios_data else 0}")
+    except json.JSONDecodeError as e:
+        logging.error(f"❌ Error parseando JSON: {e}")
+        return {}
+    
+    horarios_data = horarios_data or {}
+    guardar_disponibilidad_cacheada(clave_cache, horarios_data, generacion)
+    return horarios_data
+
+def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_inicio: str = None, tiempo_cita: int = None,
+                        busqueda_paralela: bool = None) -> Dict[str, Any]:
     """
     Busca disponibilidad de profesionales en Dentalink.
     
@@ -232,16 +857,16 @@ def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_in
         id_sucursal: ID de la sucursal
         fecha_inicio: Fecha de inicio (opcional, default: hoy)
         tiempo_cita: Tiempo en minutos requerido para la cita (opcional)
+        busqueda_paralela: Consulta las 4 semanas a la vez y retorna la primera con
+            disponibilidad (opcional, default: BUSQUEDA_PARALELA)
     
     Returns:
         Dict con la disponibilidad encontrada
     """
-    logging.info("🔍 Iniciando búsqueda de disponibilidad")
-    logging.info(f"📋 Parámetros recibidos:")
-    logging.info(f"   - ids_profesionales: {ids_profesionales}")
-    logging.info(f"   - id_sucursal: {id_sucursal}")
-    logging.info(f"   - fecha_inicio: {fecha_inicio}")
-    logging.info(f"   - tiempo_cita: {tiempo_cita}")
+    anotar_registro(id_sucursal=id_sucursal, profesionales=len(ids_profesionales or []),
+                    fecha_inicio=fecha_inicio, tiempo_cita=tiempo_cita)
+    log_detalle(f"🔍 Búsqueda de disponibilidad: ids_profesionales={ids_profesionales}, id_sucursal={id_sucursal}, "
+                f"fecha_inicio={fecha_inicio}, tiempo_cita={tiempo_cita}")
     
     # Validaciones
     if not ids_profesionales:
@@ -252,35 +877,27 @@ def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_in
         logging.error("❌ Error: No se proporcionó ID de sucursal")
         return {"error": "Se requiere ID de sucursal"}
     
+    if busqueda_paralela is None:
+        busqueda_paralela = BUSQUEDA_PARALELA
+    
     # Obtener configuración de API
     api_base, headers_api = obtener_configuracion_api()
-    logging.info(f"🔧 API seleccionada: {obtener_nombre_api()}")
-    logging.info(f"🌐 URL base: {api_base}")
-    logging.info(f"🔑 Headers: {headers_api}")
+    anotar_registro(api=obtener_nombre_api(), busqueda_paralela=bool(busqueda_paralela))
     
-    # Obtener nombres e intervalos de profesionales
+    # Obtener nombres e intervalos de profesionales desde la caché
     profesionales_info = {}
     profesionales_intervalos = {}
-    try:
-        logging.info("👨‍⚕️ Obteniendo información de profesionales...")
-        prof_resp = requests.get(f"{api_base}dentistas", headers=headers_api)
-        if prof_resp.status_code == 200:
-            dentistas = prof_resp.json().get("data", [])
-            for dentista in dentistas:
-                if dentista.get("id") in ids_profesionales:
-                    apellido = dentista.get('apellido') or dentista.get('apellidos', '')
-                    nombre_completo = f"{dentista.get('nombre', 'Desconocido')} {apellido}".strip()
-                    intervalo = dentista.get('intervalo')  # Sin default, debe venir del profesional
-                    profesionales_info[dentista.get("id")] = nombre_completo
-                    if intervalo:
-                        profesionales_intervalos[dentista.get("id")] = intervalo
-                        logging.info(f"✅ Profesional encontrado: ID {dentista.get('id')} - {nombre_completo} (Intervalo: {intervalo} min)")
-                    else:
-                        logging.warning(f"⚠️ Profesional ID {dentista.get('id')} - {nombre_completo} sin intervalo configurado")
+    directorio = obtener_directorio_profesionales()
+    for id_prof in ids_profesionales:
+        profesional = directorio.get(id_prof)
+        if not profesional:
+            continue
+        profesionales_info[id_prof] = profesional["nombre"]
+        if profesional["intervalo"]:
+            profesionales_intervalos[id_prof] = profesional["intervalo"]
+            log_detalle(f"✅ Profesional encontrado: ID {id_prof} - {profesional['nombre']} (Intervalo: {profesional['intervalo']} min)")
         else:
-            logging.warning(f"⚠️ No se pudieron obtener los profesionales: {prof_resp.status_code}")
-    except Exception as e:
-        logging.warning(f"⚠️ Error obteniendo información de profesionales: {e}")
+            logging.warning(f"⚠️ Profesional ID {id_prof} - {profesional['nombre']} sin intervalo configurado")
     
     # Obtener hora actual de Santiago/Chile
     tz_santiago = pytz.timezone("America/Santiago")
@@ -291,158 +908,39 @@ def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_in
         fecha_inicio = hora_actual.strftime("%Y-%m-%d")
     
     fecha_inicio_dt = datetime.strptime(fecha_inicio, "%Y-%m-%d")
-    
-    # Búsqueda iterativa hasta 4 semanas
-    intentos_maximos = 4
-    intento_actual = 1
-    
-    while intento_actual <= intentos_maximos:
-        fecha_fin_dt = fecha_inicio_dt + timedelta(days=6)  # 1 semana
-        
-        logging.info(f"🔄 Intento {intento_actual} de {intentos_maximos}: "
-                    f"Buscando del {fecha_inicio_dt.strftime('%Y-%m-%d')} al {fecha_fin_dt.strftime('%Y-%m-%d')}")
-        
-        # Preparar body JSON para la API según documentación de Dentalink
-        body_data = {
-            "ids_dentista": ids_profesionales,
-            "id_sucursal": id_sucursal,
-            "fecha_inicio": fecha_inicio_dt.strftime("%Y-%m-%d"),
-            "fecha_fin": fecha_fin_dt.strftime("%Y-%m-%d")
-        }
-        
-        logging.info(f"📋 Body JSON enviado: {body_data}")
-        
-        # Obtener horarios disponibles
-        urls_to_try = [f"{api_base}horariosdisponibles/", f"{api_base}horariosdisponibles"]
-        response = None
-        url_usado = None
-        
-        for url_horarios in urls_to_try:
-            try:
-                logging.info(f"🌐 Intentando URL: {url_horarios}")
-                response = requests.get(url_horarios, headers=headers_api, json=body_data)
-                logging.info(f"📊 Status Code: {response.status_code}")
-                
-                if response.status_code != 404:
-                    url_usado = url_horarios
-                    break
-            except requests.exceptions.RequestException as e:
-                logging.error(f"❌ Error al conectar con {url_horarios}: {e}")
-        
-        if response is None or response.status_code == 404:
-            logging.error("❌ Endpoint horariosdisponibles no encontrado en ninguna URL")
-            return {"error": "Endpoint horariosdisponibles no encontrado"}
-        
-        logging.info(f"✅ URL exitosa: {url_usado}")
-        logging.info(f"📄 Response raw: {response.text[:500]}...")  # Primeros 500 caracteres
-        
-        if response.status_code == 200:
-            try:
-                data_response = response.json()
-                logging.info(f"📦 Estructura de respuesta: {list(data_response.keys())}")
-                horarios_data = data_response.get("data", {})
-                logging.info(f"📅 Horarios data keys: {list(horarios_data.keys()) if horarios_data else 'No data'}")
-                logging.info(f"📊 Cantidad de profesionales con horarios: {len(horarios_data) if horarios_data else 0}")
-            except json.JSONDecodeError as e:
-                logging.error(f"❌ Error parseando JSON: {e}")
-                continue
-            
-            if horarios_data:
-                disponibilidad_final = []
-                logging.info(f"🔍 Procesando horarios para {len(horarios_data)} profesionales")
-                
-                for id_profesional_str, fechas_horarios in horarios_data.items():
-                    id_profesional_int = int(id_profesional_str)
-                    logging.info(f"👨‍⚕️ Procesando profesional ID: {id_profesional_str}")
-                    logging.info(f"📅 Fechas disponibles: {list(fechas_horarios.keys()) if isinstance(fechas_horarios, dict) else 'No es dict'}")
-                    
-                    # Obtener nombre del profesional
-                    nombre_profesional = profesionales_info.get(id_profesional_int, f"Profesional {id_profesional_int}")
-                    intervalo_profesional = profesionales_intervalos.get(id_profesional_int)
-                    logging.info(f"👤 Nombre asignado: {nombre_profesional}")
-                    if intervalo_profesional:
-                        logging.info(f"⏱️ Intervalo del profesional: {intervalo_profesional} minutos")
-                    else:
-                        logging.warning(f"⚠️ Profesional sin intervalo configurado")
-                    
-                    disponibilidad_profesional = {
-                        "id_profesional": id_profesional_int,
-                        "nombre_profesional": nombre_profesional,
-                        "fechas": {}
-                    }
-                    
-                    if isinstance(fechas_horarios, dict):
-                        for fecha, horarios in fechas_horarios.items():
-                            logging.info(f"📆 Procesando fecha {fecha} con {len(horarios) if isinstance(horarios, list) else 'No es lista'} horarios")
-                            
-                            if isinstance(horarios, list):
-                                horarios_futuros = filtrar_horarios_futuros(horarios, fecha, hora_actual)
-                                logging.info(f"⏰ Horarios futuros filtrados: {len(horarios_futuros)}")
-                                
-                                if horarios_futuros:
-                                    horarios_normalizados = []
-                                    for horario in horarios_futuros:
-                                        hora_inicio = horario.get("hora_inicio", "")
-                                        logging.info(f"🕐 Procesando hora: {hora_inicio}")
-                                        
-                                        # Normalizar formato de hora
-                                        try:
-                                            hora_normalizada = datetime.strptime(hora_inicio, "%H:%M:%S").strftime("%H:%M")
-                                        except ValueError:
-                                            logging.warning(f"⚠️ Formato de hora inválido: {hora_inicio}")
-                                            hora_normalizada = hora_inicio
-                                        
-                                        horarios_normalizados.append(hora_normalizada)
-                                    
-                                    if horarios_normalizados:
-                                        # Validar bloques consecutivos si se especificó tiempo_cita Y el profesional tiene intervalo
-                                        if tiempo_cita and intervalo_profesional:
-                                            logging.info(f"🔍 Validando bloques consecutivos para tiempo_cita={tiempo_cita} min")
-                                            horarios_normalizados = validar_bloques_consecutivos(
-                                                horarios_normalizados, 
-                                                tiempo_cita, 
-                                                intervalo_profesional
-                                            )
-                                        elif tiempo_cita and not intervalo_profesional:
-                                            logging.warning(f"⚠️ Se solicitó tiempo_cita={tiempo_cita} min pero el profesional no tiene intervalo configurado. No se puede validar bloques consecutivos.")
-                                        
-                                        if horarios_normalizados:
-                                            # Formatear fecha en español
-                                            fecha_formateada = formatear_fecha_espanol(fecha)
-                                            disponibilidad_profesional["fechas"][fecha_formateada] = horarios_normalizados
-                                            logging.info(f"✅ Fecha {fecha} ({fecha_formateada}) agregada con {len(horarios_normalizados)} horarios")
-                                        else:
-                                            logging.info(f"❌ Fecha {fecha} sin horarios válidos después de validar bloques consecutivos")
-                            else:
-                                logging.warning(f"⚠️ Horarios para fecha {fecha} no es una lista: {type(horarios)}")
-                    else:
-                        logging.warning(f"⚠️ fechas_horarios no es un dict: {type(fechas_horarios)}")
-                    
-                    if disponibilidad_profesional["fechas"]:
-                        disponibilidad_final.append(disponibilidad_profesional)
-                        logging.info(f"✅ Profesional {id_profesional_str} agregado con {len(disponibilidad_profesional['fechas'])} fechas")
-                    else:
-                        logging.info(f"❌ Profesional {id_profesional_str} sin fechas disponibles")
-                
-                logging.info(f"📊 Total profesionales con disponibilidad: {len(disponibilidad_final)}")
-                
-                if disponibilidad_final:
-                    resultado = {
-                        "disponibilidad": disponibilidad_final,
-                        "fecha_desde": fecha_inicio_dt.strftime('%Y-%m-%d'),
-                        "fecha_hasta": fecha_fin_dt.strftime('%Y-%m-%d')
-                    }
-                    logging.info(f"✅ Retornando disponibilidad exitosa")
+    inicios_semana = [fecha_inicio_dt + timedelta(days=7 * semana) for semana in range(SEMANAS_BUSQUEDA)]
+    argumentos_semana = (profesionales_info, profesionales_intervalos, hora_actual, tiempo_cita)
+    
+    if busqueda_paralela:
+        # Consultar todas las semanas a la vez y revisarlas en orden de fecha
+        log_detalle(f"⚡ Consultando {SEMANAS_BUSQUEDA} semanas en paralelo")
+        # Cada tarea corre con una copia del contexto para sumar al registro de esta petición
+        futuros = [
+            _pool_semanas.submit(copy_context().run, _buscar_semana, api_base, headers_api, ids_profesionales, id_sucursal,
+                                 inicio_semana, *argumentos_semana)
+            for inicio_semana in inicios_semana
+        ]
+        try:
+            for semana, futuro in enumerate(futuros, start=1):
+                resultado = futuro.result()
+                if resultado:
+                    anotar_registro(semana_encontrada=semana)
                     return resultado
-            else:
-                logging.warning(f"⚠️ No hay datos de horarios en la respuesta para intento {intento_actual}")
-        else:
-            logging.error(f"❌ Status code no exitoso: {response.status_code}")
-            logging.error(f"📄 Response text: {response.text}")
-        
-        # Avanzar a la siguiente semana
-        fecha_inicio_dt += timedelta(days=7)
-        intento_actual += 1
+        finally:
+            # Las semanas posteriores ya no se necesitan
+            for futuro in futuros:
+                futuro.cancel()
+    else:
+        # Búsqueda iterativa hasta 4 semanas
+        for intento_actual, inicio_semana in enumerate(inicios_semana, start=1):
+            log_detalle(f"🔄 Intento {intento_actual} de {SEMANAS_BUSQUEDA}: "
+                        f"Buscando del {inicio_semana.strftime('%Y-%m-%d')} al {(inicio_semana + timedelta(days=6)).strftime('%Y-%m-%d')}")
+            
+            resultado = _buscar_semana(api_base, headers_api, ids_profesionales, id_sucursal,
+                                       inicio_semana, *argumentos_semana)
+            if resultado:
+                anotar_registro(semana_encontrada=intento_actual)
+                return resultado
     
     return {
         "mensaje": "No se encontró disponibilidad en las próximas 4 semanas",
@@ -456,12 +954,23 @@ def endpoint_search_availability():
     if not data:
         return jsonify({"error": "No se proporcionaron datos"}), 400
     
+    # IDs normalizados a int: la clave de caché y su invalidación tras agendar usan los mismos valores
     ids_profesionales = data.get("ids_profesionales", [])
+    if not isinstance(ids_profesionales, list):
+        ids_profesionales = [ids_profesionales]
+    ids_profesionales = [extraer_id(valor) for valor in ids_profesionales]
+    if None in ids_profesionales:
+        return jsonify({"error": "ids_profesionales debe contener solo IDs numéricos"}), 400
+    
     id_sucursal = extraer_id(data.get("id_sucursal"))
+    if id_sucursal is None and data.get("id_sucursal") is not None:
+        return jsonify({"error": "id_sucursal debe ser un ID numérico"}), 400
+    
     fecha_inicio = data.get("fecha_inicio")
     tiempo_cita = data.get("tiempo_cita")
+    busqueda_paralela = data.get("busqueda_paralela")
     
-    resultado = search_availability(ids_profesionales, id_sucursal, fecha_inicio, tiempo_cita)
+    resultado = search_availability(ids_profesionales, id_sucursal, fecha_inicio, tiempo_cita, busqueda_paralela)
     
     if "error" in resultado:
         return jsonify(resultado), 400
@@ -493,7 +1002,7 @@ def search_user(rut: str, id_sucursal: int = None) -> Dict[str, Any]:
         filtro = json.dumps({"rut": {"eq": rut_formateado}})
         logging.info(f"🔍 Buscando paciente en {api_base}pacientes?q=... RUT={rut_formateado}")
         
-        response = requests.get(f"{api_base}pacientes", headers=headers_api, params={"q": filtro})
+        response = http_get(f"{api_base}pacientes", headers=headers_api, params={"q": filtro})
         logging.info(f"📊 Status búsqueda paciente en {api_name}: {response.status_code}")
         
         if response.status_code == 200:
@@ -584,7 +1093,7 @@ def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email
         payload_paciente["fecha_nacimiento"] = fecha_nacimiento
     
     try:
-        response = requests.post(f"{api_base}pacientes/", headers=headers_api, json=payload_paciente)
+        response = http_post(f"{api_base}pacientes/", headers=headers_api, json=payload_paciente)
         
         if response.status_code == 201:
             paciente_data = response.json().get("data", {})
@@ -631,6 +1140,590 @@ def endpoint_create_user():
     
     return jsonify(resultado)
 
+# ============================
+# COLA PERSISTENTE DE SINCRONIZACIÓN GHL
+# ============================
+
+# Archivo SQLite de la cola: los trabajos pendientes sobreviven a un reinicio del proceso
+GHL_COLA_ARCHIVO = os.getenv('GHL_COLA_ARCHIVO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ghl_cola.sqlite3'))
+GHL_WORKERS = int(os.getenv('GHL_WORKERS', '2'))
+GHL_MAX_INTENTOS = int(os.getenv('GHL_MAX_INTENTOS', '6'))
+# Espera antes del reintento n: GHL_BACKOFF_BASE * 2^(n-1) segundos (±20%), como mucho GHL_BACKOFF_MAX
+GHL_BACKOFF_BASE = float(os.getenv('GHL_BACKOFF_BASE', '5'))
+GHL_BACKOFF_MAX = float(os.getenv('GHL_BACKOFF_MAX', '900'))
+# Segundos que un trabajo tomado queda reservado; si el worker muere, otro lo retoma al vencer.
+# Mientras el trabajo corre, un latido la renueva cada GHL_RESERVA / 3: un trabajo lento
+# (esperas del límite de GHL, Retry-After, timeouts) nunca queda libre para otro worker
+GHL_RESERVA = float(os.getenv('GHL_RESERVA', '300'))
+GHL_COLA_ESPERA = 2.0  # Cada cuánto revisa la cola un worker sin trabajo
+
+class ErrorSincronizacionGHL(Exception):
+    """GHL respondió con error; reintentable=False manda el trabajo directo al dead letter"""
+    
+    def __init__(self, mensaje: str, reintentable: bool = True):
+        super().__init__(mensaje)
+        self.reintentable = reintentable
+
+def status_reintentable_ghl(status_code: int) -> bool:
+    """429 y 5xx son transitorios; el resto de los 4xx no se arreglan reintentando"""
+    return status_code == 429 or status_code >= 500
+
+_aviso_cola_ghl = threading.Event()
+_workers_ghl: List[threading.Thread] = []
+_workers_ghl_lock = threading.Lock()
+
+# Contadores de este proceso desde que arrancó
+_contadores_ghl = {"encolados": 0, "sincronizados": 0, "reintentos": 0, "dead_letter": 0}
+_contadores_ghl_lock = threading.Lock()
+
+def _contar_ghl(campo: str) -> None:
+    with _contadores_ghl_lock:
+        _contadores_ghl[campo] += 1
+
+def _conexion_cola_ghl() -> sqlite3.Connection:
+    """Conexión nueva en modo autocommit; las transacciones se abren explícitamente"""
+    return sqlite3.connect(GHL_COLA_ARCHIVO, timeout=30, isolation_level=None)
+
+def _inicializar_cola_ghl() -> None:
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.executescript("""
+            CREATE TABLE IF NOT EXISTS ghl_cola (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                datos TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                creado_en REAL NOT NULL,
+                disponible_en REAL NOT NULL,
+                reservado_hasta REAL NOT NULL DEFAULT 0,
+                ultimo_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ghl_cola_disponible ON ghl_cola (disponible_en);
+            CREATE TABLE IF NOT EXISTS ghl_dead_letter (
+                id INTEGER PRIMARY KEY,
+                datos TEXT NOT NULL,
+                intentos INTEGER NOT NULL,
+                creado_en REAL NOT NULL,
+                descartado_en REAL NOT NULL,
+                ultimo_error TEXT
+            );
+        """)
+
+def encolar_sincronizacion_ghl(datos: Dict[str, Any]) -> bool:
+    """
+    Guarda un trabajo de sincronización en la cola y despierta a los workers.
+    
+    Returns:
+        bool: False si no se pudo guardar (queda en el log para reprocesarlo a mano)
+    """
+    ahora = time.time()
+    try:
+        with closing(_conexion_cola_ghl()) as conexion:
+            conexion.execute(
+                "INSERT INTO ghl_cola (datos, creado_en, disponible_en) VALUES (?, ?, ?)",
+                (json.dumps(datos, ensure_ascii=False), ahora, ahora)
+            )
+    except sqlite3.Error as e:
+        logging.error(f"❌ No se pudo encolar sincronización GHL ({e}): {json.dumps(datos, ensure_ascii=False)}")
+        return False
+    
+    _contar_ghl("encolados")
+    _aviso_cola_ghl.set()
+    return True
+
+def _tomar_trabajo_ghl() -> Optional[Tuple[int, Dict[str, Any], int]]:
+    """Reserva el trabajo disponible más antiguo; (id, datos, intentos previos) o None"""
+    ahora = time.time()
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        fila = conexion.execute(
+            "SELECT id, datos, intentos FROM ghl_cola WHERE disponible_en <= ? AND reservado_hasta <= ? "
+            "ORDER BY disponible_en, id LIMIT 1",
+            (ahora, ahora)
+        ).fetchone()
+        if fila:
+            conexion.execute("UPDATE ghl_cola SET reservado_hasta = ? WHERE id = ?", (ahora + GHL_RESERVA, fila[0]))
+        conexion.execute("COMMIT")
+    if not fila:
+        return None
+    return fila[0], json.loads(fila[1]), fila[2]
+
+def _renovar_reserva_ghl(id_trabajo: int, terminado: threading.Event) -> None:
+    """Latido: extiende la reserva del trabajo hasta que el worker avise que terminó"""
+    while not terminado.wait(GHL_RESERVA / 3):
+        try:
+            with closing(_conexion_cola_ghl()) as conexion:
+                conexion.execute("UPDATE ghl_cola SET reservado_hasta = ? WHERE id = ?",
+                                 (time.time() + GHL_RESERVA, id_trabajo))
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ No se pudo renovar la reserva del trabajo GHL {id_trabajo}: {e}")
+
+def _completar_trabajo_ghl(id_trabajo: int) -> None:
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("DELETE FROM ghl_cola WHERE id = ?", (id_trabajo,))
+    _contar_ghl("sincronizados")
+
+def _registrar_fallo_ghl(id_trabajo: int, intentos: int, error: Exception) -> None:
+    """Reprograma el trabajo con backoff exponencial o lo pasa al dead letter"""
+    mensaje = f"{type(error).__name__}: {error}"
+    reintentable = getattr(error, "reintentable", True)
+    
+    with closing(_conexion_cola_ghl()) as conexion:
+        if reintentable and intentos < GHL_MAX_INTENTOS:
+            espera = min(GHL_BACKOFF_MAX, GHL_BACKOFF_BASE * 2 ** (intentos - 1)) * random.uniform(0.8, 1.2)
+            conexion.execute(
+                "UPDATE ghl_cola SET intentos = ?, disponible_en = ?, reservado_hasta = 0, ultimo_error = ? WHERE id = ?",
+                (intentos, time.time() + espera, mensaje, id_trabajo)
+            )
+            _contar_ghl("reintentos")
+            logging.warning(f"🔁 Sincronización GHL {id_trabajo} falló (intento {intentos}/{GHL_MAX_INTENTOS}): "
+                            f"{mensaje}; reintento en {espera:.0f}s")
+            return
+        
+        conexion.execute("BEGIN IMMEDIATE")
+        conexion.execute(
+            "INSERT OR REPLACE INTO ghl_dead_letter (id, datos, intentos, creado_en, descartado_en, ultimo_error) "
+            "SELECT id, datos, ?, creado_en, ?, ? FROM ghl_cola WHERE id = ?",
+            (intentos, time.time(), mensaje, id_trabajo)
+        )
+        conexion.execute("DELETE FROM ghl_cola WHERE id = ?", (id_trabajo,))
+        conexion.execute("COMMIT")
+    _contar_ghl("dead_letter")
+    logging.error(f"❌ Sincronización GHL {id_trabajo} enviada al dead letter tras {intentos} intentos: {mensaje}")
+
+def _worker_ghl() -> None:
+    """Toma trabajos de la cola uno a uno; sin trabajo, espera un aviso o GHL_COLA_ESPERA"""
+    while True:
+        try:
+            trabajo = _tomar_trabajo_ghl()
+        except sqlite3.Error as e:
+            logging.error(f"❌ Error leyendo la cola GHL: {e}")
+            time.sleep(GHL_COLA_ESPERA)
+            continue
+        
+        if trabajo is None:
+            _aviso_cola_ghl.wait(GHL_COLA_ESPERA)
+            _aviso_cola_ghl.clear()
+            continue
+        
+        id_trabajo, datos, intentos = trabajo
+        terminado = threading.Event()
+        latido = threading.Thread(target=_renovar_reserva_ghl, args=(id_trabajo, terminado),
+                                  name=f"ghl-reserva-{id_trabajo}", daemon=True)
+        latido.start()
+        try:
+            _ejecutar_sincronizacion_ghl(datos)
+        except Exception as e:
+            resultado = e
+        else:
+            resultado = None
+        finally:
+            # El latido se detiene antes de tocar la fila para no pisar reservado_hasta = 0
+            terminado.set()
+            latido.join()
+        
+        try:
+            if resultado is None:
+                _completar_trabajo_ghl(id_trabajo)
+            else:
+                _registrar_fallo_ghl(id_trabajo, intentos + 1, resultado)
+        except sqlite3.Error as e:
+            # La reserva vence sola y el trabajo se vuelve a tomar
+            logging.error(f"❌ Error actualizando la cola GHL para el trabajo {id_trabajo}: {e}")
+
+def iniciar_workers_ghl() -> None:
+    """Crea la cola si no existe y arranca GHL_WORKERS hilos (una sola vez por proceso)"""
+    with _workers_ghl_lock:
+        if _workers_ghl:
+            return
+        try:
+            _inicializar_cola_ghl()
+        except sqlite3.Error as e:
+            logging.error(f"❌ No se pudo abrir la cola GHL en {GHL_COLA_ARCHIVO}: {e}")
+            return
+        for numero in range(GHL_WORKERS):
+            worker = threading.Thread(target=_worker_ghl, name=f"ghl-sync-{numero}", daemon=True)
+            worker.start()
+            _workers_ghl.append(worker)
+    logging.info(f"🧵 {GHL_WORKERS} workers de sincronización GHL iniciados ({GHL_COLA_ARCHIVO})")
+
+def metricas_cola_ghl() -> Dict[str, Any]:
+    """Profundidad de la cola y del dead letter, más los contadores de este proceso"""
+    ahora = time.time()
+    with closing(_conexion_cola_ghl()) as conexion:
+        pendientes, en_proceso, en_reintento, creado_mas_antiguo = conexion.execute(
+            "SELECT COUNT(*), COALESCE(SUM(reservado_hasta > ?), 0), COALESCE(SUM(intentos > 0), 0), MIN(creado_en) "
+            "FROM ghl_cola",
+            (ahora,)
+        ).fetchone()
+        dead_letter = conexion.execute("SELECT COUNT(*) FROM ghl_dead_letter").fetchone()[0]
+    with _contadores_ghl_lock:
+        contadores = dict(_contadores_ghl)
+    return {
+        "pendientes": pendientes,
+        "en_proceso": en_proceso,
+        "en_reintento": en_reintento,
+        "antiguedad_max_s": round(ahora - creado_mas_antiguo, 1) if creado_mas_antiguo else 0,
+        "dead_letter": dead_letter,
+        "workers": len(_workers_ghl),
+        "proceso": contadores,
+        "contactos": _coalescedor_contactos_ghl.metricas(),
+        "limite": metricas_limite_ghl()
+    }
+
+def reencolar_dead_letter_ghl(ids: List[int] = None) -> int:
+    """Devuelve a la cola los trabajos del dead letter (todos o los ids indicados); retorna cuántos"""
+    filtro, parametros = "", ()
+    if ids:
+        filtro = f" WHERE id IN ({', '.join('?' for _ in ids)})"
+        parametros = tuple(ids)
+    ahora = time.time()
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        cantidad = conexion.execute(
+            "INSERT INTO ghl_cola (datos, creado_en, disponible_en) "
+            f"SELECT datos, creado_en, ? FROM ghl_dead_letter{filtro}",
+            (ahora, *parametros)
+        ).rowcount
+        conexion.execute(f"DELETE FROM ghl_dead_letter{filtro}", parametros)
+        conexion.execute("COMMIT")
+    if cantidad:
+        _aviso_cola_ghl.set()
+    return cantidad
+
+# ============================
+# LÍMITE DE PETICIONES A GHL
+# ============================
+
+# GHL admite unas 100 peticiones cada 10 segundos por location
+GHL_LIMITE_PETICIONES = int(os.getenv('GHL_LIMITE_PETICIONES', '100'))
+GHL_LIMITE_VENTANA = float(os.getenv('GHL_LIMITE_VENTANA', '10'))
+# Máximo que una llamada espera su turno antes de desistir
+GHL_LIMITE_ESPERA_MAXIMA = float(os.getenv('GHL_LIMITE_ESPERA_MAXIMA', '60'))
+GHL_REINTENTOS_429 = int(os.getenv('GHL_REINTENTOS_429', '1'))
+
+class CuboTokensGHL:
+    """
+    Token bucket de una location: GHL_LIMITE_PETICIONES tokens que se recargan de forma
+    continua a lo largo de GHL_LIMITE_VENTANA segundos. Mientras haya llamadas
+    interactivas esperando, las de segundo plano ceden el turno. Un 429 pausa el cubo
+    entero durante el Retry-After que indicó GHL.
+    """
+    
+    def __init__(self, capacidad: int, ventana: float):
+        self.capacidad = capacidad
+        self.recarga_por_s = capacidad / ventana
+        self._tokens = float(capacidad)
+        self._actualizado = time.monotonic()
+        self._pausado_hasta = 0.0
+        self._restante_ghl: Optional[int] = None  # Último X-RateLimit-Remaining informado por GHL
+        self._esperando = {True: 0, False: 0}     # Llamadas en espera: interactivas / segundo plano
+        self._contadores = {"llamadas": 0, "con_espera": 0, "sin_turno": 0, "respuestas_429": 0}
+        self._condicion = threading.Condition()
+    
+    def _recargar(self, ahora: float) -> None:
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._actualizado) * self.recarga_por_s)
+        self._actualizado = ahora
+    
+    def tomar(self, interactiva: bool, espera_maxima: float) -> bool:
+        """Espera un token; retorna False si no lo consiguió dentro de espera_maxima"""
+        limite = time.monotonic() + espera_maxima
+        espero = False
+        with self._condicion:
+            self._esperando[interactiva] += 1
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._recargar(ahora)
+                    cede = not interactiva and self._esperando[True] > 0
+                    if ahora >= self._pausado_hasta and self._tokens >= 1 and not cede:
+                        self._tokens -= 1
+                        self._contadores["llamadas"] += 1
+                        if espero:
+                            self._contadores["con_espera"] += 1
+                        return True
+                    if ahora >= limite:
+                        self._contadores["sin_turno"] += 1
+                        return False
+                    
+                    if ahora < self._pausado_hasta:
+                        espera = self._pausado_hasta - ahora
+                    elif cede:
+                        espera = limite - ahora  # Despierta cuando una interactiva toma su token
+                    else:
+                        espera = (1 - self._tokens) / self.recarga_por_s
+                    espero = True
+                    self._condicion.wait(min(espera, limite - ahora))
+            finally:
+                self._esperando[interactiva] -= 1
+                self._condicion.notify_all()
+    
+    def registrar_respuesta(self, respuesta: requests.Response) -> None:
+        """Ajusta el cubo con los headers de GHL; en un 429 lo pausa según Retry-After"""
+        with self._condicion:
+            restante = respuesta.headers.get("X-RateLimit-Remaining")
+            if restante is not None and restante.isdigit():
+                self._restante_ghl = int(restante)
+                self._recargar(time.monotonic())
+                self._tokens = min(self._tokens, float(self._restante_ghl))
+            if respuesta.status_code == 429:
+                self._contadores["respuestas_429"] += 1
+                pausa = segundos_retry_after(respuesta)
+                self._pausado_hasta = max(self._pausado_hasta, time.monotonic() + pausa)
+                self._tokens = 0.0
+                logging.warning(f"⏳ GHL respondió 429: llamadas pausadas {pausa:.1f}s")
+    
+    def metricas(self) -> Dict[str, Any]:
+        with self._condicion:
+            ahora = time.monotonic()
+            self._recargar(ahora)
+            return {
+                "tokens_disponibles": int(self._tokens),
+                "capacidad": self.capacidad,
+                "restante_ghl": self._restante_ghl,
+                "pausado_s": round(max(0.0, self._pausado_hasta - ahora), 1),
+                "en_espera": {"interactivas": self._esperando[True], "segundo_plano": self._esperando[False]},
+                **self._contadores
+            }
+
+def segundos_retry_after(respuesta: requests.Response) -> float:
+    """Segundos del header Retry-After (número o fecha HTTP); sin header, una ventana completa"""
+    valor = respuesta.headers.get("Retry-After")
+    if valor:
+        try:
+            return max(0.0, float(valor))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return GHL_LIMITE_VENTANA
+
+_cubos_ghl: Dict[str, CuboTokensGHL] = {}
+_cubos_ghl_lock = threading.Lock()
+
+def cubo_ghl(location_id: str) -> CuboTokensGHL:
+    with _cubos_ghl_lock:
+        cubo = _cubos_ghl.get(location_id)
+        if cubo is None:
+            cubo = _cubos_ghl[location_id] = CuboTokensGHL(GHL_LIMITE_PETICIONES, GHL_LIMITE_VENTANA)
+        return cubo
+
+def http_ghl(method: str, url: str, interactiva: bool = False, location_id: str = None, **kwargs) -> requests.Response:
+    """
+    Petición a GHL que respeta el límite de la location. Ante un 429 espera el
+    Retry-After y reintenta hasta GHL_REINTENTOS_429 veces.
+    
+    Raises:
+        ErrorSincronizacionGHL: si no hubo turno dentro de GHL_LIMITE_ESPERA_MAXIMA (reintentable)
+    """
+    cubo = cubo_ghl(location_id or GHL_LOCATION_ID)
+    for _ in range(GHL_REINTENTOS_429 + 1):
+        if not cubo.tomar(interactiva, GHL_LIMITE_ESPERA_MAXIMA):
+            raise ErrorSincronizacionGHL(f"Sin turno para llamar a GHL tras {GHL_LIMITE_ESPERA_MAXIMA:.0f}s")
+        respuesta = http_request(method, url, **kwargs)
+        cubo.registrar_respuesta(respuesta)
+        if respuesta.status_code != 429:
+            break
+    return respuesta
+
+def metricas_limite_ghl() -> Dict[str, Dict[str, Any]]:
+    """Presupuesto restante de cada location usada por este proceso"""
+    with _cubos_ghl_lock:
+        cubos = dict(_cubos_ghl)
+    return {location_id: cubo.metricas() for location_id, cubo in cubos.items()}
+
+# ============================
+# CACHÉ DEL CALENDAR GHL
+# ============================
+
+# Segundos que se reutiliza el assignedUserId del calendar (sus teamMembers casi nunca cambian)
+GHL_CALENDAR_CACHE_TTL = int(os.getenv('GHL_CALENDAR_CACHE_TTL', '3600'))
+
+_calendar_ghl_assigned_user_id: Optional[str] = None
+_calendar_ghl_expira_en: float = 0.0
+_calendar_ghl_lock = threading.Lock()
+
+def _descargar_assigned_user_id_ghl() -> str:
+    """
+    Consulta GET calendars/{id} y retorna el userId del primer teamMember.
+    
+    Raises:
+        ErrorSincronizacionGHL: si GHL respondió con error o el calendar no tiene teamMembers
+    """
+    headers_ghl = {
+        "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
+        "Content-Type": "application/json",
+        "Version": "2021-04-15"
+    }
+    calendar_resp = http_ghl("GET", f"https://services.leadconnectorhq.com/calendars/{GHL_CALENDAR_ID}",
+                             headers=headers_ghl)
+    if calendar_resp.status_code != 200:
+        raise ErrorSincronizacionGHL(f"Obteniendo calendar: {calendar_resp.status_code} - {calendar_resp.text[:200]}",
+                                     status_reintentable_ghl(calendar_resp.status_code))
+    
+    team_members = calendar_resp.json().get("calendar", {}).get("teamMembers", [])
+    # Usar el primer teamMember disponible
+    assigned_user_id = team_members[0].get("userId") if team_members else None
+    if not assigned_user_id:
+        # Es configuración del calendar: reintentar no lo arregla
+        raise ErrorSincronizacionGHL("No se pudo obtener assignedUserId del calendar", reintentable=False)
+    return assigned_user_id
+
+def obtener_assigned_user_id_ghl() -> str:
+    """
+    Retorna el assignedUserId de los appointments desde la caché; si venció (o fue
+    invalidada) lo vuelve a descargar. Los workers que llegan durante la descarga
+    esperan su resultado en vez de repetir la consulta.
+    
+    Raises:
+        ErrorSincronizacionGHL / requests.exceptions.RequestException: si la descarga falla
+    """
+    global _calendar_ghl_assigned_user_id, _calendar_ghl_expira_en
+    
+    with _calendar_ghl_lock:
+        if _calendar_ghl_assigned_user_id and time.monotonic() < _calendar_ghl_expira_en:
+            return _calendar_ghl_assigned_user_id
+        
+        assigned_user_id = _descargar_assigned_user_id_ghl()
+        _calendar_ghl_assigned_user_id = assigned_user_id
+        _calendar_ghl_expira_en = time.monotonic() + GHL_CALENDAR_CACHE_TTL
+    logging.info(f"🔄 assignedUserId del calendar GHL actualizado: {assigned_user_id}")
+    return assigned_user_id
+
+def invalidar_calendar_ghl() -> None:
+    """Descarta el assignedUserId en caché; el próximo appointment vuelve a consultar el calendar"""
+    global _calendar_ghl_assigned_user_id, _calendar_ghl_expira_en
+    with _calendar_ghl_lock:
+        _calendar_ghl_assigned_user_id = None
+        _calendar_ghl_expira_en = 0.0
+    logging.info("🗑️ Caché del calendar GHL invalidada")
+
+def precargar_calendar_ghl() -> None:
+    """Carga el calendar al iniciar; si falla, el primer trabajo de la cola lo reintenta"""
+    try:
+        obtener_assigned_user_id_ghl()
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudo precargar el calendar GHL: {e}")
+
+# ============================
+# AGRUPACIÓN DE ACTUALIZACIONES DE CONTACTOS GHL
+# ============================
+
+# Segundos que se esperan más cambios de un mismo contacto antes de enviar un único PUT
+GHL_CONTACTO_VENTANA = float(os.getenv('GHL_CONTACTO_VENTANA', '1.5'))
+
+def _clave_custom_field(campo: Dict[str, Any]) -> Any:
+    return campo.get("key") or campo.get("id")
+
+def fusionar_payload_contacto_ghl(base: Dict[str, Any], cambios: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Aplica `cambios` sobre `base` (bodies de PUT contacts/{id}). Los customFields se
+    combinan por key/id y el resto de los campos se reemplaza: siempre gana el último valor.
+    """
+    fusion = dict(base)
+    for campo, valor in cambios.items():
+        if campo != "customFields":
+            fusion[campo] = valor
+            continue
+        custom_fields = {_clave_custom_field(c): c for c in fusion.get("customFields", [])}
+        for custom_field in valor:
+            custom_fields.pop(_clave_custom_field(custom_field), None)
+            custom_fields[_clave_custom_field(custom_field)] = custom_field
+        fusion["customFields"] = list(custom_fields.values())
+    return fusion
+
+class _LoteContactoGHL:
+    """Cambios acumulados de un contacto y los futuros de quienes esperan su PUT"""
+    
+    def __init__(self):
+        self.payload: Dict[str, Any] = {}
+        self.futuros: List[Future] = []
+        self.vencido = False  # Ya pasó su ventana, pero había otro PUT del contacto en curso
+
+class CoalescedorContactosGHL:
+    """
+    Agrupa las actualizaciones de un mismo contacto que llegan dentro de la ventana y
+    las envía en un solo PUT. Los PUT de un contacto nunca se solapan: lo que llega
+    mientras uno está en curso forma un lote nuevo que sale después, así el último
+    valor escrito es el que queda en GHL.
+    """
+    
+    def __init__(self, ventana: float):
+        self.ventana = ventana
+        self._lotes: Dict[str, _LoteContactoGHL] = {}
+        self._enviando = set()
+        self._lock = threading.Lock()
+        self._contadores = {"actualizaciones": 0, "envios": 0}
+    
+    def actualizar(self, contact_id: str, cambios: Dict[str, Any]) -> Future:
+        """Suma los cambios al lote del contacto; el futuro se resuelve con la respuesta del PUT"""
+        futuro = Future()
+        with self._lock:
+            self._contadores["actualizaciones"] += 1
+            lote = self._lotes.get(contact_id)
+            nuevo = lote is None
+            if nuevo:
+                lote = self._lotes[contact_id] = _LoteContactoGHL()
+            lote.payload = fusionar_payload_contacto_ghl(lote.payload, cambios)
+            lote.futuros.append(futuro)
+        
+        if nuevo:
+            temporizador = threading.Timer(self.ventana, self._vaciar, args=(contact_id,))
+            temporizador.daemon = True
+            temporizador.start()
+        return futuro
+    
+    def _vaciar(self, contact_id: str) -> None:
+        """Envía el lote del contacto y, si mientras tanto venció otro, también ese"""
+        while True:
+            with self._lock:
+                lote = self._lotes.get(contact_id)
+                if lote is None:
+                    return
+                if contact_id in self._enviando:
+                    # Lo envía el hilo del PUT en curso apenas termine
+                    lote.vencido = True
+                    return
+                del self._lotes[contact_id]
+                self._enviando.add(contact_id)
+                self._contadores["envios"] += 1
+            
+            self._enviar(contact_id, lote)
+            
+            with self._lock:
+                self._enviando.discard(contact_id)
+                siguiente = self._lotes.get(contact_id)
+                if siguiente is None or not siguiente.vencido:
+                    return
+    
+    def _enviar(self, contact_id: str, lote: _LoteContactoGHL) -> None:
+        if len(lote.futuros) > 1:
+            logging.info(f"🧩 {len(lote.futuros)} actualizaciones del contacto {contact_id} en un solo PUT")
+        headers_ghl = {
+            "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
+            "Content-Type": "application/json",
+            "Version": "2021-07-28"
+        }
+        try:
+            contact_resp = http_ghl("PUT", f"https://services.leadconnectorhq.com/contacts/{contact_id}",
+                                    headers=headers_ghl, json=lote.payload)
+        except Exception as e:
+            for futuro in lote.futuros:
+                futuro.set_exception(e)
+            return
+        for futuro in lote.futuros:
+            futuro.set_result(contact_resp)
+    
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._contadores, "pendientes": len(self._lotes), "ventana_s": self.ventana}
+
+_coalescedor_contactos_ghl = CoalescedorContactosGHL(GHL_CONTACTO_VENTANA)
+
+def actualizar_contacto_ghl(contact_id: str, cambios: Dict[str, Any]) -> Future:
+    """PUT contacts/{id} agrupado con los demás cambios del contacto dentro de la ventana"""
+    return _coalescedor_contactos_ghl.actualizar(contact_id, cambios)
+
 # ============================
 # FUNCIÓN 4: AGENDAR CITA
 # ============================
@@ -664,16 +1757,11 @@ def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int
     duracion = None
     intervalo_profesional = None
     
-    try:
-        prof_resp = requests.get(f"{api_base}dentistas", headers=headers_api)
-        if prof_resp.status_code == 200:
-            dentistas = prof_resp.json().get("data", [])
-            for dentista in dentistas:
-                if dentista.get("id") == id_profesional:
-                    intervalo_profesional = dentista.get("intervalo")
-                    break
-    except Exception as e:
-        logging.warning(f"⚠️ No se pudo obtener intervalo del profesional: {e}")
+    profesional = obtener_profesional(id_profesional)
+    if profesional:
+        intervalo_profesional = profesional["intervalo"]
+    else:
+        logging.warning(f"⚠️ No se pudo obtener intervalo del profesional {id_profesional}")
     
     # Determinar duración: tiempo_cita especificado o intervalo del profesional
     if tiempo_cita:
@@ -697,17 +1785,21 @@ def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int
     }
     
     try:
-        response = requests.post(f"{api_base}citas/", headers=headers_api, json=payload_cita)
+        response = http_post(f"{api_base}citas/", headers=headers_api, json=payload_cita)
         
         if response.status_code == 201:
             cita_data = response.json().get("data", {})
             id_cita = cita_data.get("id")
             
             logging.info(f"✅ Cita creada exitosamente en {api_name} con ID {id_cita}")
+            invalidar_cache_disponibilidad(id_profesional, id_sucursal, fecha)
             
-            # Integración con GHL en segundo plano (requerida)
+            # Integración con GHL en segundo plano (requerida), vía la cola persistente
             if GHL_ACCESS_TOKEN:
-                threading.Thread(target=_integrar_ghl, args=(user_id, fecha, hora_inicio, duracion, id_profesional, id_sucursal, comentario)).start()
+                encolar_sincronizacion_ghl({
+                    "user_id": user_id, "fecha": fecha, "hora_inicio": hora_inicio, "duracion": duracion,
+                    "id_profesional": id_profesional, "id_sucursal": id_sucursal, "comentario": comentario
+                })
             else:
                 logging.warning("⚠️ GHL_ACCESS_TOKEN no configurado; se omite integración GHL")
             
@@ -723,7 +1815,14 @@ def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int
         return {"error": f"Error de conexión: {str(e)}"}
 
 def _integrar_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, id_profesional: int, id_sucursal: int, comentario: str = ""):
-    """Función auxiliar para integración con GHL en segundo plano"""
+    """
+    Actualiza el contacto y crea el appointment en GHL. La ejecutan los workers de la cola.
+    
+    Raises:
+        ErrorSincronizacionGHL: si GHL respondió con error (reintentable o no según el status)
+        requests.exceptions.RequestException: error de conexión (se reintenta; en el POST del
+            appointment solo si no llegó a conectar, para no duplicarlo)
+    """
     try:
         if not GHL_ACCESS_TOKEN:
             return
@@ -739,20 +1838,13 @@ def _integrar_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, id_
         nombre_sucursal = f"Sucursal {id_sucursal}"
         
         try:
-            # Obtener nombre del profesional desde Dentalink
-            prof_resp = requests.get(f"{DENTALINK_API_URL}dentistas", headers=DENTALINK_HEADERS)
-            if prof_resp.status_code == 200:
-                profesionales = prof_resp.json().get("data", [])
-                for prof in profesionales:
-                    if prof.get("id") == id_profesional:
-                        apellido = prof.get('apellido') or prof.get('apellidos', '')
-                        nombre_profesional = f"{prof.get('nombre', 'Desconocido')} {apellido}".strip()
-                        break
+            # Obtener nombre del profesional desde la caché de Dentalink
+            profesional = obtener_profesional(id_profesional)
+            if profesional:
+                nombre_profesional = profesional["nombre"]
             
-            # Obtener nombre de la sucursal desde Dentalink
-            suc_resp = requests.get(f"{DENTALINK_API_URL}sucursales/{id_sucursal}", headers=DENTALINK_HEADERS)
-            if suc_resp.status_code == 200:
-                nombre_sucursal = suc_resp.json().get("data", {}).get("nombre", nombre_sucursal)
+            # Obtener nombre de la sucursal desde el mapa precargado
+            nombre_sucursal = obtener_nombre_sucursal(id_sucursal) or nombre_sucursal
         except Exception as e:
             logging.warning(f"⚠️ Error obteniendo nombres: {e}")
         
@@ -773,49 +1865,21 @@ def _integrar_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, id_
         logging.info(f"🌐 Actualizando contacto en: {update_url}")
         logging.info(f"📋 Payload contacto: {update_payload}")
         
-        contact_resp = requests.put(update_url, headers=headers_ghl, json=update_payload)
+        # Se espera el PUT (agrupado con otros cambios del contacto) antes de crear el appointment
+        contact_resp = actualizar_contacto_ghl(user_id, update_payload).result()
         logging.info(f"📊 Status Code contacto: {contact_resp.status_code}")
         
         if contact_resp.status_code == 200:
             logging.info(f"✅ Contacto actualizado en GHL: {nombre_profesional} - {nombre_sucursal}")
+        elif status_reintentable_ghl(contact_resp.status_code):
+            # Aún no se creó el appointment: se puede reintentar todo sin duplicar nada
+            raise ErrorSincronizacionGHL(f"Actualizando contacto: {contact_resp.status_code} - {contact_resp.text[:200]}")
         else:
             logging.error(f"❌ Error actualizando contacto en GHL: {contact_resp.status_code} - {contact_resp.text}")
         
-        # 3. Obtener assignedUserId del calendar
+        # 3. assignedUserId del calendar (en caché, solo se consulta al vencer)
+        assigned_user_id = obtener_assigned_user_id_ghl()
         headers_ghl["Version"] = "2021-04-15"
-        calendar_url = f"https://services.leadconnectorhq.com/calendars/{GHL_CALENDAR_ID}"
-        logging.info(f"🌐 Obteniendo calendar desde: {calendar_url}")
-        logging.info(f"🔑 Headers GHL: {headers_ghl}")
-        
-        calendar_resp = requests.get(calendar_url, headers=headers_ghl)
-        logging.info(f"📊 Status Code GHL Calendar: {calendar_resp.status_code}")
-        logging.info(f"📄 Response GHL Calendar: {calendar_resp.text[:1000]}...")  # Primeros 1000 caracteres
-        
-        assigned_user_id = None
-        if calendar_resp.status_code == 200:
-            try:
-                calendar_data = calendar_resp.json().get("calendar", {})
-                logging.info(f"📦 Calendar data keys: {list(calendar_data.keys()) if calendar_data else 'No calendar data'}")
-                
-                team_members = calendar_data.get("teamMembers", [])
-                logging.info(f"👥 Team members encontrados: {len(team_members)}")
-                logging.info(f"👥 Team members data: {team_members}")
-                
-                if team_members:
-                    # Usar el primer teamMember disponible
-                    assigned_user_id = team_members[0].get("userId")
-                    logging.info(f"✅ Obtenido assignedUserId del calendar: {assigned_user_id}")
-                else:
-                    logging.error("❌ No hay teamMembers en el calendar")
-            except Exception as e:
-                logging.error(f"❌ Error parseando respuesta del calendar: {e}")
-        else:
-            logging.error(f"❌ Error obteniendo calendar: {calendar_resp.status_code}")
-            logging.error(f"📄 Error response: {calendar_resp.text}")
-        
-        if not assigned_user_id:
-            logging.error("❌ No se pudo obtener assignedUserId del calendar")
-            return
         
         # 4. Crear appointment en GHL
         tz_cl = pytz.timezone("America/Santiago")
@@ -840,16 +1904,36 @@ def _integrar_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, id_
             "endTime": fin_dt.strftime("%Y-%m-%dT%H:%M:%S") + offset_fmt
         }
         
-        appt_resp = requests.post("https://services.leadconnectorhq.com/calendars/events/appointments", 
+        # El POST no es idempotente: si GHL pudo haberlo procesado (timeout de lectura,
+        # conexión cortada o 5xx) reintentar duplicaría el appointment, así que esos
+        # fallos van directo al dead letter para revisarlos antes de reencolar
+        try:
+            appt_resp = http_ghl("POST", "https://services.leadconnectorhq.com/calendars/events/appointments",
                                  headers=headers_ghl, json=appointment_payload)
+        except requests.exceptions.ConnectTimeout:
+            raise  # No llegó a conectar: GHL no recibió nada y se puede reintentar
+        except requests.exceptions.RequestException as e:
+            raise ErrorSincronizacionGHL(f"Creando appointment: sin respuesta de GHL ({e}), "
+                                         f"revisar si se creó antes de reencolar", reintentable=False)
         
         if appt_resp.status_code == 201:
             logging.info("✅ Appointment creado en GHL")
         else:
-            logging.error(f"❌ Error creando appointment GHL: {appt_resp.status_code} - {appt_resp.text}")
+            # Un 4xx (salvo 429) puede venir de un teamMember que ya no existe: el próximo
+            # trabajo vuelve a leer el calendar. Un 429 o un 5xx no dicen nada del calendar
+            if 400 <= appt_resp.status_code < 500 and appt_resp.status_code != 429:
+                invalidar_calendar_ghl()
+            # Solo un 429 garantiza que GHL rechazó la petición sin procesarla
+            raise ErrorSincronizacionGHL(f"Creando appointment: {appt_resp.status_code} - {appt_resp.text[:200]}",
+                                         appt_resp.status_code == 429)
         
     except Exception as e:
         logging.error(f"❌ Error en integración GHL: {e}")
+        raise
+
+def _ejecutar_sincronizacion_ghl(datos: Dict[str, Any]) -> None:
+    """Ejecuta un trabajo de la cola (los argumentos de _integrar_ghl guardados al agendar)"""
+    _integrar_ghl(**datos)
 
 @app.route('/schedule_appointment', methods=['POST'])
 def endpoint_schedule_appointment():
@@ -918,7 +2002,7 @@ def _cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
         url_cita = f"{api_base}citas/{id_cita}"
         
         # Obtener datos de la cita primero
-        resp_get = requests.get(url_cita, headers=headers_api)
+        resp_get = http_get(url_cita, headers=headers_api)
         if resp_get.status_code != 200:
             return {"error": f"No se encontró la cita con ID {id_cita}"}
         
@@ -932,10 +2016,11 @@ def _cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
         }
         
         # Cancelar cita
-        resp_cancel = requests.put(url_cita, headers=headers_api, json=payload_cancelar)
+        resp_cancel = http_put(url_cita, headers=headers_api, json=payload_cancelar)
         
         if resp_cancel.status_code == 200:
             logging.info(f"✅ Cita {id_cita} cancelada en {api_name}")
+            invalidar_cache_disponibilidad(cita_data.get("id_dentista"), cita_data.get("id_sucursal"), cita_data.get("fecha"))
             return {
                 "mensaje": "Cita cancelada exitosamente",
                 "id_cita": id_cita,
@@ -968,7 +2053,7 @@ def _cancelar_proxima_cita_por_rut(rut: str) -> Dict[str, Any]:
     try:
         # Buscar paciente
         filtro = json.dumps({"rut": {"eq": rut_formateado}})
-        resp_pac = requests.get(f"{api_base}pacientes", headers=headers_api, params={"q": filtro})
+        resp_pac = http_get(f"{api_base}pacientes", headers=headers_api, params={"q": filtro})
         
         if resp_pac.status_code != 200:
             return {"error": "No se pudo buscar el paciente"}
@@ -984,7 +2069,7 @@ def _cancelar_proxima_cita_por_rut(rut: str) -> Dict[str, Any]:
         if not citas_link:
             return {"error": "No se pudo acceder a las citas del paciente"}
         
-        resp_citas = requests.get(citas_link, headers=headers_api)
+        resp_citas = http_get(citas_link, headers=headers_api)
         if resp_citas.status_code != 200:
             return {"error": "No se pudieron obtener las citas del paciente"}
         
@@ -1027,9 +2112,10 @@ def _cancelar_proxima_cita_por_rut(rut: str) -> Dict[str, Any]:
             "flag_notificar_anulacion": 1
         }
         
-        resp_cancel = requests.put(url_cancelar, headers=headers_api, json=payload_cancelar)
+        resp_cancel = http_put(url_cancelar, headers=headers_api, json=payload_cancelar)
         
         if resp_cancel.status_code == 200:
+            invalidar_cache_disponibilidad(cita_encontrada.get("id_dentista"), cita_encontrada.get("id_sucursal"), cita_encontrada["fecha"])
             return {
                 "mensaje": "Cita cancelada exitosamente",
                 "id_cita": id_cita,
@@ -1075,19 +2161,17 @@ def get_patient_treatments(rut: str) -> Dict[str, Any]:
     Returns:
         Dict con los tratamientos del paciente o error
     """
-    logging.info(f"🔍 Buscando tratamientos para paciente con RUT: {rut}")
-    
     rut_formateado = formatear_rut(rut)
     api_base, headers_api = obtener_configuracion_api()
     api_name = obtener_nombre_api()
+    anotar_registro(api=api_name)
+    log_detalle(f"🔍 Buscando tratamientos para paciente con RUT: {rut}")
     
     try:
         # 1. Buscar paciente por RUT
         filtro = json.dumps({"rut": {"eq": rut_formateado}})
-        logging.info(f"🔍 Buscando paciente en {api_base}pacientes")
-        
-        resp_paciente = requests.get(f"{api_base}pacientes", headers=headers_api, params={"q": filtro})
-        logging.info(f"📊 Status búsqueda paciente: {resp_paciente.status_code}")
+        resp_paciente = http_get(f"{api_base}pacientes", headers=headers_api, params={"q": filtro})
+        log_detalle(f"📊 Status búsqueda paciente: {resp_paciente.status_code}")
         
         if resp_paciente.status_code != 200:
             return {"error": f"Error al buscar paciente: {resp_paciente.text}"}
@@ -1100,7 +2184,8 @@ def get_patient_treatments(rut: str) -> Dict[str, Any]:
         id_paciente = paciente.get("id")
         nombre_completo = f"{paciente.get('nombre', '')} {paciente.get('apellidos', '')}".strip()
         
-        logging.info(f"✅ Paciente encontrado: {nombre_completo} (ID: {id_paciente})")
+        anotar_registro(id_paciente=id_paciente)
+        log_detalle(f"✅ Paciente encontrado: {nombre_completo} (ID: {id_paciente})")
         
         # 2. Buscar link de tratamientos en los links del paciente
         tratamientos_link = None
@@ -1114,17 +2199,17 @@ def get_patient_treatments(rut: str) -> Dict[str, Any]:
             logging.warning("⚠️ Link de tratamientos no encontrado, construyendo URL manualmente")
             tratamientos_link = f"{api_base}pacientes/{id_paciente}/tratamientos"
         
-        logging.info(f"🔗 Consultando tratamientos: {tratamientos_link}")
+        log_detalle(f"🔗 Consultando tratamientos: {tratamientos_link}")
         
         # 3. Obtener tratamientos
-        resp_tratamientos = requests.get(tratamientos_link, headers=headers_api)
-        logging.info(f"📊 Status tratamientos: {resp_tratamientos.status_code}")
+        resp_tratamientos = http_get(tratamientos_link, headers=headers_api)
+        log_detalle(f"📊 Status tratamientos: {resp_tratamientos.status_code}")
         
         if resp_tratamientos.status_code != 200:
             return {"error": f"Error al obtener tratamientos: {resp_tratamientos.text}"}
         
         tratamientos_data = resp_tratamientos.json().get("data", [])
-        logging.info(f"📋 Tratamientos encontrados: {len(tratamientos_data)}")
+        anotar_registro(tratamientos=len(tratamientos_data))
         
         # 4. Filtrar campos relevantes de tratamientos
         tratamientos_filtrados = []
@@ -1188,6 +2273,39 @@ def health_check():
         "timestamp": datetime.utcnow().isoformat()
     })
 
+@app.route('/cache/profesionales/invalidar', methods=['POST'])
+def endpoint_invalidar_cache_profesionales():
+    """Endpoint para forzar la recarga del directorio de profesionales"""
+    invalidar_cache_profesionales()
+    return jsonify({"mensaje": "Caché de profesionales invalidada"})
+
+@app.route('/cache/sucursales/refrescar', methods=['POST'])
+def endpoint_refrescar_sucursales():
+    """Vuelve a descargar el listado de sucursales (por ejemplo, tras crear una nueva)"""
+    return jsonify({"mensaje": "Mapa de sucursales actualizado", "sucursales": refrescar_sucursales()})
+
+@app.route('/ghl/cola', methods=['GET'])
+def endpoint_metricas_cola_ghl():
+    """Profundidad de la cola de sincronización GHL y del dead letter"""
+    try:
+        return jsonify(metricas_cola_ghl())
+    except sqlite3.Error as e:
+        return jsonify({"error": f"No se pudo leer la cola GHL: {e}"}), 500
+
+@app.route('/ghl/cola/reintentar', methods=['POST'])
+def endpoint_reencolar_dead_letter_ghl():
+    """Devuelve a la cola los trabajos del dead letter (todos, o solo los de "ids")"""
+    data = request.get_json(silent=True) or {}
+    ids = [extraer_id(valor) for valor in data.get("ids") or []]
+    if None in ids:
+        return jsonify({"error": "ids debe contener solo IDs numéricos"}), 400
+    
+    try:
+        reencolados = reencolar_dead_letter_ghl(ids)
+    except sqlite3.Error as e:
+        return jsonify({"error": f"No se pudo leer la cola GHL: {e}"}), 500
+    return jsonify({"reencolados": reencolados})
+
 @app.route('/config', methods=['GET'])
 def get_config():
     """Endpoint para obtener configuración actual"""
@@ -1198,6 +2316,36 @@ def get_config():
     })
 
 
+# ============================
+# ARRANQUE DE TAREAS EN SEGUNDO PLANO
+# ============================
+# Nada arranca al importar: los benchmarks, la versión ASGI y el proceso padre
+# del reloader de Flask importan este módulo y no deben levantar workers ni
+# crear la cola SQLite. Cada punto de entrada llama a iniciar_segundo_plano()
+
+_segundo_plano_iniciado = False
+_segundo_plano_lock = threading.Lock()
+
+def iniciar_segundo_plano() -> None:
+    """Arranca workers GHL, refresco de sucursales y precarga del calendar (idempotente)"""
+    global _segundo_plano_iniciado
+    if not GHL_ACCESS_TOKEN:
+        return
+    with _segundo_plano_lock:
+        if _segundo_plano_iniciado:
+            return
+        _segundo_plano_iniciado = True
+    
+    iniciar_workers_ghl()
+    iniciar_cache_sucursales()
+    threading.Thread(target=precargar_calendar_ghl, name="ghl-calendar", daemon=True).start()
+
+@app.before_request
+def _asegurar_segundo_plano():
+    # Bajo un servidor WSGI (gunicorn, etc.) no se ejecuta __main__: arrancar con la primera petición
+    if not _segundo_plano_iniciado:
+        iniciar_segundo_plano()
+
 if __name__ == '__main__':
     logging.info("🚀 Iniciando servidor Dentalink API")
     
@@ -1205,4 +2353,9 @@ if __name__ == '__main__':
     if not DENTALINK_TOKEN:
         logging.warning("⚠️ DENTALINK_TOKEN no configurado")
     
+    # Con debug, el reloader ejecuta este bloque en el proceso padre y en el hijo;
+    # solo el hijo (WERKZEUG_RUN_MAIN) atiende peticiones y debe arrancar las tareas
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        iniciar_segundo_plano()
+
     app.run(debug=True, host='0.0.0.0', port=5001)
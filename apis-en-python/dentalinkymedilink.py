@@ -13,12 +13,24 @@ Funciones principales:
 import logging
 import json
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import pytz
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import os
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import threading
+import time
+import random
+from contextvars import ContextVar, copy_context
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from collections import deque
+from contextlib import closing
+import math
+import sqlite3
 import unicodedata
 
 # Configuración de logging
@@ -65,6 +77,415 @@ GHL_CALENDAR_ID = os.getenv('GHL_CALENDAR_ID', 'ooALBvSWsEirGZZsSNim')
 GHL_LOCATION_ID = os.getenv('GHL_LOCATION_ID', 'OOZTkZtP1Hkmhjq0oQHE')
 
 
+# ============================
+# CLIENTE HTTP (SESIONES POR HOST)
+# ============================
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+HTTP_GET_RETRIES = int(os.getenv('HTTP_GET_RETRIES', '2'))
+
+_sesiones_http: Dict[str, requests.Session] = {}
+_sesiones_http_lock = threading.Lock()
+
+def _crear_sesion_http() -> requests.Session:
+    """Crea una sesión keep-alive con pool de conexiones y reintentos solo para GET"""
+    reintentos = Retry(
+        total=HTTP_GET_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False
+    )
+    adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=reintentos)
+    sesion = requests.Session()
+    sesion.mount("https://", adaptador)
+    sesion.mount("http://", adaptador)
+    return sesion
+
+def obtener_sesion_http(url: str) -> requests.Session:
+    """Devuelve la sesión compartida del host de la URL, creándola la primera vez"""
+    host = urlsplit(url).netloc
+    sesion = _sesiones_http.get(host)
+    if sesion is None:
+        with _sesiones_http_lock:
+            sesion = _sesiones_http.get(host)
+            if sesion is None:
+                sesion = _crear_sesion_http()
+                _sesiones_http[host] = sesion
+    return sesion
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Ejecuta una petición por la sesión del host. El timeout de conexión/lectura se recorta
+    a lo que queda del presupuesto de la petición, y si la URL es de Medilink o Dentalink
+    el resultado alimenta el circuit breaker de ese backend.
+    
+    Raises:
+        UpstreamOmitido: si el circuito del backend está abierto o el presupuesto se agotó
+    """
+    timeout_conexion, timeout_lectura, recortado = timeout_con_presupuesto()
+    kwargs.setdefault("timeout", (timeout_conexion, timeout_lectura))
+    
+    breaker = breaker_de_url(url)
+    if breaker and not breaker.permitir():
+        sumar_registro("llamadas_omitidas")
+        raise UpstreamOmitido(f"Circuito abierto para {breaker.nombre}")
+    
+    inicio = time.monotonic()
+    exito = None  # None: la llamada no dice nada de la salud del backend
+    try:
+        response = obtener_sesion_http(url).request(method, url, **kwargs)
+        exito = response.status_code < 500
+        return response
+    except requests.exceptions.Timeout:
+        # Un timeout recortado por el presupuesto no es culpa del backend
+        exito = None if recortado else False
+        raise
+    except requests.exceptions.RequestException:
+        exito = False
+        raise
+    finally:
+        if breaker:
+            breaker.registrar(exito)
+        sumar_registro("llamadas_upstream")
+        sumar_registro("tiempo_upstream_ms", (time.monotonic() - inicio) * 1000)
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    return http_request("GET", url, **kwargs)
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    return http_request("POST", url, **kwargs)
+
+def http_put(url: str, **kwargs) -> requests.Response:
+    return http_request("PUT", url, **kwargs)
+
+# ============================
+# CIRCUIT BREAKER Y PRESUPUESTO POR PETICIÓN
+# ============================
+
+# Fallos (errores de conexión, timeouts o 5xx) consecutivos que abren el circuito de un backend
+BREAKER_FALLOS = int(os.getenv('BREAKER_FALLOS', '5'))
+# Segundos que el circuito queda abierto antes de dejar pasar una llamada de prueba
+BREAKER_ESPERA = float(os.getenv('BREAKER_ESPERA', '30'))
+
+# Segundos que tiene cada petición entrante para todas sus llamadas a las APIs; 0 = sin límite
+PRESUPUESTO_PETICION = float(os.getenv('PRESUPUESTO_PETICION', '45'))
+PRESUPUESTO_MINIMO = 0.1  # Con menos de esto no vale la pena lanzar otra llamada
+
+# Instante (time.monotonic) en que vence el presupuesto de la petición en curso
+_limite_peticion: ContextVar[Optional[float]] = ContextVar('limite_peticion', default=None)
+
+class UpstreamOmitido(requests.exceptions.RequestException):
+    """No se llamó al backend: su circuito está abierto o se agotó el presupuesto de la petición"""
+
+class CircuitBreaker:
+    """
+    Circuito de un backend. Cerrado deja pasar todo; tras BREAKER_FALLOS fallos seguidos se
+    abre y las llamadas se omiten sin esperar; pasados BREAKER_ESPERA segundos queda
+    semiabierto y deja pasar una sola llamada de prueba, que lo cierra o lo vuelve a abrir.
+    """
+    
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        self._estado = "cerrado"
+        self._fallos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self._aperturas = 0
+        self._lock = threading.Lock()
+    
+    def _estado_vigente(self) -> str:
+        """Estado actual, pasando de abierto a semiabierto si ya se cumplió la espera. Llamar con _lock tomado"""
+        if self._estado == "abierto" and time.monotonic() - self._abierto_desde >= BREAKER_ESPERA:
+            self._estado = "semiabierto"
+            self._prueba_en_curso = False
+        return self._estado
+    
+    def disponible(self) -> bool:
+        """True si una llamada pasaría ahora (sin reservar la llamada de prueba)"""
+        with self._lock:
+            estado = self._estado_vigente()
+            return estado == "cerrado" or (estado == "semiabierto" and not self._prueba_en_curso)
+    
+    def permitir(self) -> bool:
+        """True si la llamada puede hacerse; en semiabierto solo la primera (la de prueba)"""
+        with self._lock:
+            estado = self._estado_vigente()
+            if estado == "semiabierto" and not self._prueba_en_curso:
+                self._prueba_en_curso = True
+                return True
+            return estado == "cerrado"
+    
+    def registrar(self, exito: Optional[bool]) -> None:
+        """Anota el resultado de una llamada; None solo libera la llamada de prueba"""
+        with self._lock:
+            if exito is None:
+                self._prueba_en_curso = False
+                return
+            if exito:
+                if self._estado != "cerrado":
+                    logging.info(f"✅ Circuito de {self.nombre} cerrado")
+                self._estado = "cerrado"
+                self._fallos = 0
+                self._prueba_en_curso = False
+                return
+            
+            self._fallos += 1
+            if self._estado == "semiabierto" or (self._estado == "cerrado" and self._fallos >= BREAKER_FALLOS):
+                self._estado = "abierto"
+                self._abierto_desde = time.monotonic()
+                self._prueba_en_curso = False
+                self._aperturas += 1
+                logging.warning(f"🔌 Circuito de {self.nombre} abierto tras {self._fallos} fallos consecutivos")
+    
+    def estado_actual(self) -> Dict[str, Any]:
+        with self._lock:
+            estado = self._estado_vigente()
+            resumen = {"estado": estado, "fallos_consecutivos": self._fallos, "aperturas": self._aperturas}
+            if estado == "abierto":
+                resumen["prueba_en_s"] = round(BREAKER_ESPERA - (time.monotonic() - self._abierto_desde), 1)
+            return resumen
+
+_breakers: Dict[str, CircuitBreaker] = {nombre: CircuitBreaker(nombre) for nombre in ("Medilink v5", "Dentalink v1")}
+_bases_backend = [(MEDILINK_API_URL, "Medilink v5"), (DENTALINK_API_URL, "Dentalink v1")]
+
+def breaker_de_url(url: str) -> Optional[CircuitBreaker]:
+    """Circuito del backend de la URL (por URL base o, para los links, por host); None para GHL u otros"""
+    for base, nombre in _bases_backend:
+        if url.startswith(base):
+            return _breakers[nombre]
+    host = urlsplit(url).netloc
+    for base, nombre in _bases_backend:
+        if urlsplit(base).netloc == host:
+            return _breakers[nombre]
+    return None
+
+def apis_disponibles(apis: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Quita de una cadena de fallback los backends con el circuito abierto. Si todos están
+    abiertos la deja igual: sus llamadas fallan al instante con UpstreamOmitido.
+    """
+    disponibles = [api for api in apis if _breakers[api['name']].disponible()]
+    if not disponibles or len(disponibles) == len(apis):
+        return apis
+    sumar_registro("backends_omitidos", len(apis) - len(disponibles))
+    return disponibles
+
+def estado_circuitos() -> Dict[str, Dict[str, Any]]:
+    return {nombre: breaker.estado_actual() for nombre, breaker in _breakers.items()}
+
+def iniciar_presupuesto() -> Any:
+    """Fija el vencimiento del presupuesto de la petición en curso; retorna el token para liberarlo"""
+    return _limite_peticion.set(time.monotonic() + PRESUPUESTO_PETICION if PRESUPUESTO_PETICION > 0 else None)
+
+def finalizar_presupuesto(token: Any) -> None:
+    """Libera el presupuesto fijado por iniciar_presupuesto()"""
+    _limite_peticion.reset(token)
+
+def timeout_con_presupuesto() -> Tuple[float, float, bool]:
+    """
+    Timeouts para la próxima llamada: los configurados, recortados a lo que queda del
+    presupuesto de la petición (cada llamada usa solo lo que dejaron las anteriores).
+    
+    Returns:
+        tuple: (timeout de conexión, timeout de lectura, True si el presupuesto los recortó)
+    
+    Raises:
+        UpstreamOmitido: si ya no queda presupuesto
+    """
+    limite = _limite_peticion.get()
+    if limite is None:
+        return HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, False
+    restante = limite - time.monotonic()
+    if restante < PRESUPUESTO_MINIMO:
+        sumar_registro("llamadas_omitidas")
+        anotar_registro(presupuesto_agotado=True)
+        raise UpstreamOmitido("Presupuesto de tiempo de la petición agotado")
+    return min(HTTP_CONNECT_TIMEOUT, restante), min(HTTP_READ_TIMEOUT, restante), restante < HTTP_READ_TIMEOUT
+
+# ============================
+# REGISTRO POR PETICIÓN
+# ============================
+
+# Fracción (0-1) de peticiones que registran además el detalle por horario/profesional
+LOG_DETALLE_MUESTREO = float(os.getenv('LOG_DETALLE_MUESTREO', '0'))
+
+_registro_peticion: ContextVar[Optional[Dict[str, Any]]] = ContextVar('registro_peticion', default=None)
+_registro_lock = threading.Lock()
+
+def iniciar_registro(registro: Dict[str, Any]) -> Any:
+    """Activa el resumen de la petición en curso; retorna el token para finalizarlo"""
+    return _registro_peticion.set(registro)
+
+def finalizar_registro(token: Any) -> Dict[str, Any]:
+    """Desactiva el resumen activado con iniciar_registro() y lo retorna para emitirlo"""
+    registro = _registro_peticion.get()
+    _registro_peticion.reset(token)
+    return registro
+
+def detalle_pedido(header_detalle: str, body: Any) -> bool:
+    """El detalle se activa con el header X-Log-Detalle, con "debug": true en el body o por muestreo"""
+    if (header_detalle or '').lower() in ('1', 'true', 'si'):
+        return True
+    if isinstance(body, dict) and body.get('debug'):
+        return True
+    return LOG_DETALLE_MUESTREO > 0 and random.random() < LOG_DETALLE_MUESTREO
+
+def _detalle_solicitado() -> bool:
+    return detalle_pedido(request.headers.get('X-Log-Detalle', ''), request.get_json(silent=True))
+
+@app.before_request
+def _iniciar_registro_peticion():
+    registro = {
+        "ruta": request.path,
+        "metodo": request.method,
+        "detalle": _detalle_solicitado(),
+        "llamadas_upstream": 0,
+        "tiempo_upstream_ms": 0.0
+    }
+    g.registro_inicio = time.monotonic()
+    g.registro_token = iniciar_registro(registro)
+    g.presupuesto_token = iniciar_presupuesto()
+
+@app.after_request
+def _anotar_status_peticion(response):
+    anotar_registro(status=response.status_code)
+    return response
+
+@app.teardown_request
+def _emitir_registro_peticion(exc):
+    """Emite una única línea JSON con el resumen de la petición"""
+    token_presupuesto = g.pop('presupuesto_token', None)
+    if token_presupuesto is not None:
+        finalizar_presupuesto(token_presupuesto)
+    
+    token = g.pop('registro_token', None)
+    if token is None:
+        return
+    registro = finalizar_registro(token)
+    
+    registro.setdefault("status", 500)
+    if exc is not None:
+        registro["error"] = repr(exc)
+    registro["duracion_ms"] = round((time.monotonic() - g.pop('registro_inicio')) * 1000, 1)
+    registro["tiempo_upstream_ms"] = round(registro["tiempo_upstream_ms"], 1)
+    logging.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+def anotar_registro(**campos) -> None:
+    """Agrega campos al resumen de la petición en curso (no hace nada fuera de una petición)"""
+    registro = _registro_peticion.get()
+    if registro is not None:
+        with _registro_lock:
+            registro.update(campos)
+
+def sumar_registro(campo: str, cantidad: float = 1) -> None:
+    """Acumula un contador en el resumen de la petición en curso"""
+    registro = _registro_peticion.get()
+    if registro is not None:
+        with _registro_lock:
+            registro[campo] = registro.get(campo, 0) + cantidad
+
+def detalle_activo() -> bool:
+    """True si la petición en curso registra el detalle por ítem"""
+    registro = _registro_peticion.get()
+    return registro is not None and registro["detalle"]
+
+def log_detalle(mensaje: str) -> None:
+    if detalle_activo():
+        logging.info(mensaje)
+
+# ============================
+# ENRUTAMIENTO APRENDIDO
+# ============================
+
+# Archivo donde se persiste qué backend respondió realmente para cada sucursal y profesional.
+# Dentalink y Medilink numeran sus profesionales por separado, así que la ruta de un
+# profesional se guarda por sucursal: "id_sucursal:id_profesional".
+RUTAS_ARCHIVO = os.getenv('RUTAS_ARCHIVO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rutas_aprendidas.json'))
+
+_rutas_aprendidas: Dict[str, Dict[str, str]] = {"sucursales": {}, "profesionales": {}}
+_rutas_lock = threading.Lock()
+
+def _cargar_rutas_aprendidas() -> None:
+    """Carga la tabla de rutas desde RUTAS_ARCHIVO; si no existe o está corrupta se parte vacía"""
+    try:
+        with open(RUTAS_ARCHIVO, encoding='utf-8') as archivo:
+            datos = json.load(archivo)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️ No se pudo leer {RUTAS_ARCHIVO}: {e}")
+        return
+    
+    for tipo in ("sucursales", "profesionales"):
+        rutas = datos.get(tipo, {}) if isinstance(datos, dict) else {}
+        _rutas_aprendidas[tipo] = {
+            clave: backend for clave, backend in rutas.items()
+            if backend in ("dentalink", "medilink") and (tipo == "sucursales" or ":" in clave)
+        }
+    logging.info(f"🧭 Rutas aprendidas cargadas: {len(_rutas_aprendidas['sucursales'])} sucursales, "
+                 f"{len(_rutas_aprendidas['profesionales'])} profesionales")
+
+def _guardar_rutas_aprendidas() -> None:
+    """Escribe la tabla de forma atómica (archivo temporal + rename). Llamar con _rutas_lock tomado"""
+    temporal = f"{RUTAS_ARCHIVO}.tmp"
+    try:
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            json.dump(_rutas_aprendidas, archivo, indent=2, sort_keys=True)
+        os.replace(temporal, RUTAS_ARCHIVO)
+    except OSError as e:
+        logging.warning(f"⚠️ No se pudo guardar {RUTAS_ARCHIVO}: {e}")
+
+def _clave_ruta_profesional(id_sucursal: int, id_profesional: int) -> str:
+    return f"{id_sucursal}:{id_profesional}"
+
+def ruta_aprendida(id_sucursal: int = None, id_profesional: int = None) -> Optional[bool]:
+    """
+    Backend aprendido para el profesional en esa sucursal o, si no hay, para la sucursal.
+    
+    Returns:
+        True si es Dentalink, False si es Medilink, None si no hay ruta aprendida
+    """
+    with _rutas_lock:
+        backend = None
+        if id_profesional is not None and id_sucursal is not None:
+            backend = _rutas_aprendidas["profesionales"].get(_clave_ruta_profesional(id_sucursal, id_profesional))
+        if backend is None and id_sucursal is not None:
+            backend = _rutas_aprendidas["sucursales"].get(str(id_sucursal))
+    return None if backend is None else backend == "dentalink"
+
+def ruta_contradice_configuracion(id_sucursal: int) -> bool:
+    """True si la sucursal tiene una ruta aprendida distinta de la que indica SUCURSALES_DENTALINK"""
+    aprendida = ruta_aprendida(id_sucursal)
+    return aprendida is not None and aprendida != (id_sucursal in SUCURSALES_DENTALINK)
+
+def registrar_ruta(usa_dentalink: bool, id_sucursal: int = None, ids_profesionales: List[int] = ()) -> None:
+    """Registra el backend que respondió; solo escribe el archivo si la tabla cambió"""
+    backend = "dentalink" if usa_dentalink else "medilink"
+    claves = []
+    if id_sucursal is not None:
+        claves.append(("sucursales", str(id_sucursal)))
+        # Sin sucursal no se sabe a qué sistema pertenece el ID del profesional
+        claves.extend(("profesionales", _clave_ruta_profesional(id_sucursal, id_prof)) for id_prof in ids_profesionales)
+    
+    with _rutas_lock:
+        cambios = [(tipo, clave) for tipo, clave in claves if _rutas_aprendidas[tipo].get(clave) != backend]
+        if not cambios:
+            return
+        for tipo, clave in cambios:
+            _rutas_aprendidas[tipo][clave] = backend
+        _guardar_rutas_aprendidas()
+    logging.info(f"🧭 Rutas actualizadas a {backend}: {cambios}")
+
+def obtener_rutas_aprendidas() -> Dict[str, Dict[str, str]]:
+    """Copia de la tabla de rutas aprendidas"""
+    with _rutas_lock:
+        return {tipo: dict(rutas) for tipo, rutas in _rutas_aprendidas.items()}
+
+_cargar_rutas_aprendidas()
+
 # ============================
 # UTILIDADES
 # ============================
@@ -88,21 +509,38 @@ def extraer_id(valor: Any) -> Optional[int]:
             return None
     return None
 
-def determinar_api_por_sucursal(id_sucursal: int) -> Tuple[str, Dict, bool]:
+def determinar_api_por_sucursal(id_sucursal: int, id_profesional: int = None) -> Tuple[str, Dict, bool]:
     """
-    Determina qué API usar según el ID de sucursal.
+    Determina qué API usar según el ID de sucursal (y de profesional, si se conoce).
+    
+    Usa primero la ruta aprendida de respuestas reales y, si no hay, SUCURSALES_DENTALINK.
     
     Returns:
         tuple: (api_base_url, headers, is_dentalink)
     """
-    usa_dentalink = id_sucursal in SUCURSALES_DENTALINK
+    usa_dentalink = ruta_aprendida(id_sucursal, id_profesional)
+    if usa_dentalink is None:
+        usa_dentalink = id_sucursal in SUCURSALES_DENTALINK
     api_base = DENTALINK_API_URL if usa_dentalink else MEDILINK_API_URL
     headers_api = DENTALINK_HEADERS if usa_dentalink else MEDILINK_HEADERS
     return api_base, headers_api, usa_dentalink
 
-def obtener_nombre_api(id_sucursal: int) -> str:
+def obtener_nombre_api(id_sucursal: int, id_profesional: int = None) -> str:
     """Retorna el nombre legible de la API que se usa para una sucursal"""
-    return "Dentalink v1" if id_sucursal in SUCURSALES_DENTALINK else "Medilink v5"
+    return "Dentalink v1" if determinar_api_por_sucursal(id_sucursal, id_profesional)[2] else "Medilink v5"
+
+def apis_en_orden(id_sucursal: int, id_profesional: int = None) -> List[Dict[str, Any]]:
+    """API que corresponde a la sucursal seguida de la alternativa como fallback (sin las de circuito abierto)"""
+    _, _, usa_dentalink = determinar_api_por_sucursal(id_sucursal, id_profesional)
+    return apis_disponibles([
+        {
+            "name": "Dentalink v1" if es_dentalink else "Medilink v5",
+            "base": DENTALINK_API_URL if es_dentalink else MEDILINK_API_URL,
+            "headers": DENTALINK_HEADERS if es_dentalink else MEDILINK_HEADERS,
+            "is_dentalink": es_dentalink
+        }
+        for es_dentalink in (usa_dentalink, not usa_dentalink)
+    ])
 
 def formatear_rut(rut: str) -> str:
     """Formatea un RUT chileno removiendo puntos y manteniendo guión"""
@@ -137,12 +575,44 @@ def filtrar_horarios_futuros(horarios: List[Dict], fecha: str, hora_actual: date
     
     return horarios_futuros
 
+def _hora_a_segundos(hora_str) -> Optional[int]:
+    """Convierte "HH:MM:SS" a segundos desde medianoche. Retorna None si no tiene ese formato."""
+    if not isinstance(hora_str, str):
+        return None
+    
+    # Camino rápido para el formato que entrega la API (dos dígitos por componente)
+    partes = hora_str.split(':')
+    if len(partes) == 3 and all(len(parte) == 2 and parte.isascii() and parte.isdigit() for parte in partes):
+        horas, minutos, segundos = int(partes[0]), int(partes[1]), int(partes[2])
+        if horas < 24 and minutos < 60 and segundos < 60:
+            return horas * 3600 + minutos * 60 + segundos
+        return None
+    
+    # Formatos menos comunes ("9:05:00", etc.): delegar en strptime
+    try:
+        dt = datetime.strptime(hora_str, "%H:%M:%S")
+    except ValueError:
+        return None
+    return dt.hour * 3600 + dt.minute * 60 + dt.second
+
+def _intervalo_minutos(intervalo) -> Optional[int]:
+    """Intervalo del slot en minutos enteros positivos, o None si no sirve para encadenar"""
+    if isinstance(intervalo, float) and intervalo.is_integer():
+        intervalo = int(intervalo)
+    if isinstance(intervalo, int) and intervalo > 0:
+        return intervalo
+    return None
+
 def filtrar_horarios_por_duracion(horarios: List[Dict], tiempo_cita: int) -> List[str]:
     """
     Filtra horarios disponibles según el tiempo requerido de la cita.
     Solo retorna horarios donde hay suficientes slots consecutivos.
     Usa el intervalo real del API sin defaults.
     
+    Recorre los slots ordenados una sola vez de atrás hacia adelante, acumulando
+    en minutos enteros el tiempo disponible de cada racha de slots consecutivos
+    (slot k+1 empieza justo cuando termina el slot k según su propio intervalo).
+    
     Args:
         horarios: Lista de horarios disponibles del API
         tiempo_cita: Duración requerida en minutos
@@ -154,428 +624,1004 @@ def filtrar_horarios_por_duracion(horarios: List[Dict], tiempo_cita: int) -> Lis
         # Si no hay tiempo_cita especificado, retornar todos los horarios
         return [datetime.strptime(h.get("hora_inicio", ""), "%H:%M:%S").strftime("%H:%M") for h in horarios]
     
+    if not isinstance(tiempo_cita, (int, float)):
+        logging.warning(f"⚠️ tiempo_cita no numérico: {tiempo_cita!r} - No hay horarios válidos")
+        return []
+    
     # Ordenar horarios por hora de inicio
     horarios_ordenados = sorted(horarios, key=lambda x: x.get("hora_inicio", ""))
     
+    inicios = [_hora_a_segundos(h.get("hora_inicio", "")) for h in horarios_ordenados]
+    intervalos = [_intervalo_minutos(h.get("intervalo")) for h in horarios_ordenados]
+    
+    sin_intervalo = sum(1 for intervalo in intervalos if intervalo is None)
+    hora_invalida = sum(1 for inicio, intervalo in zip(inicios, intervalos) if inicio is None and intervalo is not None)
+    if sin_intervalo or hora_invalida:
+        logging.warning(f"⚠️ Slots omitidos por duración: {sin_intervalo} sin intervalo, {hora_invalida} con hora inválida")
+    
+    # disponible[k]: minutos consecutivos desde el slot k hasta el final de su racha
+    n = len(horarios_ordenados)
+    disponible = [0] * n
+    for k in range(n - 1, -1, -1):
+        inicio, intervalo = inicios[k], intervalos[k]
+        if inicio is None or intervalo is None:
+            continue
+        disponible[k] = intervalo
+        if k + 1 < n and intervalos[k + 1] is not None and inicios[k + 1] == inicio + intervalo * 60:
+            disponible[k] += disponible[k + 1]
+    
     horarios_validos = []
+    for k in range(n):
+        if disponible[k] < tiempo_cita or inicios[k] is None or intervalos[k] is None:
+            continue
+        # Un slot que por sí solo cubre la cita igual exige que el siguiente tenga hora legible
+        if intervalos[k] >= tiempo_cita and k + 1 < n and inicios[k + 1] is None:
+            continue
+        horarios_validos.append(f"{inicios[k] // 3600:02d}:{inicios[k] % 3600 // 60:02d}")
+    
+    log_detalle(f"📊 Horarios por duración: {len(horarios_validos)} de {n} sirven para {tiempo_cita}min")
+    
+    return horarios_validos
+
+# ============================
+# URL DE HORARIOS DISPONIBLES
+# ============================
+
+# Variante de URL de horariosdisponibles (con o sin "/" final) que respondió, por URL base
+_variante_horarios: Dict[str, str] = {}
+_variante_horarios_lock = threading.Lock()
+
+def variante_horarios_recordada(api_base: str) -> Optional[str]:
+    """URL de horariosdisponibles que respondió la última vez para esta API, o None"""
+    with _variante_horarios_lock:
+        return _variante_horarios.get(api_base)
+
+def recordar_variante_horarios(api_base: str, url_horarios: str) -> None:
+    with _variante_horarios_lock:
+        _variante_horarios[api_base] = url_horarios
+
+def olvidar_variante_horarios(api_base: str) -> None:
+    with _variante_horarios_lock:
+        _variante_horarios.pop(api_base, None)
+
+def consultar_horarios_disponibles(api_base: str, headers_api: Dict, **kwargs) -> Tuple[Optional[requests.Response], Optional[str]]:
+    """
+    Hace GET a horariosdisponibles usando la variante de URL que ya funcionó para esta API.
+    
+    Solo si la variante recordada falla (404 o error de conexión) se vuelven a probar
+    ambas variantes; en régimen normal es exactamente una llamada por consulta.
+    
+    Returns:
+        tuple: (response o None, url que respondió o None)
+    """
+    recordada = variante_horarios_recordada(api_base)
+    
+    variantes = [f"{api_base}horariosdisponibles/", f"{api_base}horariosdisponibles"]
+    urls_to_try = ([recordada] + [url for url in variantes if url != recordada]) if recordada else variantes
+    response = None
+    
+    for url_horarios in urls_to_try:
+        try:
+            log_detalle(f"🌐 Intentando URL: {url_horarios}")
+            response = http_get(url_horarios, headers=headers_api, **kwargs)
+            log_detalle(f"📊 Status Code: {response.status_code}")
+            
+            if response.status_code != 404:
+                if url_horarios != recordada:
+                    recordar_variante_horarios(api_base, url_horarios)
+                return response, url_horarios
+        except requests.exceptions.RequestException as e:
+            logging.error(f"❌ Error al conectar con {url_horarios}: {e}")
+        
+        if url_horarios == recordada:
+            # La variante recordada dejó de responder: volver a probar ambas
+            olvidar_variante_horarios(api_base)
+    
+    return response, None
+
+# ============================
+# CACHÉ DE PROFESIONALES
+# ============================
+
+# Segundos que se reutiliza un profesional encontrado / uno que la API no tiene
+PROFESIONALES_CACHE_TTL = int(os.getenv('PROFESIONALES_CACHE_TTL', '600'))
+PROFESIONALES_CACHE_TTL_NEGATIVO = int(os.getenv('PROFESIONALES_CACHE_TTL_NEGATIVO', '120'))
+PROFESIONALES_CACHE_MAX = int(os.getenv('PROFESIONALES_CACHE_MAX', '5000'))
+
+# Pool acotado para las consultas profesionales/{id} de Medilink
+PROFESIONALES_POOL_SIZE = int(os.getenv('PROFESIONALES_POOL_SIZE', '8'))
+_pool_profesionales = ThreadPoolExecutor(max_workers=PROFESIONALES_POOL_SIZE, thread_name_prefix="profesionales")
+
+# Clave: (es_dentalink, id_profesional) -> (expira_en, {"nombre", "intervalo"} o None si la API no lo tiene)
+_cache_profesionales: Dict[Tuple[bool, int], Tuple[float, Optional[Dict[str, Any]]]] = {}
+_cache_profesionales_lock = threading.Lock()
+_dentistas_carga_lock = threading.Lock()  # Una sola descarga de /dentistas a la vez
+
+def datos_profesional(profesional: Dict) -> Dict[str, Any]:
+    apellidos = profesional.get('apellidos', '') or profesional.get('apellido', '')
+    return {
+        "nombre": f"{profesional.get('nombre', 'Desconocido')} {apellidos}".strip(),
+        "intervalo": profesional.get("intervalo")  # Sin default, debe venir del profesional
+    }
+
+def guardar_profesionales(es_dentalink: bool, profesionales: Dict[int, Optional[Dict[str, Any]]]) -> None:
+    ahora = time.monotonic()
+    with _cache_profesionales_lock:
+        for id_prof, datos in profesionales.items():
+            ttl = PROFESIONALES_CACHE_TTL if datos else PROFESIONALES_CACHE_TTL_NEGATIVO
+            _cache_profesionales[(es_dentalink, id_prof)] = (ahora + ttl, datos)
+        if len(_cache_profesionales) > PROFESIONALES_CACHE_MAX:
+            for clave in [clave for clave, (expira, _) in _cache_profesionales.items() if expira <= ahora]:
+                del _cache_profesionales[clave]
+
+def profesionales_en_cache(es_dentalink: bool, ids_profesionales: List[int]) -> Tuple[Dict[int, Optional[Dict]], List[int]]:
+    """Separa los IDs en (encontrados en caché, faltantes)"""
+    ahora = time.monotonic()
+    encontrados, faltantes = {}, []
+    with _cache_profesionales_lock:
+        for id_prof in ids_profesionales:
+            entrada = _cache_profesionales.get((es_dentalink, id_prof))
+            if entrada and entrada[0] > ahora:
+                encontrados[id_prof] = entrada[1]
+            else:
+                faltantes.append(id_prof)
+    return encontrados, faltantes
+
+def _descargar_dentistas() -> Optional[Dict[int, Dict[str, Any]]]:
+    """Descarga /dentistas de Dentalink indexado por ID. Retorna None si la API falla."""
+    try:
+        prof_resp = http_get(f"{DENTALINK_API_URL}dentistas", headers=DENTALINK_HEADERS)
+        if prof_resp.status_code != 200:
+            logging.warning(f"⚠️ No se pudieron obtener dentistas de Dentalink: {prof_resp.status_code}")
+            return None
+        return {dentista.get("id"): datos_profesional(dentista) for dentista in prof_resp.json().get("data", [])}
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo dentistas de Dentalink: {e}")
+        return None
+
+def _descargar_profesional_medilink(id_profesional: int) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """
+    Consulta profesionales/{id} en Medilink.
+    
+    Returns:
+        tuple: (respuesta definitiva, datos o None). Un 404 es definitivo (se cachea como
+        negativo); un error de red o 5xx no lo es y no se cachea.
+    """
+    try:
+        prof_resp = http_get(f"{MEDILINK_API_URL}profesionales/{id_profesional}", headers=MEDILINK_HEADERS)
+        if prof_resp.status_code == 200:
+            return True, datos_profesional(prof_resp.json().get("data", {}))
+        if prof_resp.status_code == 404:
+            return True, None
+        logging.warning(f"⚠️ No se pudo obtener profesional {id_profesional} de Medilink: {prof_resp.status_code}")
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo profesional {id_profesional} de Medilink: {e}")
+    return False, None
+
+def resolver_profesionales(ids_profesionales: List[int], es_dentalink: bool) -> Dict[int, Optional[Dict[str, Any]]]:
+    """
+    Resuelve profesionales en una sola API usando la caché.
+    
+    Dentalink se resuelve con una descarga de /dentistas; en Medilink los IDs faltantes
+    se consultan en paralelo.
+    
+    Returns:
+        Dict {id: {"nombre", "intervalo"} o None si esa API no lo tiene}; los IDs cuya
+        consulta falló no aparecen
+    """
+    resultado, faltantes = profesionales_en_cache(es_dentalink, list(dict.fromkeys(ids_profesionales)))
+    if not faltantes:
+        return resultado
+    
+    if es_dentalink:
+        with _dentistas_carga_lock:
+            # Otra petición pudo haber descargado /dentistas mientras se esperaba el lock
+            encontrados, faltantes = profesionales_en_cache(True, faltantes)
+            resultado.update(encontrados)
+            if faltantes:
+                sumar_registro("profesionales_descargados", len(faltantes))
+                directorio = _descargar_dentistas()
+                if directorio is not None:
+                    directorio.update({id_prof: None for id_prof in faltantes if id_prof not in directorio})
+                    guardar_profesionales(True, directorio)
+                    resultado.update({id_prof: directorio[id_prof] for id_prof in faltantes})
+        return resultado
+    
+    sumar_registro("profesionales_descargados", len(faltantes))
+    futuros = {
+        id_prof: _pool_profesionales.submit(copy_context().run, _descargar_profesional_medilink, id_prof)
+        for id_prof in faltantes
+    }
+    descargados = {}
+    for id_prof, futuro in futuros.items():
+        definitivo, datos = futuro.result()
+        if definitivo:
+            descargados[id_prof] = datos
+    guardar_profesionales(False, descargados)
+    resultado.update(descargados)
+    return resultado
+
+def obtener_profesionales(ids_profesionales: List[int], usa_dentalink: bool) -> Dict[int, Dict[str, Any]]:
+    """
+    Retorna {id: {"nombre", "intervalo"}} buscando primero en la API indicada y los
+    faltantes en la alternativa. Los profesionales que no están en ninguna se omiten.
+    """
+    profesionales = {
+        id_prof: datos for id_prof, datos in resolver_profesionales(ids_profesionales, usa_dentalink).items() if datos
+    }
+    faltantes = [id_prof for id_prof in ids_profesionales if id_prof not in profesionales]
+    if faltantes:
+        log_detalle(f"🔄 Buscando {len(faltantes)} profesionales en API alternativa...")
+        profesionales.update({
+            id_prof: datos for id_prof, datos in resolver_profesionales(faltantes, not usa_dentalink).items() if datos
+        })
+    return profesionales
+
+def invalidar_cache_profesionales() -> None:
+    """Descarta todos los profesionales en memoria"""
+    with _cache_profesionales_lock:
+        _cache_profesionales.clear()
+    logging.info("🗑️ Caché de profesionales invalidada")
+
+# ============================
+# CACHÉ DE SUCURSALES
+# ============================
+
+# Cada cuántos segundos se vuelve a descargar el listado completo de sucursales
+SUCURSALES_REFRESCO = int(os.getenv('SUCURSALES_REFRESCO', '3600'))
+
+_nombres_sucursales: Dict[int, str] = {}
+_nombres_sucursales_lock = threading.Lock()
+_sucursales_consultadas: set = set()  # IDs ausentes del listado que ya se descargaron por separado
+_refresco_sucursales_iniciado = False
+
+def _descargar_sucursales(api_base: str, headers_api: Dict[str, str], nombre_api: str) -> Optional[Dict[int, str]]:
+    """Descarga el listado de sucursales de una API como {id: nombre}. Retorna None si la API falla."""
+    try:
+        suc_resp = http_get(f"{api_base}sucursales", headers=headers_api)
+        if suc_resp.status_code != 200:
+            logging.warning(f"⚠️ No se pudieron obtener las sucursales de {nombre_api}: {suc_resp.status_code}")
+            return None
+        return {
+            sucursal["id"]: sucursal["nombre"]
+            for sucursal in suc_resp.json().get("data", [])
+            if sucursal.get("id") is not None and sucursal.get("nombre")
+        }
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo sucursales de {nombre_api}: {e}")
+        return None
+
+def refrescar_sucursales() -> int:
+    """
+    Descarga el listado de sucursales de Dentalink y Medilink y lo agrega al mapa en
+    memoria. Si un ID existe en ambas, manda el nombre de Medilink (el que se consultaba
+    al sincronizar con GHL). Retorna cuántas sucursales hay en memoria.
+    """
+    nombres = {}
+    for api_base, headers_api, nombre_api in ((DENTALINK_API_URL, DENTALINK_HEADERS, "Dentalink v1"),
+                                              (MEDILINK_API_URL, MEDILINK_HEADERS, "Medilink v5")):
+        nombres.update(_descargar_sucursales(api_base, headers_api, nombre_api) or {})
+    if not nombres:
+        return len(_nombres_sucursales)
+    with _nombres_sucursales_lock:
+        # Se agrega sobre el mapa anterior: si una API falló, sus sucursales siguen disponibles
+        _nombres_sucursales.update(nombres)
+        _sucursales_consultadas.clear()
+        total = len(_nombres_sucursales)
+    logging.info(f"🔄 Mapa de sucursales actualizado: {total} sucursales")
+    return total
+
+def _refrescar_sucursales_periodicamente() -> None:
+    while True:
+        refrescar_sucursales()
+        time.sleep(SUCURSALES_REFRESCO)
+
+def iniciar_cache_sucursales() -> None:
+    """Precarga el mapa de sucursales y lo refresca cada SUCURSALES_REFRESCO segundos (una vez por proceso)"""
+    global _refresco_sucursales_iniciado
+    with _nombres_sucursales_lock:
+        if _refresco_sucursales_iniciado:
+            return
+        _refresco_sucursales_iniciado = True
+    threading.Thread(target=_refrescar_sucursales_periodicamente, name="sucursales", daemon=True).start()
+
+def _consultar_sucursal(id_sucursal: int) -> None:
+    """Descarga una sucursal que no vino en el listado y la agrega al mapa"""
+    try:
+        suc_resp = http_get(f"{MEDILINK_API_URL}sucursales/{id_sucursal}", headers=MEDILINK_HEADERS)
+        if suc_resp.status_code != 200:
+            logging.warning(f"⚠️ No se pudo obtener la sucursal {id_sucursal}: {suc_resp.status_code}")
+            return
+        nombre = suc_resp.json().get("data", {}).get("nombre")
+        if nombre:
+            with _nombres_sucursales_lock:
+                _nombres_sucursales[id_sucursal] = nombre
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo la sucursal {id_sucursal}: {e}")
+
+def obtener_nombre_sucursal(id_sucursal: int) -> Optional[str]:
+    """
+    Nombre de la sucursal desde el mapa precargado, sin consultar la API.
+    
+    Si el ID no está, su descarga se lanza en segundo plano (una sola vez por ID hasta el
+    próximo refresco del listado) y se retorna None; quien llama usa un nombre genérico.
+    """
+    with _nombres_sucursales_lock:
+        nombre = _nombres_sucursales.get(id_sucursal)
+        if nombre or id_sucursal in _sucursales_consultadas:
+            return nombre
+        _sucursales_consultadas.add(id_sucursal)
+    threading.Thread(target=_consultar_sucursal, args=(id_sucursal,), daemon=True).start()
+    return None
+
+# ============================
+# CACHÉ DE PACIENTES POR RUT
+# ============================
+
+# Segundos que se reutiliza un paciente encontrado / un RUT que la API no tiene
+PACIENTES_CACHE_TTL = int(os.getenv('PACIENTES_CACHE_TTL', '300'))
+PACIENTES_CACHE_TTL_NEGATIVO = int(os.getenv('PACIENTES_CACHE_TTL_NEGATIVO', '30'))
+PACIENTES_CACHE_MAX = int(os.getenv('PACIENTES_CACHE_MAX', '10000'))
+
+# Clave: (RUT formateado, es_dentalink) -> (expira_en, paciente o None si la API no lo tiene)
+_cache_pacientes: Dict[Tuple[str, bool], Tuple[float, Optional[Dict[str, Any]]]] = {}
+_cache_pacientes_lock = threading.Lock()
+
+def datos_paciente(paciente: Dict) -> Dict[str, Any]:
+    return {
+        "id": paciente.get("id"),
+        "nombre": paciente.get("nombre", ""),
+        "apellidos": paciente.get("apellidos", ""),
+        "rut": paciente.get("rut", ""),
+        "celular": paciente.get("celular", ""),
+        "email": paciente.get("email", ""),
+        "links": paciente.get("links", [])
+    }
+
+def guardar_paciente(rut: str, es_dentalink: bool, paciente: Optional[Dict]) -> None:
+    """Guarda el paciente de una API (o None si no existe en ella) bajo su RUT formateado"""
+    ahora = time.monotonic()
+    ttl = PACIENTES_CACHE_TTL if paciente else PACIENTES_CACHE_TTL_NEGATIVO
+    with _cache_pacientes_lock:
+        _cache_pacientes[(formatear_rut(rut), es_dentalink)] = (ahora + ttl, datos_paciente(paciente) if paciente else None)
+        if len(_cache_pacientes) > PACIENTES_CACHE_MAX:
+            for clave in [clave for clave, (expira, _) in _cache_pacientes.items() if expira <= ahora]:
+                del _cache_pacientes[clave]
+
+def paciente_en_cache(rut: str, es_dentalink: bool) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Retorna (hay entrada vigente, paciente o None si la API no lo tiene)"""
+    with _cache_pacientes_lock:
+        entrada = _cache_pacientes.get((formatear_rut(rut), es_dentalink))
+    if entrada and entrada[0] > time.monotonic():
+        sumar_registro("pacientes_cache")
+        return True, entrada[1]
+    return False, None
+
+def buscar_paciente(rut: str, api: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Busca un paciente por RUT en una API (pacientes?q=) usando la caché.
+    
+    Returns:
+        Dict {"id", "nombre", "apellidos", "rut", "celular", "email", "links"} o None si la
+        API no lo tiene. Los errores de red o status distinto de 200 también retornan None,
+        pero no se cachean.
+    """
+    rut_formateado = formatear_rut(rut)
+    en_cache, paciente = paciente_en_cache(rut_formateado, api['is_dentalink'])
+    if en_cache:
+        return paciente
+    
+    sumar_registro("pacientes_consultados")
+    try:
+        filtro = json.dumps({"rut": {"eq": rut_formateado}})
+        response = http_get(f"{api['base']}pacientes", headers=api['headers'], params={"q": filtro})
+        log_detalle(f"📊 Status búsqueda paciente en {api['name']}: {response.status_code}")
+        if response.status_code != 200:
+            return None
+        pacientes = response.json().get("data", [])
+    except Exception as e:
+        logging.warning(f"⚠️ Error al buscar paciente en {api['name']}: {e}")
+        return None
+    
+    paciente = datos_paciente(pacientes[0]) if pacientes else None
+    guardar_paciente(rut_formateado, api['is_dentalink'], paciente)
+    return paciente
+
+def invalidar_cache_pacientes(rut: str = None) -> None:
+    """Descarta las entradas de un RUT en ambas APIs, o todas si no se indica"""
+    with _cache_pacientes_lock:
+        if rut is None:
+            _cache_pacientes.clear()
+        else:
+            rut_formateado = formatear_rut(rut)
+            for es_dentalink in (False, True):
+                _cache_pacientes.pop((rut_formateado, es_dentalink), None)
+
+# ============================
+# LATENCIA Y HEDGING DE HORARIOS
+# ============================
+
+# Si está activo, cuando la API principal tarda más que su percentil de latencia se
+# lanza también la consulta a la alternativa y gana la primera respuesta con horarios
+HEDGING_HORARIOS = os.getenv('HEDGING_HORARIOS', 'false').lower() in ('1', 'true', 'si', 'yes')
+HEDGING_PERCENTIL = float(os.getenv('HEDGING_PERCENTIL', '95'))
+HEDGING_UMBRAL_MINIMO_MS = float(os.getenv('HEDGING_UMBRAL_MINIMO_MS', '250'))
+HEDGING_UMBRAL_INICIAL_MS = float(os.getenv('HEDGING_UMBRAL_INICIAL_MS', '2000'))  # Mientras no hay muestras suficientes
+HEDGING_MUESTRAS = int(os.getenv('HEDGING_MUESTRAS', '200'))
+HEDGING_MUESTRAS_MINIMAS = 20
+
+HEDGING_POOL_SIZE = int(os.getenv('HEDGING_POOL_SIZE', '16'))
+_pool_hedging = ThreadPoolExecutor(max_workers=HEDGING_POOL_SIZE, thread_name_prefix="hedging")
+
+# Últimas latencias (segundos) de horariosdisponibles por nombre de API
+_latencias_horarios: Dict[str, deque] = {}
+_latencias_lock = threading.Lock()
+
+def registrar_latencia(api_name: str, segundos: float) -> None:
+    with _latencias_lock:
+        muestras = _latencias_horarios.get(api_name)
+        if muestras is None:
+            muestras = _latencias_horarios[api_name] = deque(maxlen=HEDGING_MUESTRAS)
+        muestras.append(segundos)
+
+def umbral_hedging(api_name: str) -> float:
+    """Segundos a esperar a la API principal antes de lanzar la alternativa"""
+    with _latencias_lock:
+        muestras = sorted(_latencias_horarios.get(api_name, ()))
+    if len(muestras) < HEDGING_MUESTRAS_MINIMAS:
+        return HEDGING_UMBRAL_INICIAL_MS / 1000
+    indice = min(len(muestras) - 1, max(0, math.ceil(HEDGING_PERCENTIL / 100 * len(muestras)) - 1))
+    return max(muestras[indice], HEDGING_UMBRAL_MINIMO_MS / 1000)
+
+def estadisticas_latencia() -> Dict[str, Dict[str, Any]]:
+    """Resumen por API: muestras, p50, p95 y umbral de hedging actual (ms)"""
+    with _latencias_lock:
+        copias = {api_name: sorted(muestras) for api_name, muestras in _latencias_horarios.items()}
+    resumen = {}
+    for api_name, muestras in copias.items():
+        if not muestras:
+            continue
+        resumen[api_name] = {
+            "muestras": len(muestras),
+            "p50_ms": round(muestras[len(muestras) // 2] * 1000, 1),
+            "p95_ms": round(muestras[min(len(muestras) - 1, math.ceil(0.95 * len(muestras)) - 1)] * 1000, 1),
+            "umbral_hedging_ms": round(umbral_hedging(api_name) * 1000, 1)
+        }
+    return resumen
+
+# ============================
+# FUNCIÓN 1: BUSCAR DISPONIBILIDAD
+# ============================
+
+# Semanas consultadas por search_availability (ventanas de 7 días)
+SEMANAS_BUSQUEDA = 4
+
+# Cantidad de horarios que retorna /next_available_slots por defecto y como máximo
+PROXIMOS_HORARIOS_DEFAULT = int(os.getenv('PROXIMOS_HORARIOS_DEFAULT', '3'))
+PROXIMOS_HORARIOS_MAX = 50
+
+# Pool compartido y acotado para buscar varias sucursales en una misma petición
+SUCURSALES_POOL_SIZE = int(os.getenv('SUCURSALES_POOL_SIZE', '8'))
+_pool_sucursales = ThreadPoolExecutor(max_workers=SUCURSALES_POOL_SIZE, thread_name_prefix="sucursales")
+
+def _obtener_nombres_profesionales(ids_profesionales: List[int], usa_dentalink: bool) -> Dict[int, str]:
+    """
+    Obtiene el nombre de cada profesional, primero en la API de la sucursal y luego en la alternativa.
+    
+    Returns:
+        Dict {id_profesional: nombre}; los no encontrados quedan como "Profesional {id}"
+    """
+    return nombres_con_fallback(ids_profesionales, obtener_profesionales(ids_profesionales, usa_dentalink))
+
+def nombres_con_fallback(ids_profesionales: List[int], profesionales: Dict[int, Dict[str, Any]]) -> Dict[int, str]:
+    """Nombre de cada profesional resuelto; los faltantes quedan como "Profesional {id}" """
+    profesionales_info = {}
+    for id_prof in ids_profesionales:
+        if id_prof in profesionales:
+            profesionales_info[id_prof] = profesionales[id_prof]["nombre"]
+        else:
+            # Fallback: usar ID como nombre
+            profesionales_info[id_prof] = f"Profesional {id_prof}"
+            logging.warning(f"⚠️ No se encontró nombre para profesional {id_prof}, usando fallback")
+    
+    return profesionales_info
+
+def parametros_horarios(usa_dentalink: bool, ids_profesionales: List[int], id_sucursal: int,
+                        fecha_inicio_dt: datetime, fecha_fin_dt: datetime) -> Dict[str, Any]:
+    """Arma los kwargs de horariosdisponibles: body JSON para Dentalink, params de URL para Medilink"""
+    if usa_dentalink:
+        # Para Dentalink: usar body JSON con ids_dentista
+        return {"json": {
+            "ids_dentista": ids_profesionales,
+            "id_sucursal": id_sucursal,
+            "fecha_inicio": fecha_inicio_dt.strftime("%Y-%m-%d"),
+            "fecha_fin": fecha_fin_dt.strftime("%Y-%m-%d")
+        }}
+    
+    # Para Medilink: usar parámetros URL con ids_profesional[]
+    params = [("ids_profesional[]", id_prof) for id_prof in ids_profesionales]
+    params.extend([
+        ("id_sucursal", id_sucursal),
+        ("fecha_inicio", fecha_inicio_dt.strftime("%Y-%m-%d")),
+        ("fecha_fin", fecha_fin_dt.strftime("%Y-%m-%d"))
+    ])
+    return {"params": params}
+
+def _consultar_api_horarios(api_config: Dict[str, Any], ids_profesionales: List[int], id_sucursal: int,
+                            fecha_inicio_dt: datetime, fecha_fin_dt: datetime) -> Tuple[Optional[requests.Response], Optional[str]]:
+    """Consulta horariosdisponibles en una API y registra su latencia si respondió"""
+    log_detalle(f"🔄 Consultando horarios en {api_config['name']}")
+    parametros = parametros_horarios(api_config['is_dentalink'], ids_profesionales, id_sucursal,
+                                     fecha_inicio_dt, fecha_fin_dt)
+    log_detalle(f"📋 Parámetros para {api_config['name']}: {parametros}")
+    
+    inicio = time.monotonic()
+    respuesta_api, url_api = consultar_horarios_disponibles(api_config['base'], api_config['headers'], **parametros)
+    if respuesta_api is not None:
+        registrar_latencia(api_config['name'], time.monotonic() - inicio)
+    return respuesta_api, url_api
+
+def tiene_horarios(response: Optional[requests.Response]) -> bool:
+    """True si la respuesta es un 200 con datos de horarios"""
+    if response is None or response.status_code != 200:
+        return False
+    try:
+        return bool(response.json().get("data"))
+    except ValueError:
+        return False
+
+def _intentos_secuenciales(apis_a_probar: List[Dict[str, Any]], *argumentos) -> Iterator[Tuple[Dict, Optional[requests.Response], Optional[str], bool]]:
+    """Consulta las APIs en orden; la siguiente solo se consulta si el consumidor sigue iterando"""
+    for api_config in apis_a_probar:
+        yield (api_config, *_consultar_api_horarios(api_config, *argumentos), False)
+
+def intentos_con_hedging(apis_a_probar: List[Dict[str, Any]], *argumentos) -> Iterator[Tuple[Dict, Optional[requests.Response], Optional[str], bool]]:
+    """
+    Consulta la API principal y, si no responde dentro de su umbral de latencia, también la
+    alternativa. Entrega primero la primera respuesta con horarios; si ninguna los trae,
+    entrega ambas en el orden principal -> alternativa, igual que el modo secuencial.
+    """
+    principal, alternativa = apis_a_probar
+    futuro_principal = _pool_hedging.submit(copy_context().run, _consultar_api_horarios, principal, *argumentos)
+    umbral = umbral_hedging(principal['name'])
+    
+    try:
+        respuesta_api, url_api = futuro_principal.result(timeout=umbral)
+    except FuturesTimeoutError:
+        pass
+    else:
+        # La principal respondió a tiempo: mismo flujo que el modo secuencial
+        yield principal, respuesta_api, url_api, False
+        yield (alternativa, *_consultar_api_horarios(alternativa, *argumentos), False)
+        return
+    
+    sumar_registro("hedges")
+    log_detalle(f"⏱️ {principal['name']} no respondió en {umbral * 1000:.0f}ms, consultando también {alternativa['name']}")
+    futuro_alternativa = _pool_hedging.submit(copy_context().run, _consultar_api_horarios, alternativa, *argumentos)
+    
+    configuraciones = {futuro_principal: principal, futuro_alternativa: alternativa}
+    resultados = {}
+    for futuro in as_completed(configuraciones):
+        api_config = configuraciones[futuro]
+        resultados[api_config['name']] = (api_config, *futuro.result())
+        if tiene_horarios(resultados[api_config['name']][1]):
+            if api_config is alternativa:
+                sumar_registro("hedges_ganados")
+            yield (*resultados[api_config['name']], api_config is alternativa)
+            return
+    
+    for api_config in apis_a_probar:
+        yield (*resultados[api_config['name']], False)
+
+def consultar_horarios_ventana(ids_profesionales: List[int], id_sucursal: int, fecha_inicio_dt: datetime,
+                               fecha_fin_dt: datetime) -> Tuple[Optional[Dict], Optional[str], Optional[str]]:
+    """
+    Consulta horariosdisponibles para una ventana, primero en la API de la sucursal y,
+    si no responde bien, en la API alternativa (o en paralelo si HEDGING_HORARIOS está activo).
+    
+    Returns:
+        tuple: (horarios_data o None si no hubo datos utilizables, api usada, mensaje de error
+        si el endpoint no existe en ninguna API)
+    """
+    # Intentar primero con la API correspondiente a la sucursal y luego con la alternativa
+    apis_a_probar = apis_en_orden(id_sucursal)
+    argumentos = (ids_profesionales, id_sucursal, fecha_inicio_dt, fecha_fin_dt)
+    if HEDGING_HORARIOS and len(apis_a_probar) == 2:
+        intentos = intentos_con_hedging(apis_a_probar, *argumentos)
+    else:
+        intentos = _intentos_secuenciales(apis_a_probar, *argumentos)
+    
+    # Una ruta aprendida que contradice la configuración debe confirmarse con horarios:
+    # si responde vacío se consulta también la alternativa, que la corrige si los trae
+    verificar_ruta = len(apis_a_probar) == 2 and ruta_contradice_configuracion(id_sucursal)
+    respuesta_vacia = None
+    
+    response = None
+    url_usado = None
+    api_usada = None
+    api_respuesta = None
+    gano_por_hedging = False
+    
+    for api_config, respuesta_api, url_api, por_hedging in intentos:
+        if respuesta_api is not None:
+            response = respuesta_api
+            api_respuesta = api_config
+            gano_por_hedging = por_hedging
+        if url_api:
+            url_usado = url_api
+            api_usada = api_config['name']
+            log_detalle(f"✅ Endpoint encontrado en {api_usada}")
+        else:
+            logging.warning(f"⚠️ Endpoint no encontrado en {api_config['name']}")
+        
+        if response is not None and response.ok:
+            if not (verificar_ruta and respuesta_vacia is None and api_config is apis_a_probar[0]
+                    and not tiene_horarios(response)):
+                break
+            log_detalle(f"🧭 Ruta aprendida de la sucursal {id_sucursal} sin horarios, verificando {apis_a_probar[1]['name']}")
+            respuesta_vacia = (response, url_usado, api_usada, api_respuesta, gano_por_hedging)
+    
+    if respuesta_vacia is not None and not tiene_horarios(response):
+        # La alternativa tampoco trajo horarios: queda la respuesta de la ruta aprendida
+        response, url_usado, api_usada, api_respuesta, gano_por_hedging = respuesta_vacia
+    
+    if response is None or response.status_code == 404:
+        logging.error("❌ Endpoint horariosdisponibles no encontrado en ninguna API")
+        return None, None, "Endpoint horariosdisponibles no encontrado en ninguna API (Dentalink v1 ni Medilink v5)"
+    
+    log_detalle(f"✅ URL exitosa: {url_usado} (API: {api_usada})")
+    
+    if response.status_code != 200:
+        logging.error(f"❌ Status code no exitoso en horariosdisponibles: {response.status_code}")
+        log_detalle(f"📄 Response text: {response.text[:500]}")
+        return None, api_usada, None
+    
+    try:
+        horarios_data = response.json().get("data", {})
+    except json.JSONDecodeError as e:
+        logging.error(f"❌ Error parseando JSON: {e}")
+        return None, api_usada, None
+    
+    # Esta API respondió por la sucursal y por los profesionales que trajeron horarios.
+    # Una respuesta vacía no confirma nada y una que ganó solo por latencia no cambia la ruta.
+    if horarios_data and not gano_por_hedging:
+        registrar_ruta(api_respuesta["is_dentalink"], id_sucursal,
+                       [int(id_prof) for id_prof in (horarios_data or {}) if str(id_prof).isdigit()])
+    
+    log_detalle(f"📊 Cantidad de profesionales con horarios: {len(horarios_data) if horarios_data else 0}")
+    return horarios_data or None, api_usada, None
+
+def _horarios_validos_fecha(horarios: List[Dict], fecha: str, hora_actual: datetime, tiempo_cita: int = None) -> List[str]:
+    """Horarios futuros de una fecha en formato HH:MM, filtrados por duración si se indicó tiempo_cita"""
+    # Primero filtrar por horarios futuros
+    horarios_futuros = filtrar_horarios_futuros(horarios, fecha, hora_actual)
+    if not horarios_futuros:
+        return []
+    
+    # Luego filtrar por duración si se especificó tiempo_cita
+    if tiempo_cita:
+        return filtrar_horarios_por_duracion(horarios_futuros, tiempo_cita)
+    
+    # Si no hay tiempo_cita, normalizar todos los horarios futuros
+    horarios_normalizados = []
+    for horario in horarios_futuros:
+        hora_inicio = horario.get("hora_inicio", "")
+        
+        # Normalizar formato de hora
+        try:
+            hora_normalizada = datetime.strptime(hora_inicio, "%H:%M:%S").strftime("%H:%M")
+        except ValueError:
+            logging.warning(f"⚠️ Formato de hora inválido: {hora_inicio}")
+            hora_normalizada = hora_inicio
+        
+        horarios_normalizados.append(hora_normalizada)
+    return horarios_normalizados
+
+def disponibilidad_semana(horarios_data: Dict, profesionales_info: Dict[int, str], hora_actual: datetime,
+                          tiempo_cita: int = None) -> List[Dict[str, Any]]:
+    """
+    Arma la disponibilidad de una ventana a partir de la respuesta de horariosdisponibles.
+    
+    Returns:
+        Lista de {"nombre_profesional", "fechas": {fecha: [HH:MM, ...]}} con los profesionales
+        que tienen al menos un horario válido
+    """
+    detalle = detalle_activo()
+    disponibilidad_final = []
+    horarios_entregados = 0
+    log_detalle(f"🔍 Procesando horarios para {len(horarios_data)} profesionales")
+    
+    for id_profesional_str, fechas_horarios in horarios_data.items():
+        id_profesional_int = int(id_profesional_str)
+        
+        # Obtener nombre del profesional
+        nombre_profesional = profesionales_info.get(id_profesional_int, f"Profesional {id_profesional_int}")
+        
+        disponibilidad_profesional = {
+            "nombre_profesional": nombre_profesional,
+            "fechas": {}
+        }
+        
+        if isinstance(fechas_horarios, dict):
+            for fecha, horarios in fechas_horarios.items():
+                if isinstance(horarios, list):
+                    horarios_normalizados = _horarios_validos_fecha(horarios, fecha, hora_actual, tiempo_cita)
+                    if horarios_normalizados:
+                        disponibilidad_profesional["fechas"][fecha] = horarios_normalizados
+                        horarios_entregados += len(horarios_normalizados)
+                        if detalle:
+                            logging.info(f"✅ Fecha {fecha} agregada con {len(horarios_normalizados)} horarios")
+                else:
+                    logging.warning(f"⚠️ Horarios para fecha {fecha} no es una lista: {type(horarios)}")
+        else:
+            logging.warning(f"⚠️ fechas_horarios no es un dict: {type(fechas_horarios)}")
+        
+        if disponibilidad_profesional["fechas"]:
+            disponibilidad_final.append(disponibilidad_profesional)
+            if detalle:
+                logging.info(f"✅ Profesional {id_profesional_str} agregado con {len(disponibilidad_profesional['fechas'])} fechas")
+        elif detalle:
+            logging.info(f"❌ Profesional {id_profesional_str} sin fechas disponibles")
+    
+    sumar_registro("horarios_procesados", horarios_entregados)
+    log_detalle(f"📊 Total profesionales con disponibilidad: {len(disponibilidad_final)}")
+    return disponibilidad_final
+
+def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_inicio: str = None, tiempo_cita: int = None) -> Dict[str, Any]:
+    """
+    Busca disponibilidad de profesionales en Medilink/Dentalink.
+    
+    Args:
+        ids_profesionales: Lista de IDs de profesionales
+        id_sucursal: ID de la sucursal
+        fecha_inicio: Fecha de inicio (opcional, default: hoy)
+        tiempo_cita: Tiempo en minutos requerido para la cita (opcional)
+    
+    Returns:
+        Dict con la disponibilidad encontrada
+    """
+    anotar_registro(id_sucursal=id_sucursal, profesionales=len(ids_profesionales or []),
+                    fecha_inicio=fecha_inicio, tiempo_cita=tiempo_cita)
+    log_detalle(f"🔍 Búsqueda de disponibilidad: ids_profesionales={ids_profesionales}, id_sucursal={id_sucursal}, "
+                f"fecha_inicio={fecha_inicio}, tiempo_cita={tiempo_cita}")
+    
+    # Validaciones
+    if not ids_profesionales:
+        logging.error("❌ Error: No se proporcionaron IDs de profesionales")
+        return {"error": "Se requiere al menos un ID de profesional"}
+    
+    if not id_sucursal:
+        logging.error("❌ Error: No se proporcionó ID de sucursal")
+        return {"error": "Se requiere ID de sucursal"}
+    
+    # Determinar API a usar
+    usa_dentalink = determinar_api_por_sucursal(id_sucursal)[2]
+    anotar_registro(api=obtener_nombre_api(id_sucursal))
+    
+    # Obtener nombres de profesionales
+    profesionales_info = _obtener_nombres_profesionales(ids_profesionales, usa_dentalink)
+    
+    # Obtener hora actual de Santiago/Chile
+    tz_santiago = pytz.timezone("America/Santiago")
+    hora_actual = datetime.now(tz_santiago)
+    
+    # Establecer fecha de inicio
+    if not fecha_inicio:
+        fecha_inicio = hora_actual.strftime("%Y-%m-%d")
+    
+    fecha_inicio_dt = datetime.strptime(fecha_inicio, "%Y-%m-%d")
+    
+    # Búsqueda iterativa hasta 4 semanas
+    for intento_actual in range(1, SEMANAS_BUSQUEDA + 1):
+        sumar_registro("semanas_consultadas")
+        fecha_fin_dt = fecha_inicio_dt + timedelta(days=6)  # 1 semana
+        
+        log_detalle(f"🔄 Intento {intento_actual} de {SEMANAS_BUSQUEDA}: "
+                    f"Buscando del {fecha_inicio_dt.strftime('%Y-%m-%d')} al {fecha_fin_dt.strftime('%Y-%m-%d')}")
+        
+        horarios_data, api_usada, error = consultar_horarios_ventana(ids_profesionales, id_sucursal,
+                                                                     fecha_inicio_dt, fecha_fin_dt)
+        if error:
+            return {"error": error}
+        
+        if horarios_data:
+            disponibilidad_final = disponibilidad_semana(horarios_data, profesionales_info, hora_actual, tiempo_cita)
+            
+            if disponibilidad_final:
+                resultado = {
+                    "disponibilidad": disponibilidad_final,
+                    "fecha_desde": fecha_inicio_dt.strftime('%Y-%m-%d'),
+                    "fecha_hasta": fecha_fin_dt.strftime('%Y-%m-%d'),
+                    "api_utilizada": api_usada if api_usada else obtener_nombre_api(id_sucursal)
+                }
+                anotar_registro(api=resultado["api_utilizada"], semana_encontrada=intento_actual)
+                return resultado
+        else:
+            log_detalle(f"⚠️ No hay datos de horarios en la respuesta para intento {intento_actual}")
+        
+        # Avanzar a la siguiente semana
+        fecha_inicio_dt += timedelta(days=7)
+    
+    return {
+        "mensaje": "No se encontró disponibilidad en las próximas 4 semanas",
+        "disponibilidad": []
+    }
+
+def search_availability_multisucursal(ids_profesionales: List[int], ids_sucursales: List[int], fecha_inicio: str = None,
+                                     tiempo_cita: int = None) -> Dict[str, Any]:
+    """
+    Busca disponibilidad en varias sucursales en paralelo.
+    
+    Cada sucursal se resuelve con search_availability, que elige Dentalink o Medilink
+    según determinar_api_por_sucursal.
+    
+    Args:
+        ids_profesionales: Lista de IDs de profesionales
+        ids_sucursales: Lista de IDs de sucursales
+        fecha_inicio: Fecha de inicio (opcional, default: hoy)
+        tiempo_cita: Tiempo en minutos requerido para la cita (opcional)
+    
+    Returns:
+        Dict con "sucursales": un resultado por sucursal en el orden recibido
+    """
+    ids_sucursales = list(dict.fromkeys(ids_sucursales))  # sin duplicados, manteniendo el orden
+    if not ids_sucursales:
+        return {"error": "Se requiere al menos un ID de sucursal"}
+    
+    # Cada tarea corre con una copia del contexto para sumar al registro de esta petición
+    futuros = [
+        _pool_sucursales.submit(copy_context().run, search_availability, ids_profesionales, id_sucursal,
+                                fecha_inicio, tiempo_cita)
+        for id_sucursal in ids_sucursales
+    ]
     
-    for i, horario in enumerate(horarios_ordenados):
+    resultados = []
+    for id_sucursal, futuro in zip(ids_sucursales, futuros):
         try:
-            # Obtener intervalo del API (obligatorio)
-            intervalo = horario.get("intervalo")
-            if not intervalo:
-                logging.warning(f"⚠️ Slot sin intervalo definido: {horario.get('hora_inicio', 'N/A')} - Se omite")
-                continue
-            
-            hora_inicio_str = horario.get("hora_inicio", "")
-            hora_inicio = datetime.strptime(hora_inicio_str, "%H:%M:%S")
-            
-            # Calcular tiempo total disponible empezando desde este slot
-            tiempo_disponible = intervalo  # El slot actual
-            hora_esperada = hora_inicio + timedelta(minutes=intervalo)
-            slots_usados = 1
-            
-            # Verificar slots consecutivos
-            for j in range(i + 1, len(horarios_ordenados)):
-                siguiente_horario = horarios_ordenados[j]
-                hora_siguiente_str = siguiente_horario.get("hora_inicio", "")
-                hora_siguiente = datetime.strptime(hora_siguiente_str, "%H:%M:%S")
-                intervalo_siguiente = siguiente_horario.get("intervalo")
-                
-                if not intervalo_siguiente:
-                    logging.warning(f"⚠️ Slot consecutivo sin intervalo: {hora_siguiente_str} - Se detiene búsqueda")
-                    break
-                
-                # Verificar si es consecutivo
-                if hora_siguiente == hora_esperada:
-                    tiempo_disponible += intervalo_siguiente
-                    slots_usados += 1
-                    hora_esperada = hora_siguiente + timedelta(minutes=intervalo_siguiente)
-                    
-                    # Si ya tenemos suficiente tiempo, este es válido
-                    if tiempo_disponible >= tiempo_cita:
-                        break
-                else:
-                    # No es consecutivo, romper la búsqueda
-                    break
-            
-            # Verificar si el tiempo disponible es suficiente
-            if tiempo_disponible >= tiempo_cita:
-                horarios_validos.append(hora_inicio.strftime("%H:%M"))
-                logging.info(f"✅ Horario válido: {hora_inicio.strftime('%H:%M')} ({slots_usados} slots = {tiempo_disponible}min disponibles para {tiempo_cita}min requeridos)")
-            else:
-                logging.info(f"❌ Horario insuficiente: {hora_inicio.strftime('%H:%M')} (solo {tiempo_disponible}min disponibles, necesita {tiempo_cita}min)")
-                
+            resultado = futuro.result()
         except Exception as e:
-            logging.warning(f"⚠️ Error procesando horario para duración: {e}")
-            continue
+            logging.error(f"❌ Error buscando disponibilidad en sucursal {id_sucursal}: {e}")
+            resultado = {"error": f"Error buscando disponibilidad: {str(e)}"}
+        resultados.append({"id_sucursal": id_sucursal, **resultado})
     
-    return horarios_validos
-
-# ============================
-# FUNCIÓN 1: BUSCAR DISPONIBILIDAD
-# ============================
+    con_disponibilidad = sum(1 for resultado in resultados if resultado.get("disponibilidad"))
+    anotar_registro(id_sucursal=ids_sucursales, api=[resultado.get("api_utilizada") for resultado in resultados],
+                    semana_encontrada=None, sucursales_con_disponibilidad=con_disponibilidad)
+    
+    return {
+        "sucursales": resultados,
+        "sucursales_con_disponibilidad": con_disponibilidad
+    }
 
-def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_inicio: str = None, tiempo_cita: int = None) -> Dict[str, Any]:
+def next_available_slots(ids_profesionales: List[int], id_sucursal: int, cantidad: int = PROXIMOS_HORARIOS_DEFAULT,
+                         fecha_inicio: str = None, tiempo_cita: int = None) -> Dict[str, Any]:
     """
-    Busca disponibilidad de profesionales en Medilink/Dentalink.
+    Retorna los primeros `cantidad` horarios disponibles entre todos los profesionales.
+    
+    Recorre las ventanas de 7 días una a una y se detiene en cuanto junta `cantidad`
+    inicios válidos (respetando tiempo_cita), sin consultar las semanas siguientes.
     
     Args:
         ids_profesionales: Lista de IDs de profesionales
         id_sucursal: ID de la sucursal
+        cantidad: Cantidad de horarios a retornar
         fecha_inicio: Fecha de inicio (opcional, default: hoy)
         tiempo_cita: Tiempo en minutos requerido para la cita (opcional)
     
     Returns:
-        Dict con la disponibilidad encontrada
+        Dict con "horarios": lista ordenada por fecha y hora
     """
-    logging.info("🔍 Iniciando búsqueda de disponibilidad")
-    logging.info(f"📋 Parámetros recibidos:")
-    logging.info(f"   - ids_profesionales: {ids_profesionales}")
-    logging.info(f"   - id_sucursal: {id_sucursal}")
-    logging.info(f"   - fecha_inicio: {fecha_inicio}")
-    logging.info(f"   - tiempo_cita: {tiempo_cita}")
+    anotar_registro(id_sucursal=id_sucursal, profesionales=len(ids_profesionales or []),
+                    fecha_inicio=fecha_inicio, tiempo_cita=tiempo_cita, cantidad=cantidad)
     
-    # Validaciones
     if not ids_profesionales:
-        logging.error("❌ Error: No se proporcionaron IDs de profesionales")
         return {"error": "Se requiere al menos un ID de profesional"}
     
     if not id_sucursal:
-        logging.error("❌ Error: No se proporcionó ID de sucursal")
         return {"error": "Se requiere ID de sucursal"}
     
-    # Determinar API a usar
-    api_base, headers_api, usa_dentalink = determinar_api_por_sucursal(id_sucursal)
-    logging.info(f"🔧 API seleccionada: {obtener_nombre_api(id_sucursal)}")
-    logging.info(f"🌐 URL base: {api_base}")
-    logging.info(f"🔑 Headers: {headers_api}")
-    
-    # Obtener nombres de profesionales
-    profesionales_info = {}
-    logging.info("👨‍⚕️ Obteniendo información de profesionales...")
-    
-    # Intentar primero con la API correspondiente a la sucursal
-    if usa_dentalink:
-        try:
-            prof_resp = requests.get(f"{api_base}dentistas", headers=headers_api)
-            if prof_resp.status_code == 200:
-                dentistas = prof_resp.json().get("data", [])
-                for dentista in dentistas:
-                    if dentista.get("id") in ids_profesionales:
-                        apellidos = dentista.get('apellidos', '') or dentista.get('apellido', '')
-                        nombre_completo = f"{dentista.get('nombre', 'Desconocido')} {apellidos}".strip()
-                        profesionales_info[dentista.get("id")] = nombre_completo
-                        logging.info(f"✅ Dentista encontrado en Dentalink: ID {dentista.get('id')} - {nombre_completo}")
-            else:
-                logging.warning(f"⚠️ No se pudieron obtener dentistas de Dentalink: {prof_resp.status_code}")
-        except Exception as e:
-            logging.warning(f"⚠️ Error obteniendo dentistas de Dentalink: {e}")
-    else:
-        # Para Medilink, obtener cada profesional individualmente
-        for id_prof in ids_profesionales:
-            try:
-                prof_resp = requests.get(f"{api_base}profesionales/{id_prof}", headers=headers_api)
-                if prof_resp.status_code == 200:
-                    prof_data = prof_resp.json().get("data", {})
-                    apellidos = prof_data.get('apellidos', '') or prof_data.get('apellido', '')
-                    nombre_completo = f"{prof_data.get('nombre', 'Desconocido')} {apellidos}".strip()
-                    profesionales_info[id_prof] = nombre_completo
-                    logging.info(f"✅ Profesional encontrado en Medilink: ID {id_prof} - {nombre_completo}")
-                else:
-                    logging.warning(f"⚠️ No se pudo obtener profesional {id_prof} de Medilink: {prof_resp.status_code}")
-            except Exception as e:
-                logging.warning(f"⚠️ Error obteniendo profesional {id_prof} de Medilink: {e}")
-    
-    # Buscar profesionales faltantes en la API alternativa
-    ids_faltantes = [id_prof for id_prof in ids_profesionales if id_prof not in profesionales_info]
-    
-    if ids_faltantes:
-        logging.info(f"🔄 Buscando {len(ids_faltantes)} profesionales en API alternativa...")
-        
-        if usa_dentalink:
-            # Si usamos Dentalink, buscar faltantes en Medilink
-            for id_prof in ids_faltantes:
-                try:
-                    prof_resp = requests.get(f"{MEDILINK_API_URL}profesionales/{id_prof}", headers=MEDILINK_HEADERS)
-                    if prof_resp.status_code == 200:
-                        prof_data = prof_resp.json().get("data", {})
-                        apellidos = prof_data.get('apellidos', '') or prof_data.get('apellido', '')
-                        nombre_completo = f"{prof_data.get('nombre', 'Desconocido')} {apellidos}".strip()
-                        profesionales_info[id_prof] = nombre_completo
-                        logging.info(f"✅ Profesional encontrado en Medilink (alternativo): ID {id_prof} - {nombre_completo}")
-                    else:
-                        logging.warning(f"⚠️ Profesional {id_prof} no encontrado en Medilink: {prof_resp.status_code}")
-                except Exception as e:
-                    logging.warning(f"⚠️ Error buscando profesional {id_prof} en Medilink: {e}")
-        else:
-            # Si usamos Medilink, buscar faltantes en Dentalink
-            try:
-                prof_resp = requests.get(f"{DENTALINK_API_URL}dentistas", headers=DENTALINK_HEADERS)
-                if prof_resp.status_code == 200:
-                    dentistas = prof_resp.json().get("data", [])
-                    for dentista in dentistas:
-                        if dentista.get("id") in ids_faltantes:
-                            apellidos = dentista.get('apellidos', '') or dentista.get('apellido', '')
-                            nombre_completo = f"{dentista.get('nombre', 'Desconocido')} {apellidos}".strip()
-                            profesionales_info[dentista.get("id")] = nombre_completo
-                            logging.info(f"✅ Dentista encontrado en Dentalink (alternativo): ID {dentista.get('id')} - {nombre_completo}")
-                else:
-                    logging.warning(f"⚠️ No se pudieron obtener dentistas de Dentalink: {prof_resp.status_code}")
-            except Exception as e:
-                logging.warning(f"⚠️ Error obteniendo dentistas de Dentalink: {e}")
+    if not isinstance(cantidad, int) or not 1 <= cantidad <= PROXIMOS_HORARIOS_MAX:
+        return {"error": f"cantidad debe ser un entero entre 1 y {PROXIMOS_HORARIOS_MAX}"}
     
-    # Fallback: usar IDs como nombres para los que aún faltan
-    for id_prof in ids_profesionales:
-        if id_prof not in profesionales_info:
-            profesionales_info[id_prof] = f"Profesional {id_prof}"
-            logging.warning(f"⚠️ No se encontró nombre para profesional {id_prof}, usando fallback")
+    usa_dentalink = determinar_api_por_sucursal(id_sucursal)[2]
+    anotar_registro(api=obtener_nombre_api(id_sucursal))
+    profesionales_info = _obtener_nombres_profesionales(ids_profesionales, usa_dentalink)
     
-    # Obtener hora actual de Santiago/Chile
     tz_santiago = pytz.timezone("America/Santiago")
     hora_actual = datetime.now(tz_santiago)
-    
-    # Establecer fecha de inicio
     if not fecha_inicio:
         fecha_inicio = hora_actual.strftime("%Y-%m-%d")
-    
     fecha_inicio_dt = datetime.strptime(fecha_inicio, "%Y-%m-%d")
     
-    # Búsqueda iterativa hasta 4 semanas
-    intentos_maximos = 4
-    intento_actual = 1
+    horarios_encontrados = []
+    api_usada = None
     
-    while intento_actual <= intentos_maximos:
-        fecha_fin_dt = fecha_inicio_dt + timedelta(days=6)  # 1 semana
-        
-        logging.info(f"🔄 Intento {intento_actual} de {intentos_maximos}: "
-                    f"Buscando del {fecha_inicio_dt.strftime('%Y-%m-%d')} al {fecha_fin_dt.strftime('%Y-%m-%d')}")
-        
-        # Preparar parámetros para la API según el tipo
-        body_data = None
-        params = None
-        
-        if usa_dentalink:
-            # Para Dentalink: usar body JSON con ids_dentista
-            body_data = {
-                "ids_dentista": ids_profesionales,
-                "id_sucursal": id_sucursal,
-                "fecha_inicio": fecha_inicio_dt.strftime("%Y-%m-%d"),
-                "fecha_fin": fecha_fin_dt.strftime("%Y-%m-%d")
-            }
-            logging.info(f"📋 Body JSON para Dentalink: {body_data}")
-        else:
-            # Para Medilink: usar parámetros URL con ids_profesional[]
-            params = []
-            for id_prof in ids_profesionales:
-                params.append(("ids_profesional[]", id_prof))
-            params.extend([
-                ("id_sucursal", id_sucursal),
-                ("fecha_inicio", fecha_inicio_dt.strftime("%Y-%m-%d")),
-                ("fecha_fin", fecha_fin_dt.strftime("%Y-%m-%d"))
-            ])
-            logging.info(f"📋 Params para Medilink: {params}")
-        
-        # Obtener horarios disponibles - intentar en API principal primero
-        response = None
-        url_usado = None
-        api_usada = None
+    for semana in range(1, SEMANAS_BUSQUEDA + 1):
+        sumar_registro("semanas_consultadas")
+        fecha_fin_dt = fecha_inicio_dt + timedelta(days=6)
         
-        # Intentar primero con la API correspondiente a la sucursal
-        apis_a_probar = [
-            {
-                "name": obtener_nombre_api(id_sucursal),
-                "base": api_base,
-                "headers": headers_api,
-                "is_dentalink": usa_dentalink,
-                "body": body_data,
-                "params": params
-            }
-        ]
-        
-        # Si falla, agregar API alternativa como fallback
-        api_alternativa = {
-            "name": "Medilink v5" if usa_dentalink else "Dentalink v1",
-            "base": MEDILINK_API_URL if usa_dentalink else DENTALINK_API_URL,
-            "headers": MEDILINK_HEADERS if usa_dentalink else DENTALINK_HEADERS,
-            "is_dentalink": not usa_dentalink,
-            "body": None,
-            "params": None
-        }
+        horarios_data, api_semana, error = consultar_horarios_ventana(ids_profesionales, id_sucursal,
+                                                                      fecha_inicio_dt, fecha_fin_dt)
+        if error:
+            return {"error": error}
+        api_usada = api_semana or api_usada
         
-        # Preparar params/body para API alternativa si es necesario
-        if usa_dentalink:
-            # Si original era Dentalink, alternativa es Medilink (usa params)
-            api_alternativa["params"] = []
-            for id_prof in ids_profesionales:
-                api_alternativa["params"].append(("ids_profesional[]", id_prof))
-            api_alternativa["params"].extend([
-                ("id_sucursal", id_sucursal),
-                ("fecha_inicio", fecha_inicio_dt.strftime("%Y-%m-%d")),
-                ("fecha_fin", fecha_fin_dt.strftime("%Y-%m-%d"))
-            ])
-        else:
-            # Si original era Medilink, alternativa es Dentalink (usa body)
-            api_alternativa["body"] = {
-                "ids_dentista": ids_profesionales,
-                "id_sucursal": id_sucursal,
-                "fecha_inicio": fecha_inicio_dt.strftime("%Y-%m-%d"),
-                "fecha_fin": fecha_fin_dt.strftime("%Y-%m-%d")
-            }
-        
-        apis_a_probar.append(api_alternativa)
+        # Agrupar por fecha para recorrer los días en orden y cortar apenas se completa la cantidad
+        horarios_por_fecha: Dict[str, List[Tuple[int, List[Dict]]]] = {}
+        for id_profesional_str, fechas_horarios in (horarios_data or {}).items():
+            if not isinstance(fechas_horarios, dict):
+                continue
+            for fecha, horarios in fechas_horarios.items():
+                if isinstance(horarios, list):
+                    horarios_por_fecha.setdefault(fecha, []).append((int(id_profesional_str), horarios))
         
-        # Intentar con cada API
-        for api_config in apis_a_probar:
-            urls_to_try = [f"{api_config['base']}horariosdisponibles/", f"{api_config['base']}horariosdisponibles"]
+        for fecha in sorted(horarios_por_fecha):
+            horarios_dia = []
+            for id_profesional, horarios in horarios_por_fecha[fecha]:
+                for hora in _horarios_validos_fecha(horarios, fecha, hora_actual, tiempo_cita):
+                    horarios_dia.append((hora, id_profesional))
             
-            for url_horarios in urls_to_try:
-                try:
-                    logging.info(f"🌐 Intentando URL: {url_horarios} ({api_config['name']})")
-                    
-                    if api_config['is_dentalink']:
-                        response = requests.get(url_horarios, headers=api_config['headers'], json=api_config['body'])
-                    else:
-                        response = requests.get(url_horarios, headers=api_config['headers'], params=api_config['params'])
-                    
-                    logging.info(f"📊 Status Code: {response.status_code}")
-                    
-                    if response.status_code == 404:
-                        logging.warning(f"⚠️ Endpoint no encontrado en {api_config['name']}")
-                        continue
-                    
-                    if response.status_code != 404:
-                        url_usado = url_horarios
-                        api_usada = api_config['name']
-                        logging.info(f"✅ Endpoint encontrado en {api_usada}")
-                        break
-                        
-                except requests.exceptions.RequestException as e:
-                    logging.error(f"❌ Error al conectar con {url_horarios}: {e}")
-                    continue
-            
-            if response and response.status_code != 404:
-                break
-        
-        if response is None or response.status_code == 404:
-            logging.error("❌ Endpoint horariosdisponibles no encontrado en ninguna API")
-            return {"error": "Endpoint horariosdisponibles no encontrado en ninguna API (Dentalink v1 ni Medilink v5)"}
-        
-        logging.info(f"✅ URL exitosa: {url_usado} (API: {api_usada})")
-        logging.info(f"📄 Response raw: {response.text[:500]}...")  # Primeros 500 caracteres
-        
-        if response.status_code == 200:
-            try:
-                data_response = response.json()
-                logging.info(f"📦 Estructura de respuesta: {list(data_response.keys())}")
-                horarios_data = data_response.get("data", {})
-                logging.info(f"📅 Horarios data keys: {list(horarios_data.keys()) if horarios_data else 'No data'}")
-                logging.info(f"📊 Cantidad de profesionales con horarios: {len(horarios_data) if horarios_data else 0}")
-            except json.JSONDecodeError as e:
-                logging.error(f"❌ Error parseando JSON: {e}")
-                continue
+            for hora, id_profesional in sorted(horarios_dia):
+                horarios_encontrados.append({
+                    "fecha": fecha,
+                    "hora_inicio": hora,
+                    "id_profesional": id_profesional,
+                    "nombre_profesional": profesionales_info.get(id_profesional, f"Profesional {id_profesional}")
+                })
             
-            if horarios_data:
-                disponibilidad_final = []
-                logging.info(f"🔍 Procesando horarios para {len(horarios_data)} profesionales")
-                
-                for id_profesional_str, fechas_horarios in horarios_data.items():
-                    id_profesional_int = int(id_profesional_str)
-                    logging.info(f"👨‍⚕️ Procesando profesional ID: {id_profesional_str}")
-                    logging.info(f"📅 Fechas disponibles: {list(fechas_horarios.keys()) if isinstance(fechas_horarios, dict) else 'No es dict'}")
-                    
-                    # Obtener nombre del profesional
-                    nombre_profesional = profesionales_info.get(id_profesional_int, f"Profesional {id_profesional_int}")
-                    logging.info(f"👤 Nombre asignado: {nombre_profesional}")
-                    
-                    disponibilidad_profesional = {
-                        "nombre_profesional": nombre_profesional,
-                        "fechas": {}
-                    }
-                    
-                    if isinstance(fechas_horarios, dict):
-                        for fecha, horarios in fechas_horarios.items():
-                            logging.info(f"📆 Procesando fecha {fecha} con {len(horarios) if isinstance(horarios, list) else 'No es lista'} horarios")
-                            
-                            if isinstance(horarios, list):
-                                # Primero filtrar por horarios futuros
-                                horarios_futuros = filtrar_horarios_futuros(horarios, fecha, hora_actual)
-                                logging.info(f"⏰ Horarios futuros filtrados: {len(horarios_futuros)}")
-                                
-                                if horarios_futuros:
-                                    # Luego filtrar por duración si se especificó tiempo_cita
-                                    if tiempo_cita:
-                                        logging.info(f"⏱️ Filtrando por duración de {tiempo_cita} minutos")
-                                        horarios_normalizados = filtrar_horarios_por_duracion(horarios_futuros, tiempo_cita)
-                                        logging.info(f"✅ Horarios válidos para {tiempo_cita}min: {len(horarios_normalizados)}")
-                                    else:
-                                        # Si no hay tiempo_cita, normalizar todos los horarios futuros
-                                        horarios_normalizados = []
-                                        for horario in horarios_futuros:
-                                            hora_inicio = horario.get("hora_inicio", "")
-                                            logging.info(f"🕐 Procesando hora: {hora_inicio}")
-                                            
-                                            # Normalizar formato de hora
-                                            try:
-                                                hora_normalizada = datetime.strptime(hora_inicio, "%H:%M:%S").strftime("%H:%M")
-                                            except ValueError:
-                                                logging.warning(f"⚠️ Formato de hora inválido: {hora_inicio}")
-                                                hora_normalizada = hora_inicio
-                                            
-                                            horarios_normalizados.append(hora_normalizada)
-                                    
-                                    if horarios_normalizados:
-                                        disponibilidad_profesional["fechas"][fecha] = horarios_normalizados
-                                        logging.info(f"✅ Fecha {fecha} agregada con {len(horarios_normalizados)} horarios")
-                            else:
-                                logging.warning(f"⚠️ Horarios para fecha {fecha} no es una lista: {type(horarios)}")
-                    else:
-                        logging.warning(f"⚠️ fechas_horarios no es un dict: {type(fechas_horarios)}")
-                    
-                    if disponibilidad_profesional["fechas"]:
-                        disponibilidad_final.append(disponibilidad_profesional)
-                        logging.info(f"✅ Profesional {id_profesional_str} agregado con {len(disponibilidad_profesional['fechas'])} fechas")
-                    else:
-                        logging.info(f"❌ Profesional {id_profesional_str} sin fechas disponibles")
-                
-                logging.info(f"📊 Total profesionales con disponibilidad: {len(disponibilidad_final)}")
-                
-                if disponibilidad_final:
-                    resultado = {
-                        "disponibilidad": disponibilidad_final,
-                        "fecha_desde": fecha_inicio_dt.strftime('%Y-%m-%d'),
-                        "fecha_hasta": fecha_fin_dt.strftime('%Y-%m-%d'),
-                        "api_utilizada": api_usada if api_usada else obtener_nombre_api(id_sucursal)
-                    }
-                    logging.info(f"✅ Retornando disponibilidad exitosa desde {api_usada}")
-                    return resultado
-            else:
-                logging.warning(f"⚠️ No hay datos de horarios en la respuesta para intento {intento_actual}")
-        else:
-            logging.error(f"❌ Status code no exitoso: {response.status_code}")
-            logging.error(f"📄 Response text: {response.text}")
+            if len(horarios_encontrados) >= cantidad:
+                anotar_registro(semana_encontrada=semana, horarios_procesados=cantidad)
+                return {
+                    "horarios": horarios_encontrados[:cantidad],
+                    "api_utilizada": api_usada or obtener_nombre_api(id_sucursal)
+                }
         
-        # Avanzar a la siguiente semana
         fecha_inicio_dt += timedelta(days=7)
-        intento_actual += 1
     
-    return {
-        "mensaje": "No se encontró disponibilidad en las próximas 4 semanas",
-        "disponibilidad": []
+    anotar_registro(horarios_procesados=len(horarios_encontrados))
+    resultado = {
+        "horarios": horarios_encontrados,
+        "api_utilizada": api_usada or obtener_nombre_api(id_sucursal)
     }
+    if len(horarios_encontrados) < cantidad:
+        resultado["mensaje"] = (f"Solo se encontraron {len(horarios_encontrados)} horarios disponibles "
+                                f"en las próximas {SEMANAS_BUSQUEDA} semanas")
+    return resultado
 
 @app.route('/search_availability', methods=['POST'])
 def endpoint_search_availability():
-    """Endpoint para buscar disponibilidad"""
+    """
+    Endpoint para buscar disponibilidad.
+    
+    Acepta "id_sucursal" (una sucursal) o "ids_sucursales" / "id_sucursal" como lista
+    para buscar en varias sucursales en una sola llamada.
+    """
     data = request.get_json()
     if not data:
         return jsonify({"error": "No se proporcionaron datos"}), 400
     
     ids_profesionales = data.get("ids_profesionales", [])
-    id_sucursal = extraer_id(data.get("id_sucursal"))
     fecha_inicio = data.get("fecha_inicio")
     tiempo_cita = data.get("tiempo_cita")
     
+    ids_sucursales = data.get("ids_sucursales")
+    if ids_sucursales is None and isinstance(data.get("id_sucursal"), list):
+        ids_sucursales = data.get("id_sucursal")
+    
+    if ids_sucursales is not None:
+        if not isinstance(ids_sucursales, list):
+            ids_sucursales = [ids_sucursales]
+        ids_extraidos = [extraer_id(valor) for valor in ids_sucursales]
+        if None in ids_extraidos:
+            return jsonify({"error": "ids_sucursales debe contener solo IDs numéricos"}), 400
+        
+        resultado = search_availability_multisucursal(ids_profesionales, ids_extraidos, fecha_inicio, tiempo_cita)
+        if "error" in resultado:
+            return jsonify(resultado), 400
+        return jsonify(resultado)
+    
+    id_sucursal = extraer_id(data.get("id_sucursal"))
+    
     resultado = search_availability(ids_profesionales, id_sucursal, fecha_inicio, tiempo_cita)
     
     if "error" in resultado:
@@ -583,17 +1629,66 @@ def endpoint_search_availability():
     
     return jsonify(resultado)
 
+@app.route('/next_available_slots', methods=['POST'])
+def endpoint_next_available_slots():
+    """Endpoint para obtener los próximos N horarios disponibles"""
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "No se proporcionaron datos"}), 400
+    
+    ids_profesionales = data.get("ids_profesionales", [])
+    id_sucursal = extraer_id(data.get("id_sucursal"))
+    cantidad = extraer_id(data.get("cantidad", PROXIMOS_HORARIOS_DEFAULT))
+    fecha_inicio = data.get("fecha_inicio")
+    tiempo_cita = data.get("tiempo_cita")
+    
+    resultado = next_available_slots(ids_profesionales, id_sucursal, cantidad, fecha_inicio, tiempo_cita)
+    
+    if "error" in resultado:
+        return jsonify(resultado), 400
+    
+    return jsonify(resultado)
+
+# ============================
+# CONTEXTO DE AGENDAMIENTO
+# ============================
+
+class ContextoAgendamiento:
+    """
+    Lo ya resuelto durante una petición de agendamiento (paciente y su API, profesional,
+    nombre de la sucursal). create_user, schedule_appointment y _integrar_ghl lo leen
+    antes de consultar y lo completan después, así cada entidad se busca una sola vez
+    aunque pase por las tres funciones.
+    """
+    
+    def __init__(self):
+        self.paciente: Optional[Dict[str, Any]] = None
+        self.api_paciente: Optional[Dict[str, Any]] = None   # API donde existe (o se creó) el paciente
+        self.profesional: Optional[Dict[str, Any]] = None    # {"nombre", "intervalo"}
+        self.nombre_sucursal: Optional[str] = None
+    
+    def registrar_paciente(self, paciente: Dict[str, Any], api: Dict[str, Any]) -> None:
+        self.paciente = paciente
+        self.api_paciente = api
+    
+    def ordenar_apis(self, apis: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Pone primero la API del paciente: sus IDs solo son válidos en ese backend"""
+        if not self.api_paciente:
+            return apis
+        return sorted(apis, key=lambda api: api['is_dentalink'] != self.api_paciente['is_dentalink'])
+
 # ============================
 # FUNCIÓN 2: BUSCAR PACIENTE
 # ============================
 
-def search_user(rut: str, id_sucursal: int = None) -> Dict[str, Any]:
+def search_user(rut: str, id_sucursal: int = None, contexto: ContextoAgendamiento = None) -> Dict[str, Any]:
     """
     Busca un paciente por RUT en Medilink/Dentalink.
     
     Args:
         rut: RUT del paciente
         id_sucursal: ID de sucursal (opcional, si no se proporciona busca en ambas APIs)
+        contexto: Contexto de la petición (opcional), recibe el paciente y su API
     
     Returns:
         Dict con los datos del paciente encontrado o error
@@ -602,55 +1697,32 @@ def search_user(rut: str, id_sucursal: int = None) -> Dict[str, Any]:
     
     rut_formateado = formatear_rut(rut)
     
-    def buscar_paciente_por_rut(rut_busqueda: str, api_base: str, headers_api: Dict, api_name: str):
-        """Busca paciente usando el filtro q en una API específica."""
-        try:
-            filtro = json.dumps({"rut": {"eq": rut_busqueda}})
-            logging.info(f"🔍 Buscando paciente en {api_base}pacientes?q=... RUT={rut_busqueda}")
-            
-            response = requests.get(f"{api_base}pacientes", headers=headers_api, params={"q": filtro})
-            logging.info(f"📊 Status búsqueda paciente en {api_name}: {response.status_code}")
-            
-            if response.status_code == 200:
-                pacientes = response.json().get("data", [])
-                if pacientes:
-                    paciente = pacientes[0]
-                    logging.info(f"✅ Paciente encontrado en {api_name} con ID {paciente['id']}")
-                    # Extraer solo los campos esenciales
-                    nombre_completo = f"{paciente.get('nombre', '')} {paciente.get('apellidos', '')}".strip()
-                    return {
-                        "id": paciente.get("id"),
-                        "nombre": nombre_completo,
-                        "celular": paciente.get("celular", ""),
-                        "email": paciente.get("email", ""),
-                        "rut": paciente.get("rut", "")
-                    }
-        except Exception as e:
-            logging.warning(f"⚠️ Error al buscar paciente en {api_name}: {e}")
-        
-        return None
-    
     # Si se proporciona sucursal, usar API específica según la sucursal
     if id_sucursal:
-        api_base, headers_api, usa_dentalink = determinar_api_por_sucursal(id_sucursal)
-        api_name = obtener_nombre_api(id_sucursal)
-        logging.info(f"🔧 Usando API específica para sucursal {id_sucursal}: {api_name}")
-        
-        resultado = buscar_paciente_por_rut(rut_formateado, api_base, headers_api, api_name)
-        if resultado:
-            return resultado
+        apis = apis_en_orden(id_sucursal)[:1]
+        logging.info(f"🔧 Usando API específica para sucursal {id_sucursal}: {apis[0]['name']}")
     else:
         # Buscar en ambas APIs si no se especifica sucursal
         logging.info("🔍 Buscando en ambas APIs (no se especificó sucursal)")
-        apis = [
-            {"name": "Medilink v5", "base": MEDILINK_API_URL, "headers": MEDILINK_HEADERS},
-            {"name": "Dentalink v1", "base": DENTALINK_API_URL, "headers": DENTALINK_HEADERS}
-        ]
-        
-        for api in apis:
-            resultado = buscar_paciente_por_rut(rut_formateado, api['base'], api['headers'], api['name'])
-            if resultado:
-                return resultado
+        apis = apis_disponibles([
+            {"name": "Medilink v5", "base": MEDILINK_API_URL, "headers": MEDILINK_HEADERS, "is_dentalink": False},
+            {"name": "Dentalink v1", "base": DENTALINK_API_URL, "headers": DENTALINK_HEADERS, "is_dentalink": True}
+        ])
+    
+    for api in apis:
+        paciente = buscar_paciente(rut_formateado, api)
+        if paciente:
+            logging.info(f"✅ Paciente encontrado en {api['name']} con ID {paciente['id']}")
+            if contexto:
+                contexto.registrar_paciente(paciente, api)
+            # Extraer solo los campos esenciales
+            return {
+                "id": paciente["id"],
+                "nombre": f"{paciente['nombre']} {paciente['apellidos']}".strip(),
+                "celular": paciente["celular"],
+                "email": paciente["email"],
+                "rut": paciente["rut"]
+            }
     
     return {"error": f"Paciente con RUT {rut_formateado} no encontrado"}
 
@@ -678,7 +1750,8 @@ def endpoint_search_user():
 # FUNCIÓN 3: CREAR PACIENTE
 # ============================
 
-def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email: str = "", id_sucursal: int = None) -> Dict[str, Any]:
+def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email: str = "", id_sucursal: int = None,
+                contexto: ContextoAgendamiento = None) -> Dict[str, Any]:
     """
     Crea un nuevo paciente en Medilink/Dentalink.
     
@@ -689,6 +1762,7 @@ def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email
         telefono: Teléfono del paciente (opcional)
         email: Email del paciente (opcional)
         id_sucursal: ID de sucursal (opcional, default usa Medilink)
+        contexto: Contexto de la petición (opcional), recibe el paciente y su API
     
     Returns:
         Dict con los datos del paciente creado o error
@@ -702,7 +1776,7 @@ def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email
     rut_formateado = formatear_rut(rut)
     
     # Verificar si el paciente ya existe (busca en ambas APIs)
-    paciente_existente = search_user(rut_formateado, id_sucursal)
+    paciente_existente = search_user(rut_formateado, id_sucursal, contexto)
     if "id" in paciente_existente:  # Si encontró el paciente (no hay error)
         return {
             "id": paciente_existente["id"],
@@ -710,37 +1784,15 @@ def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email
         }
     
     # Determinar APIs a intentar
-    apis_a_intentar = []
-    
     if id_sucursal:
-        api_base, headers_api, usa_dentalink = determinar_api_por_sucursal(id_sucursal)
-        api_name = obtener_nombre_api(id_sucursal)
-        
-        # API principal
-        apis_a_intentar.append({
-            "name": api_name,
-            "base": api_base,
-            "headers": headers_api,
-            "is_dentalink": usa_dentalink
-        })
-        
-        # API alternativa como fallback
-        api_alt_name = "Medilink v5" if usa_dentalink else "Dentalink v1"
-        api_alt_base = MEDILINK_API_URL if usa_dentalink else DENTALINK_API_URL
-        api_alt_headers = MEDILINK_HEADERS if usa_dentalink else DENTALINK_HEADERS
-        
-        apis_a_intentar.append({
-            "name": api_alt_name,
-            "base": api_alt_base,
-            "headers": api_alt_headers,
-            "is_dentalink": not usa_dentalink
-        })
+        # API principal (aprendida o por configuración) y la alternativa como fallback
+        apis_a_intentar = apis_en_orden(id_sucursal)
     else:
         # Default: intentar Medilink primero, luego Dentalink
-        apis_a_intentar = [
+        apis_a_intentar = apis_disponibles([
             {"name": "Medilink v5", "base": MEDILINK_API_URL, "headers": MEDILINK_HEADERS, "is_dentalink": False},
             {"name": "Dentalink v1", "base": DENTALINK_API_URL, "headers": DENTALINK_HEADERS, "is_dentalink": True}
-        ]
+        ])
     
     # Payload del paciente
     payload_paciente = {
@@ -757,12 +1809,17 @@ def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email
     for api in apis_a_intentar:
         try:
             logging.info(f"🔄 Intentando crear paciente en {api['name']}")
-            response = requests.post(f"{api['base']}pacientes/", headers=api['headers'], json=payload_paciente)
+            response = http_post(f"{api['base']}pacientes/", headers=api['headers'], json=payload_paciente)
             
             if response.status_code == 201:
                 paciente_data = response.json().get("data", {})
                 id_paciente = paciente_data.get('id')
                 logging.info(f"✅ Paciente creado exitosamente en {api['name']} con ID {id_paciente}")
+                if id_paciente:
+                    # Las búsquedas siguientes de este RUT (agendar, cancelar...) no vuelven a la API
+                    guardar_paciente(rut_formateado, api['is_dentalink'], {**payload_paciente, **paciente_data})
+                    if contexto:
+                        contexto.registrar_paciente({**payload_paciente, **paciente_data}, api)
                 return {
                     "id": id_paciente,
                     "mensaje": f"Paciente creado exitosamente en {api['name']}",
@@ -771,7 +1828,8 @@ def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email
             elif response.status_code == 400 and "existe" in response.text.lower():
                 # Paciente duplicado, intentar buscar nuevamente
                 logging.info(f"⚠️ Paciente duplicado detectado en {api['name']}, buscando...")
-                paciente_existente = search_user(rut_formateado, id_sucursal)
+                invalidar_cache_pacientes(rut_formateado)  # La caché pudo tenerlo como no encontrado
+                paciente_existente = search_user(rut_formateado, id_sucursal, contexto)
                 if "id" in paciente_existente:
                     return {
                         "id": paciente_existente["id"],
@@ -789,40 +1847,640 @@ def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email
             errores.append(error_msg)
             continue
     
-    # Si llegamos aquí, falló en todas las APIs
-    return {
-        "error": "No se pudo crear el paciente en ninguna API",
-        "detalles": errores
-    }
+    # Si llegamos aquí, falló en todas las APIs
+    return {
+        "error": "No se pudo crear el paciente en ninguna API",
+        "detalles": errores
+    }
+
+@app.route('/create_user', methods=['POST'])
+def endpoint_create_user():
+    """Endpoint para crear paciente"""
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "No se proporcionaron datos"}), 400
+    
+    nombre = data.get("nombre")
+    apellidos = data.get("apellidos")
+    rut = data.get("rut")
+    telefono = data.get("telefono", "")
+    email = data.get("email", "")
+    id_sucursal = extraer_id(data.get("id_sucursal"))
+    
+    resultado = create_user(nombre, apellidos, rut, telefono, email, id_sucursal)
+    
+    if "error" in resultado:
+        return jsonify(resultado), 400
+    
+    return jsonify(resultado)
+
+# ============================
+# COLA PERSISTENTE DE SINCRONIZACIÓN GHL
+# ============================
+
+# Archivo SQLite de la cola: los trabajos pendientes sobreviven a un reinicio del proceso
+GHL_COLA_ARCHIVO = os.getenv('GHL_COLA_ARCHIVO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ghl_cola.sqlite3'))
+GHL_WORKERS = int(os.getenv('GHL_WORKERS', '2'))
+GHL_MAX_INTENTOS = int(os.getenv('GHL_MAX_INTENTOS', '6'))
+# Espera antes del reintento n: GHL_BACKOFF_BASE * 2^(n-1) segundos (±20%), como mucho GHL_BACKOFF_MAX
+GHL_BACKOFF_BASE = float(os.getenv('GHL_BACKOFF_BASE', '5'))
+GHL_BACKOFF_MAX = float(os.getenv('GHL_BACKOFF_MAX', '900'))
+# Segundos que un trabajo tomado queda reservado; si el worker muere, otro lo retoma al vencer.
+# Mientras el trabajo corre, un latido la renueva cada GHL_RESERVA / 3: un trabajo lento
+# (esperas del límite de GHL, Retry-After, timeouts) nunca queda libre para otro worker
+GHL_RESERVA = float(os.getenv('GHL_RESERVA', '300'))
+GHL_COLA_ESPERA = 2.0  # Cada cuánto revisa la cola un worker sin trabajo
+
+class ErrorSincronizacionGHL(Exception):
+    """GHL respondió con error; reintentable=False manda el trabajo directo al dead letter"""
+    
+    def __init__(self, mensaje: str, reintentable: bool = True):
+        super().__init__(mensaje)
+        self.reintentable = reintentable
+
+def status_reintentable_ghl(status_code: int) -> bool:
+    """429 y 5xx son transitorios; el resto de los 4xx no se arreglan reintentando"""
+    return status_code == 429 or status_code >= 500
+
+_aviso_cola_ghl = threading.Event()
+_workers_ghl: List[threading.Thread] = []
+_workers_ghl_lock = threading.Lock()
+
+# Contadores de este proceso desde que arrancó
+_contadores_ghl = {"encolados": 0, "sincronizados": 0, "reintentos": 0, "dead_letter": 0}
+_contadores_ghl_lock = threading.Lock()
+
+def _contar_ghl(campo: str) -> None:
+    with _contadores_ghl_lock:
+        _contadores_ghl[campo] += 1
+
+def _conexion_cola_ghl() -> sqlite3.Connection:
+    """Conexión nueva en modo autocommit; las transacciones se abren explícitamente"""
+    return sqlite3.connect(GHL_COLA_ARCHIVO, timeout=30, isolation_level=None)
+
+def _inicializar_cola_ghl() -> None:
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.executescript("""
+            CREATE TABLE IF NOT EXISTS ghl_cola (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                datos TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                creado_en REAL NOT NULL,
+                disponible_en REAL NOT NULL,
+                reservado_hasta REAL NOT NULL DEFAULT 0,
+                ultimo_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ghl_cola_disponible ON ghl_cola (disponible_en);
+            CREATE TABLE IF NOT EXISTS ghl_dead_letter (
+                id INTEGER PRIMARY KEY,
+                datos TEXT NOT NULL,
+                intentos INTEGER NOT NULL,
+                creado_en REAL NOT NULL,
+                descartado_en REAL NOT NULL,
+                ultimo_error TEXT
+            );
+        """)
+
+def encolar_sincronizacion_ghl(datos: Dict[str, Any]) -> bool:
+    """
+    Guarda un trabajo de sincronización en la cola y despierta a los workers.
+    
+    Returns:
+        bool: False si no se pudo guardar (queda en el log para reprocesarlo a mano)
+    """
+    ahora = time.time()
+    try:
+        with closing(_conexion_cola_ghl()) as conexion:
+            conexion.execute(
+                "INSERT INTO ghl_cola (datos, creado_en, disponible_en) VALUES (?, ?, ?)",
+                (json.dumps(datos, ensure_ascii=False), ahora, ahora)
+            )
+    except sqlite3.Error as e:
+        logging.error(f"❌ No se pudo encolar sincronización GHL ({e}): {json.dumps(datos, ensure_ascii=False)}")
+        return False
+    
+    _contar_ghl("encolados")
+    _aviso_cola_ghl.set()
+    return True
+
+def _tomar_trabajo_ghl() -> Optional[Tuple[int, Dict[str, Any], int]]:
+    """Reserva el trabajo disponible más antiguo; (id, datos, intentos previos) o None"""
+    ahora = time.time()
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        fila = conexion.execute(
+            "SELECT id, datos, intentos FROM ghl_cola WHERE disponible_en <= ? AND reservado_hasta <= ? "
+            "ORDER BY disponible_en, id LIMIT 1",
+            (ahora, ahora)
+        ).fetchone()
+        if fila:
+            conexion.execute("UPDATE ghl_cola SET reservado_hasta = ? WHERE id = ?", (ahora + GHL_RESERVA, fila[0]))
+        conexion.execute("COMMIT")
+    if not fila:
+        return None
+    return fila[0], json.loads(fila[1]), fila[2]
+
+def _renovar_reserva_ghl(id_trabajo: int, terminado: threading.Event) -> None:
+    """Latido: extiende la reserva del trabajo hasta que el worker avise que terminó"""
+    while not terminado.wait(GHL_RESERVA / 3):
+        try:
+            with closing(_conexion_cola_ghl()) as conexion:
+                conexion.execute("UPDATE ghl_cola SET reservado_hasta = ? WHERE id = ?",
+                                 (time.time() + GHL_RESERVA, id_trabajo))
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ No se pudo renovar la reserva del trabajo GHL {id_trabajo}: {e}")
+
+def _completar_trabajo_ghl(id_trabajo: int) -> None:
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("DELETE FROM ghl_cola WHERE id = ?", (id_trabajo,))
+    _contar_ghl("sincronizados")
+
+def _registrar_fallo_ghl(id_trabajo: int, intentos: int, error: Exception) -> None:
+    """Reprograma el trabajo con backoff exponencial o lo pasa al dead letter"""
+    mensaje = f"{type(error).__name__}: {error}"
+    reintentable = getattr(error, "reintentable", True)
+    
+    with closing(_conexion_cola_ghl()) as conexion:
+        if reintentable and intentos < GHL_MAX_INTENTOS:
+            espera = min(GHL_BACKOFF_MAX, GHL_BACKOFF_BASE * 2 ** (intentos - 1)) * random.uniform(0.8, 1.2)
+            conexion.execute(
+                "UPDATE ghl_cola SET intentos = ?, disponible_en = ?, reservado_hasta = 0, ultimo_error = ? WHERE id = ?",
+                (intentos, time.time() + espera, mensaje, id_trabajo)
+            )
+            _contar_ghl("reintentos")
+            logging.warning(f"🔁 Sincronización GHL {id_trabajo} falló (intento {intentos}/{GHL_MAX_INTENTOS}): "
+                            f"{mensaje}; reintento en {espera:.0f}s")
+            return
+        
+        conexion.execute("BEGIN IMMEDIATE")
+        conexion.execute(
+            "INSERT OR REPLACE INTO ghl_dead_letter (id, datos, intentos, creado_en, descartado_en, ultimo_error) "
+            "SELECT id, datos, ?, creado_en, ?, ? FROM ghl_cola WHERE id = ?",
+            (intentos, time.time(), mensaje, id_trabajo)
+        )
+        conexion.execute("DELETE FROM ghl_cola WHERE id = ?", (id_trabajo,))
+        conexion.execute("COMMIT")
+    _contar_ghl("dead_letter")
+    logging.error(f"❌ Sincronización GHL {id_trabajo} enviada al dead letter tras {intentos} intentos: {mensaje}")
+
+def _worker_ghl() -> None:
+    """Toma trabajos de la cola uno a uno; sin trabajo, espera un aviso o GHL_COLA_ESPERA"""
+    while True:
+        try:
+            trabajo = _tomar_trabajo_ghl()
+        except sqlite3.Error as e:
+            logging.error(f"❌ Error leyendo la cola GHL: {e}")
+            time.sleep(GHL_COLA_ESPERA)
+            continue
+        
+        if trabajo is None:
+            _aviso_cola_ghl.wait(GHL_COLA_ESPERA)
+            _aviso_cola_ghl.clear()
+            continue
+        
+        id_trabajo, datos, intentos = trabajo
+        terminado = threading.Event()
+        latido = threading.Thread(target=_renovar_reserva_ghl, args=(id_trabajo, terminado),
+                                  name=f"ghl-reserva-{id_trabajo}", daemon=True)
+        latido.start()
+        try:
+            _ejecutar_sincronizacion_ghl(datos)
+        except Exception as e:
+            resultado = e
+        else:
+            resultado = None
+        finally:
+            # El latido se detiene antes de tocar la fila para no pisar reservado_hasta = 0
+            terminado.set()
+            latido.join()
+        
+        try:
+            if resultado is None:
+                _completar_trabajo_ghl(id_trabajo)
+            else:
+                _registrar_fallo_ghl(id_trabajo, intentos + 1, resultado)
+        except sqlite3.Error as e:
+            # La reserva vence sola y el trabajo se vuelve a tomar
+            logging.error(f"❌ Error actualizando la cola GHL para el trabajo {id_trabajo}: {e}")
+
+def iniciar_workers_ghl() -> None:
+    """Crea la cola si no existe y arranca GHL_WORKERS hilos (una sola vez por proceso)"""
+    with _workers_ghl_lock:
+        if _workers_ghl:
+            return
+        try:
+            _inicializar_cola_ghl()
+        except sqlite3.Error as e:
+            logging.error(f"❌ No se pudo abrir la cola GHL en {GHL_COLA_ARCHIVO}: {e}")
+            return
+        for numero in range(GHL_WORKERS):
+            worker = threading.Thread(target=_worker_ghl, name=f"ghl-sync-{numero}", daemon=True)
+            worker.start()
+            _workers_ghl.append(worker)
+    logging.info(f"🧵 {GHL_WORKERS} workers de sincronización GHL iniciados ({GHL_COLA_ARCHIVO})")
+
+def metricas_cola_ghl() -> Dict[str, Any]:
+    """Profundidad de la cola y del dead letter, más los contadores de este proceso"""
+    ahora = time.time()
+    with closing(_conexion_cola_ghl()) as conexion:
+        pendientes, en_proceso, en_reintento, creado_mas_antiguo = conexion.execute(
+            "SELECT COUNT(*), COALESCE(SUM(reservado_hasta > ?), 0), COALESCE(SUM(intentos > 0), 0), MIN(creado_en) "
+            "FROM ghl_cola",
+            (ahora,)
+        ).fetchone()
+        dead_letter = conexion.execute("SELECT COUNT(*) FROM ghl_dead_letter").fetchone()[0]
+    with _contadores_ghl_lock:
+        contadores = dict(_contadores_ghl)
+    return {
+        "pendientes": pendientes,
+        "en_proceso": en_proceso,
+        "en_reintento": en_reintento,
+        "antiguedad_max_s": round(ahora - creado_mas_antiguo, 1) if creado_mas_antiguo else 0,
+        "dead_letter": dead_letter,
+        "workers": len(_workers_ghl),
+        "proceso": contadores,
+        "contactos": _coalescedor_contactos_ghl.metricas(),
+        "limite": metricas_limite_ghl()
+    }
+
+def reencolar_dead_letter_ghl(ids: List[int] = None) -> int:
+    """Devuelve a la cola los trabajos del dead letter (todos o los ids indicados); retorna cuántos"""
+    filtro, parametros = "", ()
+    if ids:
+        filtro = f" WHERE id IN ({', '.join('?' for _ in ids)})"
+        parametros = tuple(ids)
+    ahora = time.time()
+    with closing(_conexion_cola_ghl()) as conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        cantidad = conexion.execute(
+            "INSERT INTO ghl_cola (datos, creado_en, disponible_en) "
+            f"SELECT datos, creado_en, ? FROM ghl_dead_letter{filtro}",
+            (ahora, *parametros)
+        ).rowcount
+        conexion.execute(f"DELETE FROM ghl_dead_letter{filtro}", parametros)
+        conexion.execute("COMMIT")
+    if cantidad:
+        _aviso_cola_ghl.set()
+    return cantidad
+
+# ============================
+# LÍMITE DE PETICIONES A GHL
+# ============================
+
+# GHL admite unas 100 peticiones cada 10 segundos por location
+GHL_LIMITE_PETICIONES = int(os.getenv('GHL_LIMITE_PETICIONES', '100'))
+GHL_LIMITE_VENTANA = float(os.getenv('GHL_LIMITE_VENTANA', '10'))
+# Máximo que una llamada espera su turno antes de desistir
+GHL_LIMITE_ESPERA_MAXIMA = float(os.getenv('GHL_LIMITE_ESPERA_MAXIMA', '60'))
+GHL_REINTENTOS_429 = int(os.getenv('GHL_REINTENTOS_429', '1'))
+
+class CuboTokensGHL:
+    """
+    Token bucket de una location: GHL_LIMITE_PETICIONES tokens que se recargan de forma
+    continua a lo largo de GHL_LIMITE_VENTANA segundos. Mientras haya llamadas
+    interactivas esperando, las de segundo plano ceden el turno. Un 429 pausa el cubo
+    entero durante el Retry-After que indicó GHL.
+    """
+    
+    def __init__(self, capacidad: int, ventana: float):
+        self.capacidad = capacidad
+        self.recarga_por_s = capacidad / ventana
+        self._tokens = float(capacidad)
+        self._actualizado = time.monotonic()
+        self._pausado_hasta = 0.0
+        self._restante_ghl: Optional[int] = None  # Último X-RateLimit-Remaining informado por GHL
+        self._esperando = {True: 0, False: 0}     # Llamadas en espera: interactivas / segundo plano
+        self._contadores = {"llamadas": 0, "con_espera": 0, "sin_turno": 0, "respuestas_429": 0}
+        self._condicion = threading.Condition()
+    
+    def _recargar(self, ahora: float) -> None:
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._actualizado) * self.recarga_por_s)
+        self._actualizado = ahora
+    
+    def tomar(self, interactiva: bool, espera_maxima: float) -> bool:
+        """Espera un token; retorna False si no lo consiguió dentro de espera_maxima"""
+        limite = time.monotonic() + espera_maxima
+        espero = False
+        with self._condicion:
+            self._esperando[interactiva] += 1
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._recargar(ahora)
+                    cede = not interactiva and self._esperando[True] > 0
+                    if ahora >= self._pausado_hasta and self._tokens >= 1 and not cede:
+                        self._tokens -= 1
+                        self._contadores["llamadas"] += 1
+                        if espero:
+                            self._contadores["con_espera"] += 1
+                        return True
+                    if ahora >= limite:
+                        self._contadores["sin_turno"] += 1
+                        return False
+                    
+                    if ahora < self._pausado_hasta:
+                        espera = self._pausado_hasta - ahora
+                    elif cede:
+                        espera = limite - ahora  # Despierta cuando una interactiva toma su token
+                    else:
+                        espera = (1 - self._tokens) / self.recarga_por_s
+                    espero = True
+                    self._condicion.wait(min(espera, limite - ahora))
+            finally:
+                self._esperando[interactiva] -= 1
+                self._condicion.notify_all()
+    
+    def registrar_respuesta(self, respuesta: requests.Response) -> None:
+        """Ajusta el cubo con los headers de GHL; en un 429 lo pausa según Retry-After"""
+        with self._condicion:
+            restante = respuesta.headers.get("X-RateLimit-Remaining")
+            if restante is not None and restante.isdigit():
+                self._restante_ghl = int(restante)
+                self._recargar(time.monotonic())
+                self._tokens = min(self._tokens, float(self._restante_ghl))
+            if respuesta.status_code == 429:
+                self._contadores["respuestas_429"] += 1
+                pausa = segundos_retry_after(respuesta)
+                self._pausado_hasta = max(self._pausado_hasta, time.monotonic() + pausa)
+                self._tokens = 0.0
+                logging.warning(f"⏳ GHL respondió 429: llamadas pausadas {pausa:.1f}s")
+    
+    def metricas(self) -> Dict[str, Any]:
+        with self._condicion:
+            ahora = time.monotonic()
+            self._recargar(ahora)
+            return {
+                "tokens_disponibles": int(self._tokens),
+                "capacidad": self.capacidad,
+                "restante_ghl": self._restante_ghl,
+                "pausado_s": round(max(0.0, self._pausado_hasta - ahora), 1),
+                "en_espera": {"interactivas": self._esperando[True], "segundo_plano": self._esperando[False]},
+                **self._contadores
+            }
+
+def segundos_retry_after(respuesta: requests.Response) -> float:
+    """Segundos del header Retry-After (número o fecha HTTP); sin header, una ventana completa"""
+    valor = respuesta.headers.get("Retry-After")
+    if valor:
+        try:
+            return max(0.0, float(valor))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return GHL_LIMITE_VENTANA
+
+_cubos_ghl: Dict[str, CuboTokensGHL] = {}
+_cubos_ghl_lock = threading.Lock()
+
+def cubo_ghl(location_id: str) -> CuboTokensGHL:
+    with _cubos_ghl_lock:
+        cubo = _cubos_ghl.get(location_id)
+        if cubo is None:
+            cubo = _cubos_ghl[location_id] = CuboTokensGHL(GHL_LIMITE_PETICIONES, GHL_LIMITE_VENTANA)
+        return cubo
+
+def http_ghl(method: str, url: str, interactiva: bool = False, location_id: str = None, **kwargs) -> requests.Response:
+    """
+    Petición a GHL que respeta el límite de la location. Ante un 429 espera el
+    Retry-After y reintenta hasta GHL_REINTENTOS_429 veces.
+    
+    Raises:
+        ErrorSincronizacionGHL: si no hubo turno dentro de GHL_LIMITE_ESPERA_MAXIMA (reintentable)
+    """
+    cubo = cubo_ghl(location_id or GHL_LOCATION_ID)
+    for _ in range(GHL_REINTENTOS_429 + 1):
+        if not cubo.tomar(interactiva, GHL_LIMITE_ESPERA_MAXIMA):
+            raise ErrorSincronizacionGHL(f"Sin turno para llamar a GHL tras {GHL_LIMITE_ESPERA_MAXIMA:.0f}s")
+        respuesta = http_request(method, url, **kwargs)
+        cubo.registrar_respuesta(respuesta)
+        if respuesta.status_code != 429:
+            break
+    return respuesta
 
-@app.route('/create_user', methods=['POST'])
-def endpoint_create_user():
-    """Endpoint para crear paciente"""
-    data = request.get_json()
-    if not data:
-        return jsonify({"error": "No se proporcionaron datos"}), 400
+def metricas_limite_ghl() -> Dict[str, Dict[str, Any]]:
+    """Presupuesto restante de cada location usada por este proceso"""
+    with _cubos_ghl_lock:
+        cubos = dict(_cubos_ghl)
+    return {location_id: cubo.metricas() for location_id, cubo in cubos.items()}
+
+# ============================
+# CACHÉ DEL CALENDAR GHL
+# ============================
+
+# Segundos que se reutiliza el assignedUserId del calendar (sus teamMembers casi nunca cambian)
+GHL_CALENDAR_CACHE_TTL = int(os.getenv('GHL_CALENDAR_CACHE_TTL', '3600'))
+
+_calendar_ghl_assigned_user_id: Optional[str] = None
+_calendar_ghl_expira_en: float = 0.0
+_calendar_ghl_lock = threading.Lock()
+
+def _descargar_assigned_user_id_ghl() -> str:
+    """
+    Consulta GET calendars/{id} y retorna el userId del primer teamMember.
     
-    nombre = data.get("nombre")
-    apellidos = data.get("apellidos")
-    rut = data.get("rut")
-    telefono = data.get("telefono", "")
-    email = data.get("email", "")
-    id_sucursal = extraer_id(data.get("id_sucursal"))
+    Raises:
+        ErrorSincronizacionGHL: si GHL respondió con error o el calendar no tiene teamMembers
+    """
+    calendar_resp = http_ghl("GET", f"https://services.leadconnectorhq.com/calendars/{GHL_CALENDAR_ID}",
+                             headers=cabeceras_ghl("2021-04-15"))
+    if calendar_resp.status_code != 200:
+        raise ErrorSincronizacionGHL(f"Obteniendo calendar: {calendar_resp.status_code} - {calendar_resp.text[:200]}",
+                                     status_reintentable_ghl(calendar_resp.status_code))
+    
+    assigned_user_id = assigned_user_id_de_calendar(calendar_resp)
+    if not assigned_user_id:
+        # Es configuración del calendar: reintentar no lo arregla
+        raise ErrorSincronizacionGHL("No se pudo obtener assignedUserId del calendar", reintentable=False)
+    return assigned_user_id
+
+def obtener_assigned_user_id_ghl() -> str:
+    """
+    Retorna el assignedUserId de los appointments desde la caché; si venció (o fue
+    invalidada) lo vuelve a descargar. Los workers que llegan durante la descarga
+    esperan su resultado en vez de repetir la consulta.
     
-    resultado = create_user(nombre, apellidos, rut, telefono, email, id_sucursal)
+    Raises:
+        ErrorSincronizacionGHL / requests.exceptions.RequestException: si la descarga falla
+    """
+    global _calendar_ghl_assigned_user_id, _calendar_ghl_expira_en
     
-    if "error" in resultado:
-        return jsonify(resultado), 400
+    with _calendar_ghl_lock:
+        if _calendar_ghl_assigned_user_id and time.monotonic() < _calendar_ghl_expira_en:
+            return _calendar_ghl_assigned_user_id
+        
+        assigned_user_id = _descargar_assigned_user_id_ghl()
+        _calendar_ghl_assigned_user_id = assigned_user_id
+        _calendar_ghl_expira_en = time.monotonic() + GHL_CALENDAR_CACHE_TTL
+    logging.info(f"🔄 assignedUserId del calendar GHL actualizado: {assigned_user_id}")
+    return assigned_user_id
+
+def invalidar_calendar_ghl() -> None:
+    """Descarta el assignedUserId en caché; el próximo appointment vuelve a consultar el calendar"""
+    global _calendar_ghl_assigned_user_id, _calendar_ghl_expira_en
+    with _calendar_ghl_lock:
+        _calendar_ghl_assigned_user_id = None
+        _calendar_ghl_expira_en = 0.0
+    logging.info("🗑️ Caché del calendar GHL invalidada")
+
+def precargar_calendar_ghl() -> None:
+    """Carga el calendar al iniciar; si falla, el primer trabajo de la cola lo reintenta"""
+    try:
+        obtener_assigned_user_id_ghl()
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudo precargar el calendar GHL: {e}")
+
+# ============================
+# AGRUPACIÓN DE ACTUALIZACIONES DE CONTACTOS GHL
+# ============================
+
+# Segundos que se esperan más cambios de un mismo contacto antes de enviar un único PUT
+GHL_CONTACTO_VENTANA = float(os.getenv('GHL_CONTACTO_VENTANA', '1.5'))
+
+def _clave_custom_field(campo: Dict[str, Any]) -> Any:
+    return campo.get("key") or campo.get("id")
+
+def fusionar_payload_contacto_ghl(base: Dict[str, Any], cambios: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Aplica `cambios` sobre `base` (bodies de PUT contacts/{id}). Los customFields se
+    combinan por key/id y el resto de los campos se reemplaza: siempre gana el último valor.
+    """
+    fusion = dict(base)
+    for campo, valor in cambios.items():
+        if campo != "customFields":
+            fusion[campo] = valor
+            continue
+        custom_fields = {_clave_custom_field(c): c for c in fusion.get("customFields", [])}
+        for custom_field in valor:
+            custom_fields.pop(_clave_custom_field(custom_field), None)
+            custom_fields[_clave_custom_field(custom_field)] = custom_field
+        fusion["customFields"] = list(custom_fields.values())
+    return fusion
+
+class _LoteContactoGHL:
+    """Cambios acumulados de un contacto y los futuros de quienes esperan su PUT"""
     
-    return jsonify(resultado)
+    def __init__(self):
+        self.payload: Dict[str, Any] = {}
+        self.futuros: List[Future] = []
+        self.vencido = False  # Ya pasó su ventana, pero había otro PUT del contacto en curso
+
+class CoalescedorContactosGHL:
+    """
+    Agrupa las actualizaciones de un mismo contacto que llegan dentro de la ventana y
+    las envía en un solo PUT. Los PUT de un contacto nunca se solapan: lo que llega
+    mientras uno está en curso forma un lote nuevo que sale después, así el último
+    valor escrito es el que queda en GHL.
+    """
+    
+    def __init__(self, ventana: float):
+        self.ventana = ventana
+        self._lotes: Dict[str, _LoteContactoGHL] = {}
+        self._enviando = set()
+        self._lock = threading.Lock()
+        self._contadores = {"actualizaciones": 0, "envios": 0}
+    
+    def actualizar(self, contact_id: str, cambios: Dict[str, Any]) -> Future:
+        """Suma los cambios al lote del contacto; el futuro se resuelve con la respuesta del PUT"""
+        futuro = Future()
+        with self._lock:
+            self._contadores["actualizaciones"] += 1
+            lote = self._lotes.get(contact_id)
+            nuevo = lote is None
+            if nuevo:
+                lote = self._lotes[contact_id] = _LoteContactoGHL()
+            lote.payload = fusionar_payload_contacto_ghl(lote.payload, cambios)
+            lote.futuros.append(futuro)
+        
+        if nuevo:
+            temporizador = threading.Timer(self.ventana, self._vaciar, args=(contact_id,))
+            temporizador.daemon = True
+            temporizador.start()
+        return futuro
+    
+    def _vaciar(self, contact_id: str) -> None:
+        """Envía el lote del contacto y, si mientras tanto venció otro, también ese"""
+        while True:
+            with self._lock:
+                lote = self._lotes.get(contact_id)
+                if lote is None:
+                    return
+                if contact_id in self._enviando:
+                    # Lo envía el hilo del PUT en curso apenas termine
+                    lote.vencido = True
+                    return
+                del self._lotes[contact_id]
+                self._enviando.add(contact_id)
+                self._contadores["envios"] += 1
+            
+            self._enviar(contact_id, lote)
+            
+            with self._lock:
+                self._enviando.discard(contact_id)
+                siguiente = self._lotes.get(contact_id)
+                if siguiente is None or not siguiente.vencido:
+                    return
+    
+    def _enviar(self, contact_id: str, lote: _LoteContactoGHL) -> None:
+        if len(lote.futuros) > 1:
+            logging.info(f"🧩 {len(lote.futuros)} actualizaciones del contacto {contact_id} en un solo PUT")
+        try:
+            contact_resp = http_ghl("PUT", f"https://services.leadconnectorhq.com/contacts/{contact_id}",
+                                    headers=cabeceras_ghl("2021-07-28"), json=lote.payload)
+        except Exception as e:
+            for futuro in lote.futuros:
+                futuro.set_exception(e)
+            return
+        for futuro in lote.futuros:
+            futuro.set_result(contact_resp)
+    
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._contadores, "pendientes": len(self._lotes), "ventana_s": self.ventana}
+
+_coalescedor_contactos_ghl = CoalescedorContactosGHL(GHL_CONTACTO_VENTANA)
+
+def actualizar_contacto_ghl(contact_id: str, cambios: Dict[str, Any]) -> Future:
+    """PUT contacts/{id} agrupado con los demás cambios del contacto dentro de la ventana"""
+    return _coalescedor_contactos_ghl.actualizar(contact_id, cambios)
 
 # ============================
 # FUNCIÓN 4: AGENDAR CITA
 # ============================
 
+def payload_cita_api(es_dentalink: bool, id_paciente: int, id_profesional: int, id_sucursal: int, fecha: str,
+                     hora_inicio: str, duracion: int, comentario: str = "") -> Dict[str, Any]:
+    """Body de POST citas/: Dentalink usa id_dentista; Medilink id_profesional y videoconsulta"""
+    if es_dentalink:
+        return {
+            "id_dentista": id_profesional,
+            "id_sucursal": id_sucursal,
+            "id_estado": 7,  # Estado confirmado
+            "id_sillon": 1,
+            "id_paciente": id_paciente,
+            "fecha": fecha,
+            "hora_inicio": hora_inicio,
+            "duracion": duracion,
+            "comentario": comentario or "Cita agendada por Sistema"
+        }
+    return {
+        "id_profesional": id_profesional,
+        "id_sucursal": id_sucursal,
+        "id_estado": 7,  # Estado confirmado
+        "id_sillon": 1,
+        "id_paciente": id_paciente,
+        "fecha": fecha,
+        "hora_inicio": hora_inicio,
+        "duracion": duracion,
+        "comentario": comentario or "Cita agendada por Sistema",
+        "videoconsulta": 0
+    }
+
 def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int, fecha: str, 
                         hora_inicio: str, user_id: str, tiempo_cita: int = None, 
-                        comentario: str = "") -> Dict[str, Any]:
+                        comentario: str = "", contexto: ContextoAgendamiento = None) -> Dict[str, Any]:
     """
     Agenda una cita en Medilink/Dentalink.
     
@@ -835,36 +2493,18 @@ def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int
         tiempo_cita: Duración en minutos (opcional, usa intervalo del profesional)
         comentario: Comentario para la cita (opcional)
         user_id: ContactId en GHL (requerido para integración)
+        contexto: Contexto de la petición (opcional); se comparte con la integración GHL
     
     Returns:
         Dict con los datos de la cita creada o error
     """
     logging.info(f"📅 Agendando cita para paciente {id_paciente} con profesional {id_profesional}")
     
-    # Determinar APIs a intentar
-    api_base, headers_api, usa_dentalink = determinar_api_por_sucursal(id_sucursal)
-    api_name = obtener_nombre_api(id_sucursal)
-    
-    apis_a_intentar = [
-        {
-            "name": api_name,
-            "base": api_base,
-            "headers": headers_api,
-            "is_dentalink": usa_dentalink
-        }
-    ]
-    
-    # Agregar API alternativa como fallback
-    api_alt_name = "Medilink v5" if usa_dentalink else "Dentalink v1"
-    api_alt_base = MEDILINK_API_URL if usa_dentalink else DENTALINK_API_URL
-    api_alt_headers = MEDILINK_HEADERS if usa_dentalink else DENTALINK_HEADERS
+    contexto = contexto or ContextoAgendamiento()
     
-    apis_a_intentar.append({
-        "name": api_alt_name,
-        "base": api_alt_base,
-        "headers": api_alt_headers,
-        "is_dentalink": not usa_dentalink
-    })
+    # Determinar APIs a intentar: la del paciente si ya se conoce; si no, la aprendida para
+    # el profesional/sucursal; la alternativa siempre queda como fallback
+    apis_a_intentar = contexto.ordenar_apis(apis_en_orden(id_sucursal, id_profesional))
     
     # Obtener duración de la cita
     duracion = None
@@ -876,33 +2516,15 @@ def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int
         # Intentar obtener intervalo del profesional
         intervalo_profesional = None
         
-        # Intentar primero en API principal
+        # Intentar primero en API principal (desde la caché de profesionales)
         for api in apis_a_intentar:
-            try:
-                if api['is_dentalink']:
-                    logging.info(f"🔍 Obteniendo intervalo del dentista {id_profesional} desde {api['name']}")
-                    prof_resp = requests.get(f"{api['base']}dentistas", headers=api['headers'])
-                    if prof_resp.status_code == 200:
-                        dentistas = prof_resp.json().get("data", [])
-                        for dentista in dentistas:
-                            if dentista.get("id") == id_profesional:
-                                intervalo_profesional = dentista.get("intervalo")
-                                logging.info(f"✅ Intervalo encontrado en {api['name']}: {intervalo_profesional} min")
-                                break
-                        if intervalo_profesional:
-                            break
-                else:
-                    logging.info(f"🔍 Obteniendo intervalo del profesional {id_profesional} desde {api['name']}")
-                    prof_resp = requests.get(f"{api['base']}profesionales/{id_profesional}", headers=api['headers'])
-                    if prof_resp.status_code == 200:
-                        prof_data = prof_resp.json().get("data", {})
-                        intervalo_profesional = prof_data.get("intervalo")
-                        if intervalo_profesional:
-                            logging.info(f"✅ Intervalo encontrado en {api['name']}: {intervalo_profesional} min")
-                            break
-            except Exception as e:
-                logging.warning(f"⚠️ Error obteniendo intervalo en {api['name']}: {e}")
-                continue
+            profesional = resolver_profesionales([id_profesional], api['is_dentalink']).get(id_profesional)
+            if profesional:
+                contexto.profesional = profesional  # También da el nombre para GHL
+            if profesional and profesional.get("intervalo"):
+                intervalo_profesional = profesional["intervalo"]
+                logging.info(f"✅ Intervalo encontrado en {api['name']}: {intervalo_profesional} min")
+                break
         
         if intervalo_profesional:
             duracion = intervalo_profesional
@@ -917,46 +2539,25 @@ def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int
     for api in apis_a_intentar:
         try:
             # Crear payload según la API
-            if api['is_dentalink']:
-                payload_cita = {
-                    "id_dentista": id_profesional,
-                    "id_sucursal": id_sucursal,
-                    "id_estado": 7,  # Estado confirmado
-                    "id_sillon": 1,
-                    "id_paciente": id_paciente,
-                    "fecha": fecha,
-                    "hora_inicio": hora_inicio,
-                    "duracion": duracion,
-                    "comentario": comentario or "Cita agendada por Sistema"
-                }
-            else:
-                payload_cita = {
-                    "id_profesional": id_profesional,
-                    "id_sucursal": id_sucursal,
-                    "id_estado": 7,  # Estado confirmado
-                    "id_sillon": 1,
-                    "id_paciente": id_paciente,
-                    "fecha": fecha,
-                    "hora_inicio": hora_inicio,
-                    "duracion": duracion,
-                    "comentario": comentario or "Cita agendada por Sistema",
-                    "videoconsulta": 0
-                }
+            payload_cita = payload_cita_api(api['is_dentalink'], id_paciente, id_profesional, id_sucursal,
+                                            fecha, hora_inicio, duracion, comentario)
             
             logging.info(f"🔄 Intentando agendar cita en {api['name']}")
             logging.info(f"📋 Payload: {payload_cita}")
             
-            response = requests.post(f"{api['base']}citas/", headers=api['headers'], json=payload_cita)
+            response = http_post(f"{api['base']}citas/", headers=api['headers'], json=payload_cita)
             
             if response.status_code == 201:
                 cita_data = response.json().get("data", {})
                 id_cita = cita_data.get("id")
                 
                 logging.info(f"✅ Cita creada exitosamente en {api['name']} con ID {id_cita}")
+                registrar_ruta(api['is_dentalink'], id_sucursal, [id_profesional])
                 
-                # Integración con GHL en segundo plano (requerida)
+                # Integración con GHL en segundo plano (requerida), vía la cola persistente
                 if GHL_ACCESS_TOKEN:
-                    threading.Thread(target=_integrar_ghl, args=(user_id, fecha, hora_inicio, duracion, id_profesional, id_sucursal)).start()
+                    encolar_sincronizacion_ghl(datos_sincronizacion_ghl(user_id, fecha, hora_inicio, duracion,
+                                                                        id_profesional, id_sucursal, contexto))
                 else:
                     logging.warning("⚠️ GHL_ACCESS_TOKEN no configurado; se omite integración GHL")
                 
@@ -983,128 +2584,162 @@ def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int
         "detalles": errores
     }
 
-def _integrar_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, id_profesional: int, id_sucursal: int):
-    """Función auxiliar para integración con GHL en segundo plano"""
+def cabeceras_ghl(version: str) -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
+        "Content-Type": "application/json",
+        "Version": version
+    }
+
+def payload_contacto_ghl(nombre_profesional: str, nombre_sucursal: str) -> Dict[str, Any]:
+    """Custom fields doctor/clínica del contacto, usando keys"""
+    return {
+        "customFields": [
+            {"key": "doctor", "field_value": nombre_profesional},
+            {"key": "clinica", "field_value": nombre_sucursal}
+        ]
+    }
+
+def assigned_user_id_de_calendar(calendar_resp) -> Optional[str]:
+    """userId del primer teamMember de la respuesta de GET calendars/{id}, o None"""
+    try:
+        team_members = calendar_resp.json().get("calendar", {}).get("teamMembers", [])
+        if team_members:
+            # Usar el primer teamMember disponible
+            return team_members[0].get("userId")
+        logging.error("❌ No hay teamMembers en el calendar")
+    except Exception as e:
+        logging.error(f"❌ Error parseando respuesta del calendar: {e}")
+    return None
+
+def payload_appointment_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, assigned_user_id: str) -> Dict[str, Any]:
+    """Body de POST calendars/events/appointments con inicio/fin en hora de Santiago"""
+    tz_cl = pytz.timezone("America/Santiago")
+    naive_start = datetime.strptime(f"{fecha} {hora_inicio}", "%Y-%m-%d %H:%M")
+    inicio_dt = tz_cl.localize(naive_start)
+    fin_dt = inicio_dt + timedelta(minutes=duracion)
+    
+    offset = inicio_dt.strftime('%z')
+    offset_fmt = offset[:3] + ':' + offset[3:]
+    
+    return {
+        "title": "Cita Médica",
+        "overrideLocationConfig": True,
+        "appointmentStatus": "new",
+        "ignoreDateRange": True,
+        "ignoreFreeSlotValidation": True,
+        "calendarId": GHL_CALENDAR_ID,
+        "locationId": GHL_LOCATION_ID,
+        "assignedUserId": assigned_user_id,
+        "contactId": user_id,
+        "startTime": inicio_dt.strftime("%Y-%m-%dT%H:%M:%S") + offset_fmt,
+        "endTime": fin_dt.strftime("%Y-%m-%dT%H:%M:%S") + offset_fmt
+    }
+
+def _integrar_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, id_profesional: int, id_sucursal: int,
+                  contexto: ContextoAgendamiento = None):
+    """
+    Actualiza el contacto y crea el appointment en GHL. La ejecutan los workers de la cola.
+    
+    Raises:
+        ErrorSincronizacionGHL: si GHL respondió con error (reintentable o no según el status)
+        requests.exceptions.RequestException: error de conexión (se reintenta; en el POST del
+            appointment solo si no llegó a conectar, para no duplicarlo)
+    """
     try:
         if not GHL_ACCESS_TOKEN:
             return
         
-        headers_ghl = {
-            "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
-            "Content-Type": "application/json",
-            "Version": "2021-07-28"
-        }
+        headers_ghl = cabeceras_ghl("2021-07-28")
         
         # 1. Obtener nombres del profesional y sucursal
         nombre_profesional = f"Profesional {id_profesional}"
         nombre_sucursal = f"Sucursal {id_sucursal}"
         
+        contexto = contexto or ContextoAgendamiento()
         try:
-            # Obtener nombre del profesional desde Dentalink (que tiene todos los profesionales)
-            prof_resp = requests.get(f"{DENTALINK_API_URL}dentistas", headers=DENTALINK_HEADERS)
-            if prof_resp.status_code == 200:
-                profesionales = prof_resp.json().get("data", [])
-                for prof in profesionales:
-                    if prof.get("id") == id_profesional:
-                        apellido = prof.get('apellido') or prof.get('apellidos', '')
-                        nombre_profesional = f"{prof.get('nombre', 'Desconocido')} {apellido}".strip()
-                        break
+            # Obtener nombre del profesional: el ya resuelto al agendar o desde la caché
+            # (Dentalink primero, que tiene todos los profesionales)
+            if not contexto.profesional:
+                contexto.profesional = obtener_profesionales([id_profesional], True).get(id_profesional)
+            if contexto.profesional:
+                nombre_profesional = contexto.profesional["nombre"]
             
-            # Obtener nombre de la sucursal
-            suc_resp = requests.get(f"{MEDILINK_API_URL}sucursales/{id_sucursal}", headers=MEDILINK_HEADERS)
-            if suc_resp.status_code == 200:
-                nombre_sucursal = suc_resp.json().get("data", {}).get("nombre", nombre_sucursal)
+            # Obtener nombre de la sucursal desde el mapa precargado
+            if not contexto.nombre_sucursal:
+                contexto.nombre_sucursal = obtener_nombre_sucursal(id_sucursal)
+            nombre_sucursal = contexto.nombre_sucursal or nombre_sucursal
         except Exception as e:
             logging.warning(f"⚠️ Error obteniendo nombres: {e}")
         
         # 2. Actualizar contacto con doctor y clínica usando keys
-        update_payload = {
-            "customFields": [
-                {"key": "doctor", "field_value": nombre_profesional},
-                {"key": "clinica", "field_value": nombre_sucursal}
-            ]
-        }
+        update_payload = payload_contacto_ghl(nombre_profesional, nombre_sucursal)
         update_url = f"https://services.leadconnectorhq.com/contacts/{user_id}"
         logging.info(f"🌐 Actualizando contacto en: {update_url}")
         logging.info(f"📋 Payload contacto: {update_payload}")
         
-        contact_resp = requests.put(update_url, headers=headers_ghl, json=update_payload)
+        # Se espera el PUT (agrupado con otros cambios del contacto) antes de crear el appointment
+        contact_resp = actualizar_contacto_ghl(user_id, update_payload).result()
         logging.info(f"📊 Status Code contacto: {contact_resp.status_code}")
         
         if contact_resp.status_code == 200:
             logging.info(f"✅ Contacto actualizado en GHL: {nombre_profesional} - {nombre_sucursal}")
+        elif status_reintentable_ghl(contact_resp.status_code):
+            # Aún no se creó el appointment: se puede reintentar todo sin duplicar nada
+            raise ErrorSincronizacionGHL(f"Actualizando contacto: {contact_resp.status_code} - {contact_resp.text[:200]}")
         else:
             logging.error(f"❌ Error actualizando contacto en GHL: {contact_resp.status_code} - {contact_resp.text}")
         
-        # 3. Obtener assignedUserId del calendar
+        # 3. assignedUserId del calendar (en caché, solo se consulta al vencer)
+        assigned_user_id = obtener_assigned_user_id_ghl()
         headers_ghl["Version"] = "2021-04-15"
-        calendar_url = f"https://services.leadconnectorhq.com/calendars/{GHL_CALENDAR_ID}"
-        logging.info(f"🌐 Obteniendo calendar desde: {calendar_url}")
-        logging.info(f"🔑 Headers GHL: {headers_ghl}")
-        
-        calendar_resp = requests.get(calendar_url, headers=headers_ghl)
-        logging.info(f"📊 Status Code GHL Calendar: {calendar_resp.status_code}")
-        logging.info(f"📄 Response GHL Calendar: {calendar_resp.text[:1000]}...")  # Primeros 1000 caracteres
-        
-        assigned_user_id = None
-        if calendar_resp.status_code == 200:
-            try:
-                calendar_data = calendar_resp.json().get("calendar", {})
-                logging.info(f"📦 Calendar data keys: {list(calendar_data.keys()) if calendar_data else 'No calendar data'}")
-                
-                team_members = calendar_data.get("teamMembers", [])
-                logging.info(f"👥 Team members encontrados: {len(team_members)}")
-                logging.info(f"👥 Team members data: {team_members}")
-                
-                if team_members:
-                    # Usar el primer teamMember disponible
-                    assigned_user_id = team_members[0].get("userId")
-                    logging.info(f"✅ Obtenido assignedUserId del calendar: {assigned_user_id}")
-                else:
-                    logging.error("❌ No hay teamMembers en el calendar")
-            except Exception as e:
-                logging.error(f"❌ Error parseando respuesta del calendar: {e}")
-        else:
-            logging.error(f"❌ Error obteniendo calendar: {calendar_resp.status_code}")
-            logging.error(f"📄 Error response: {calendar_resp.text}")
-        
-        if not assigned_user_id:
-            logging.error("❌ No se pudo obtener assignedUserId del calendar")
-            return
         
         # 4. Crear appointment en GHL
-        tz_cl = pytz.timezone("America/Santiago")
-        naive_start = datetime.strptime(f"{fecha} {hora_inicio}", "%Y-%m-%d %H:%M")
-        inicio_dt = tz_cl.localize(naive_start)
-        fin_dt = inicio_dt + timedelta(minutes=duracion)
-        
-        offset = inicio_dt.strftime('%z')
-        offset_fmt = offset[:3] + ':' + offset[3:]
-        
-        appointment_payload = {
-            "title": "Cita Médica",
-            "overrideLocationConfig": True,
-            "appointmentStatus": "new",
-            "ignoreDateRange": True,
-            "ignoreFreeSlotValidation": True,
-            "calendarId": GHL_CALENDAR_ID,
-            "locationId": GHL_LOCATION_ID,
-            "assignedUserId": assigned_user_id,
-            "contactId": user_id,
-            "startTime": inicio_dt.strftime("%Y-%m-%dT%H:%M:%S") + offset_fmt,
-            "endTime": fin_dt.strftime("%Y-%m-%dT%H:%M:%S") + offset_fmt
-        }
+        appointment_payload = payload_appointment_ghl(user_id, fecha, hora_inicio, duracion, assigned_user_id)
         
-        appt_resp = requests.post("https://services.leadconnectorhq.com/calendars/events/appointments", 
+        # El POST no es idempotente: si GHL pudo haberlo procesado (timeout de lectura,
+        # conexión cortada o 5xx) reintentar duplicaría el appointment, así que esos
+        # fallos van directo al dead letter para revisarlos antes de reencolar
+        try:
+            appt_resp = http_ghl("POST", "https://services.leadconnectorhq.com/calendars/events/appointments",
                                  headers=headers_ghl, json=appointment_payload)
+        except (requests.exceptions.ConnectTimeout, UpstreamOmitido):
+            raise  # No llegó a enviarse: GHL no recibió nada y se puede reintentar
+        except requests.exceptions.RequestException as e:
+            raise ErrorSincronizacionGHL(f"Creando appointment: sin respuesta de GHL ({e}), "
+                                         f"revisar si se creó antes de reencolar", reintentable=False)
         
         if appt_resp.status_code == 201:
             logging.info("✅ Appointment creado en GHL")
         else:
-            logging.error(f"❌ Error creando appointment GHL: {appt_resp.status_code} - {appt_resp.text}")
+            # Un 4xx (salvo 429) puede venir de un teamMember que ya no existe: el próximo
+            # trabajo vuelve a leer el calendar. Un 429 o un 5xx no dicen nada del calendar
+            if 400 <= appt_resp.status_code < 500 and appt_resp.status_code != 429:
+                invalidar_calendar_ghl()
+            # Solo un 429 garantiza que GHL rechazó la petición sin procesarla
+            raise ErrorSincronizacionGHL(f"Creando appointment: {appt_resp.status_code} - {appt_resp.text[:200]}",
+                                         appt_resp.status_code == 429)
         
     except Exception as e:
         logging.error(f"❌ Error en integración GHL: {e}")
+        raise
+
+def datos_sincronizacion_ghl(user_id: str, fecha: str, hora_inicio: str, duracion: int, id_profesional: int,
+                             id_sucursal: int, contexto: ContextoAgendamiento = None) -> Dict[str, Any]:
+    """Trabajo para la cola GHL: los argumentos de _integrar_ghl más lo ya resuelto en el contexto"""
+    return {
+        "user_id": user_id, "fecha": fecha, "hora_inicio": hora_inicio, "duracion": duracion,
+        "id_profesional": id_profesional, "id_sucursal": id_sucursal,
+        "profesional": contexto.profesional if contexto else None,
+        "nombre_sucursal": contexto.nombre_sucursal if contexto else None
+    }
+
+def _ejecutar_sincronizacion_ghl(datos: Dict[str, Any]) -> None:
+    """Ejecuta un trabajo de la cola reconstruyendo el contexto guardado al agendar"""
+    contexto = ContextoAgendamiento()
+    contexto.profesional = datos.pop("profesional", None)
+    contexto.nombre_sucursal = datos.pop("nombre_sucursal", None)
+    _integrar_ghl(**datos, contexto=contexto)
 
 @app.route('/schedule_appointment', methods=['POST'])
 def endpoint_schedule_appointment():
@@ -1158,19 +2793,32 @@ def cancel_appointment(rut: str = None, id_cita: int = None) -> Dict[str, Any]:
     
     # Si se proporciona ID de cita, cancelar directamente
     if id_cita:
-        return _cancelar_cita_por_id(id_cita)
+        return cancelar_cita_por_id(id_cita)
     
     # Si se proporciona RUT, buscar y cancelar próxima cita futura
     if rut:
         return _cancelar_proxima_cita_por_rut(rut)
 
-def _cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
+def payload_cancelacion(es_dentalink: bool) -> Dict[str, Any]:
+    """Body de PUT citas/{id} para anular (Dentalink usa "comentarios" y notifica al paciente)"""
+    if es_dentalink:
+        return {
+            "id_estado": 1,  # Estado anulado
+            "comentarios": "Cita cancelada por sistema",
+            "flag_notificar_anulacion": 1
+        }
+    return {
+        "id_estado": 1,  # Estado anulado
+        "comentario": "Cita cancelada por sistema"
+    }
+
+def cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
     """Cancela una cita específica por ID"""
     # Intentar en ambas APIs ya que no sabemos en cuál está la cita
-    apis = [
+    apis = apis_disponibles([
         {"name": "Dentalink v1", "base": DENTALINK_API_URL, "headers": DENTALINK_HEADERS, "is_dentalink": True},
         {"name": "Medilink v5", "base": MEDILINK_API_URL, "headers": MEDILINK_HEADERS, "is_dentalink": False}
-    ]
+    ])
     
     errores = []
     cita_data_guardada = None  # Para guardar datos si encontramos la cita pero falla al cancelar
@@ -1181,7 +2829,7 @@ def _cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
             
             # Obtener datos de la cita primero
             logging.info(f"🔍 Buscando cita {id_cita} en {api['name']}")
-            resp_get = requests.get(url_cita, headers=api['headers'])
+            resp_get = http_get(url_cita, headers=api['headers'])
             
             if resp_get.status_code == 404:
                 logging.info(f"⚠️ Cita {id_cita} no encontrada en {api['name']}")
@@ -1207,21 +2855,11 @@ def _cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
                 continue
             
             # Preparar payload de cancelación
-            if api['is_dentalink']:
-                payload_cancelar = {
-                    "id_estado": 1,  # Estado anulado
-                    "comentarios": "Cita cancelada por sistema",
-                    "flag_notificar_anulacion": 1
-                }
-            else:
-                payload_cancelar = {
-                    "id_estado": 1,  # Estado anulado
-                    "comentario": "Cita cancelada por sistema"
-                }
+            payload_cancelar = payload_cancelacion(api['is_dentalink'])
             
             # Cancelar cita
             logging.info(f"🔄 Intentando cancelar cita en {api['name']}")
-            resp_cancel = requests.put(url_cita, headers=api['headers'], json=payload_cancelar)
+            resp_cancel = http_put(url_cita, headers=api['headers'], json=payload_cancelar)
             
             if resp_cancel.status_code == 200:
                 logging.info(f"✅ Cita {id_cita} cancelada exitosamente en {api['name']}")
@@ -1256,6 +2894,55 @@ def _cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
         "detalles": errores
     }
 
+# Búsqueda de la próxima cita en la API alternativa mientras se consulta la principal
+CANCELACION_POOL_SIZE = int(os.getenv('CANCELACION_POOL_SIZE', '8'))
+_pool_cancelacion = ThreadPoolExecutor(max_workers=CANCELACION_POOL_SIZE, thread_name_prefix="cancelacion")
+
+def proxima_cita_futura(citas: List[Dict], fecha_actual: str, hora_actual_str: str) -> Optional[Dict]:
+    """Cita activa (no anulada) más próxima posterior a la fecha/hora actual, o None"""
+    # Filtrar citas activas y futuras
+    citas_futuras = []
+    for cita in citas:
+        if cita.get("estado_anulacion", 0) != 0:  # Ya anulada
+            continue
+        
+        fecha_cita = cita["fecha"]
+        hora_cita = cita["hora_inicio"]
+        
+        # Verificar si es futura
+        if (fecha_cita > fecha_actual or 
+            (fecha_cita == fecha_actual and hora_cita > hora_actual_str)):
+            citas_futuras.append(cita)
+    
+    if not citas_futuras:
+        return None
+    
+    # La más próxima por fecha y hora
+    return min(citas_futuras, key=lambda x: (x["fecha"], x["hora_inicio"]))
+
+def _proxima_cita_en_api(api: Dict[str, Any], rut_formateado: str, fecha_actual: str, hora_actual_str: str) -> Optional[Dict]:
+    """Busca el paciente en una API y retorna su cita futura activa más próxima, o None"""
+    try:
+        # Buscar paciente
+        paciente = buscar_paciente(rut_formateado, api)
+        if not paciente:
+            return None
+        
+        # Obtener citas del paciente
+        citas_link = next((l["href"] for l in paciente.get("links", []) if l.get("rel") == "citas"), None)
+        if not citas_link:
+            return None
+        
+        resp_citas = http_get(citas_link, headers=api['headers'])
+        if resp_citas.status_code != 200:
+            return None
+        
+        return proxima_cita_futura(resp_citas.json().get("data", []), fecha_actual, hora_actual_str)
+    
+    except Exception as e:
+        logging.warning(f"⚠️ Error buscando en {api['name']}: {e}")
+        return None
+
 def _cancelar_proxima_cita_por_rut(rut: str) -> Dict[str, Any]:
     """Cancela la próxima cita futura de un paciente por RUT"""
     rut_formateado = formatear_rut(rut)
@@ -1266,70 +2953,28 @@ def _cancelar_proxima_cita_por_rut(rut: str) -> Dict[str, Any]:
     fecha_actual = hora_actual.strftime("%Y-%m-%d")
     hora_actual_str = hora_actual.strftime("%H:%M:%S")
     
-    apis = [
+    apis = apis_disponibles([
         {"name": "Medilink v5", "base": MEDILINK_API_URL, "headers": MEDILINK_HEADERS, "is_dentalink": False},
         {"name": "Dentalink v1", "base": DENTALINK_API_URL, "headers": DENTALINK_HEADERS, "is_dentalink": True}
+    ])
+    
+    # Buscar paciente y sus citas en las APIs disponibles a la vez (Dentalink en el pool, Medilink aquí)
+    futuros_alternativas = [
+        _pool_cancelacion.submit(copy_context().run, _proxima_cita_en_api, api, rut_formateado, fecha_actual, hora_actual_str)
+        for api in apis[1:]
     ]
+    candidatas = [_proxima_cita_en_api(apis[0], rut_formateado, fecha_actual, hora_actual_str)]
+    candidatas.extend(futuro.result() for futuro in futuros_alternativas)
     
+    # Quedarse con la más próxima; en empate gana Medilink (primera de la lista)
     cita_encontrada = None
     api_cita = None
-    
-    # Buscar paciente y sus citas en ambas APIs
-    for api in apis:
-        try:
-            # Buscar paciente
-            filtro = json.dumps({"rut": {"eq": rut_formateado}})
-            resp_pac = requests.get(f"{api['base']}pacientes", headers=api['headers'], params={"q": filtro})
-            
-            if resp_pac.status_code != 200:
-                continue
-            
-            pacientes = resp_pac.json().get("data", [])
-            if not pacientes:
-                continue
-            
-            paciente = pacientes[0]
-            
-            # Obtener citas del paciente
-            citas_link = next((l["href"] for l in paciente.get("links", []) if l.get("rel") == "citas"), None)
-            if not citas_link:
-                continue
-            
-            resp_citas = requests.get(citas_link, headers=api['headers'])
-            if resp_citas.status_code != 200:
-                continue
-            
-            citas = resp_citas.json().get("data", [])
-            
-            # Filtrar citas activas y futuras
-            citas_futuras = []
-            for cita in citas:
-                if cita.get("estado_anulacion", 0) != 0:  # Ya anulada
-                    continue
-                
-                fecha_cita = cita["fecha"]
-                hora_cita = cita["hora_inicio"]
-                
-                # Verificar si es futura
-                if (fecha_cita > fecha_actual or 
-                    (fecha_cita == fecha_actual and hora_cita > hora_actual_str)):
-                    citas_futuras.append(cita)
-            
-            if citas_futuras:
-                # Ordenar por fecha y hora (más próxima primero)
-                citas_futuras.sort(key=lambda x: (x["fecha"], x["hora_inicio"]))
-                cita_candidata = citas_futuras[0]
-                
-                # Si no tenemos cita o esta es más próxima
-                if (not cita_encontrada or 
-                    (cita_candidata["fecha"], cita_candidata["hora_inicio"]) < 
-                    (cita_encontrada["fecha"], cita_encontrada["hora_inicio"])):
-                    cita_encontrada = cita_candidata
-                    api_cita = api
-                    
-        except Exception as e:
-            logging.warning(f"⚠️ Error buscando en {api['name']}: {e}")
-            continue
+    for api, cita_candidata in zip(apis, candidatas):
+        if cita_candidata and (not cita_encontrada or 
+            (cita_candidata["fecha"], cita_candidata["hora_inicio"]) < 
+            (cita_encontrada["fecha"], cita_encontrada["hora_inicio"])):
+            cita_encontrada = cita_candidata
+            api_cita = api
     
     if not cita_encontrada:
         return {"mensaje": "No se encontraron citas futuras activas para cancelar"}
@@ -1353,20 +2998,10 @@ def _cancelar_proxima_cita_por_rut(rut: str) -> Dict[str, Any]:
         try:
             url_cancelar = f"{api_cancel['base']}citas/{id_cita}"
             
-            if api_cancel['is_dentalink']:
-                payload_cancelar = {
-                    "id_estado": 1,
-                    "comentarios": "Cita cancelada por sistema",
-                    "flag_notificar_anulacion": 1
-                }
-            else:
-                payload_cancelar = {
-                    "id_estado": 1,
-                    "comentario": "Cita cancelada por sistema"
-                }
+            payload_cancelar = payload_cancelacion(api_cancel['is_dentalink'])
             
             logging.info(f"🔄 Intentando cancelar en {api_cancel['name']}")
-            resp_cancel = requests.put(url_cancelar, headers=api_cancel['headers'], json=payload_cancelar)
+            resp_cancel = http_put(url_cancelar, headers=api_cancel['headers'], json=payload_cancelar)
             
             if resp_cancel.status_code == 200:
                 logging.info(f"✅ Cita cancelada exitosamente en {api_cancel['name']}")
@@ -1422,7 +3057,160 @@ def endpoint_cancel_appointment():
 # FUNCIÓN 6: OBTENER TRATAMIENTOS DE PACIENTE
 # ============================
 
-def get_patient_treatments(rut: str) -> Dict[str, Any]:
+# Las citas de cada tratamiento se consultan en paralelo con este pool
+TRATAMIENTOS_POOL_SIZE = int(os.getenv('TRATAMIENTOS_POOL_SIZE', '8'))
+_pool_tratamientos = ThreadPoolExecutor(max_workers=TRATAMIENTOS_POOL_SIZE, thread_name_prefix="tratamientos")
+
+# Máximo de tratamientos (los más recientes) a los que se les consultan las citas; 0 = todos
+TRATAMIENTOS_MAX_EXPANDIDOS = int(os.getenv('TRATAMIENTOS_MAX_EXPANDIDOS', '0'))
+
+def link_citas_tratamiento(tratamiento: Dict) -> Optional[str]:
+    """Link "citas" de un tratamiento, o None si no lo trae"""
+    return next((link.get("href") for link in tratamiento.get("links", []) if link.get("rel") == "citas"), None)
+
+def resumen_citas(citas_data: List[Dict]) -> Tuple[Optional[str], List[Dict]]:
+    """
+    Resume las citas de un tratamiento.
+    
+    Returns:
+        tuple: (hora de inicio de la primera cita no anulada o None, citas con sus campos relevantes)
+    """
+    # Obtener todas las citas y sus horas
+    citas_info = [
+        {
+            "id_cita": cita.get("id"),
+            "fecha": cita.get("fecha"),
+            "hora_inicio": cita.get("hora_inicio"),
+            "hora_termino": cita.get("hora_termino"),
+            "estado": cita.get("estado"),
+            "estado_anulacion": cita.get("estado_anulacion")
+        }
+        for cita in citas_data
+    ]
+    
+    # Si hay citas, usar la hora de la primera cita no anulada
+    for cita in citas_data:
+        if cita.get("estado_anulacion", 0) == 0:  # Cita no anulada
+            return cita.get("hora_inicio"), citas_info
+    return None, citas_info
+
+def indices_tratamientos_a_expandir(tratamientos_data: List[Dict], max_tratamientos: int = None) -> List[int]:
+    """Índices de los tratamientos cuyas citas se consultan: todos, o los más recientes por fecha"""
+    if max_tratamientos and len(tratamientos_data) > max_tratamientos:
+        log_detalle(f"✂️ Se consultan citas de {max_tratamientos} de {len(tratamientos_data)} tratamientos")
+        return sorted(range(len(tratamientos_data)), key=lambda i: tratamientos_data[i].get("fecha") or "", reverse=True)[:max_tratamientos]
+    return list(range(len(tratamientos_data)))
+
+def link_tratamientos_paciente(paciente: Dict, api: Dict[str, Any]) -> str:
+    """
+    URL de tratamientos del paciente: Medilink usa "atenciones" y Dentalink "tratamientos";
+    si el paciente no trae el link se prueba el alternativo y, en último caso, se construye.
+    """
+    id_paciente = paciente.get("id")
+    tratamientos_link = None
+    
+    # Para Medilink, buscar "atenciones"; para Dentalink, buscar "tratamientos"
+    rel_a_buscar = "tratamientos" if api['is_dentalink'] else "atenciones"
+    
+    for link in paciente.get("links", []):
+        if link.get("rel") == rel_a_buscar:
+            tratamientos_link = link.get("href")
+            break
+    
+    # Si no encontró con el rel específico, buscar el alternativo
+    if not tratamientos_link:
+        rel_alternativo = "atenciones" if api['is_dentalink'] else "tratamientos"
+        for link in paciente.get("links", []):
+            if link.get("rel") == rel_alternativo:
+                tratamientos_link = link.get("href")
+                log_detalle(f"⚠️ Usando link alternativo '{rel_alternativo}' en {api['name']}")
+                break
+    
+    if not tratamientos_link:
+        # Construir URL manualmente si no existe el link
+        logging.warning("⚠️ Link no encontrado, construyendo URL manualmente")
+        if api['is_dentalink']:
+            tratamientos_link = f"{api['base']}pacientes/{id_paciente}/tratamientos"
+        else:
+            # Medilink usa "atenciones"
+            tratamientos_link = f"{api['base']}pacientes/{id_paciente}/atenciones"
+    
+    return tratamientos_link
+
+def tratamiento_filtrado(tratamiento: Dict, es_dentalink: bool, hora_inicio: Optional[str], citas_info: List[Dict]) -> Dict[str, Any]:
+    """Campos relevantes de un tratamiento según la API, con la hora y las citas ya resueltas"""
+    if es_dentalink:
+        return {
+            "id": tratamiento.get("id"),
+            "nombre": tratamiento.get("nombre"),
+            "fecha": tratamiento.get("fecha"),
+            "hora_inicio": hora_inicio,
+            "id_dentista": tratamiento.get("id_dentista"),
+            "nombre_dentista": tratamiento.get("nombre_dentista"),
+            "id_sucursal": tratamiento.get("id_sucursal"),
+            "nombre_sucursal": tratamiento.get("nombre_sucursal"),
+            "finalizado": tratamiento.get("finalizado"),
+            "bloqueado": tratamiento.get("bloqueado"),
+            "total": tratamiento.get("total"),
+            "abonado": tratamiento.get("abonado"),
+            "deuda": tratamiento.get("deuda"),
+            "citas": citas_info  # Incluir todas las citas del tratamiento
+        }
+    # Medilink usa id_profesional y tiene tipo_atencion
+    return {
+        "id": tratamiento.get("id"),
+        "nombre": tratamiento.get("nombre"),
+        "tipo_atencion": tratamiento.get("tipo_atencion"),  # Campo exclusivo de Medilink
+        "fecha": tratamiento.get("fecha"),
+        "hora_inicio": hora_inicio,
+        "id_profesional": tratamiento.get("id_profesional"),  # Medilink usa id_profesional
+        "nombre_profesional": tratamiento.get("nombre_profesional"),  # Medilink usa nombre_profesional
+        "id_sucursal": tratamiento.get("id_sucursal"),
+        "nombre_sucursal": tratamiento.get("nombre_sucursal"),
+        "finalizado": tratamiento.get("finalizado"),
+        "bloqueado": tratamiento.get("bloqueado"),
+        "total": tratamiento.get("total"),
+        "abonado": tratamiento.get("abonado"),
+        "deuda": tratamiento.get("deuda"),
+        "citas": citas_info  # Incluir todas las citas del tratamiento
+    }
+
+def _citas_tratamiento(tratamiento: Dict, headers_api: Dict, detalle: bool) -> Tuple[Optional[str], List[Dict]]:
+    """
+    Consulta el link "citas" de un tratamiento.
+    
+    Returns:
+        tuple: (hora de inicio de la primera cita no anulada o None, citas resumidas)
+    """
+    hora_inicio = None
+    citas_info = []
+    
+    citas_link = link_citas_tratamiento(tratamiento)
+    if not citas_link:
+        return hora_inicio, citas_info
+    
+    try:
+        if detalle:
+            logging.info(f"🔗 Consultando citas del tratamiento {tratamiento.get('id')}: {citas_link}")
+        resp_citas = http_get(citas_link, headers=headers_api)
+        
+        if resp_citas.status_code == 200:
+            citas_data = resp_citas.json().get("data", [])
+            sumar_registro("citas", len(citas_data))
+            if detalle:
+                logging.info(f"📅 Citas encontradas para tratamiento {tratamiento.get('id')}: {len(citas_data)}")
+            
+            hora_inicio, citas_info = resumen_citas(citas_data)
+            if hora_inicio and detalle:
+                logging.info(f"✅ Hora de inicio obtenida para tratamiento {tratamiento.get('id')}: {hora_inicio}")
+        else:
+            logging.warning(f"⚠️ Error al obtener citas del tratamiento {tratamiento.get('id')}: {resp_citas.status_code}")
+    except Exception as e:
+        logging.warning(f"⚠️ Error consultando citas del tratamiento {tratamiento.get('id')}: {e}")
+    
+    return hora_inicio, citas_info
+
+def get_patient_treatments(rut: str, max_tratamientos: int = TRATAMIENTOS_MAX_EXPANDIDOS) -> Dict[str, Any]:
     """
     Obtiene los tratamientos/atenciones de un paciente por RUT en Medilink/Dentalink.
     
@@ -1433,174 +3221,66 @@ def get_patient_treatments(rut: str) -> Dict[str, Any]:
     
     Args:
         rut: RUT del paciente
+        max_tratamientos: Máximo de tratamientos (los más recientes) a los que se les
+            consultan las citas; el resto se retorna sin citas. 0 o None = todos
     
     Returns:
         Dict con los tratamientos del paciente o error
     """
-    logging.info(f"🔍 Buscando tratamientos para paciente con RUT: {rut}")
+    log_detalle(f"🔍 Buscando tratamientos para paciente con RUT: {rut}")
     
     rut_formateado = formatear_rut(rut)
     
     # Buscar en ambas APIs
-    apis = [
+    apis = apis_disponibles([
         {"name": "Medilink v5", "base": MEDILINK_API_URL, "headers": MEDILINK_HEADERS, "is_dentalink": False},
         {"name": "Dentalink v1", "base": DENTALINK_API_URL, "headers": DENTALINK_HEADERS, "is_dentalink": True}
-    ]
+    ])
     
     for api in apis:
         try:
             # 1. Buscar paciente por RUT
-            filtro = json.dumps({"rut": {"eq": rut_formateado}})
-            logging.info(f"🔍 Buscando paciente en {api['name']}")
-            
-            resp_paciente = requests.get(f"{api['base']}pacientes", headers=api['headers'], params={"q": filtro})
-            logging.info(f"📊 Status búsqueda paciente en {api['name']}: {resp_paciente.status_code}")
-            
-            if resp_paciente.status_code != 200:
+            log_detalle(f"🔍 Buscando paciente en {api['name']}")
+            paciente = buscar_paciente(rut_formateado, api)
+            if not paciente:
                 continue
             
-            pacientes_data = resp_paciente.json().get("data", [])
-            if not pacientes_data:
-                continue
-            
-            paciente = pacientes_data[0]
             id_paciente = paciente.get("id")
             nombre_completo = f"{paciente.get('nombre', '')} {paciente.get('apellidos', '')}".strip()
             
-            logging.info(f"✅ Paciente encontrado en {api['name']}: {nombre_completo} (ID: {id_paciente})")
+            log_detalle(f"✅ Paciente encontrado en {api['name']}: {nombre_completo} (ID: {id_paciente})")
             
             # 2. Buscar link de tratamientos/atenciones en los links del paciente
-            tratamientos_link = None
-            
-            # Para Medilink, buscar "atenciones"; para Dentalink, buscar "tratamientos"
-            rel_a_buscar = "tratamientos" if api['is_dentalink'] else "atenciones"
-            
-            for link in paciente.get("links", []):
-                if link.get("rel") == rel_a_buscar:
-                    tratamientos_link = link.get("href")
-                    break
+            tratamientos_link = link_tratamientos_paciente(paciente, api)
             
-            # Si no encontró con el rel específico, buscar el alternativo
-            if not tratamientos_link:
-                rel_alternativo = "atenciones" if api['is_dentalink'] else "tratamientos"
-                for link in paciente.get("links", []):
-                    if link.get("rel") == rel_alternativo:
-                        tratamientos_link = link.get("href")
-                        logging.info(f"⚠️ Usando link alternativo '{rel_alternativo}' en {api['name']}")
-                        break
-            
-            if not tratamientos_link:
-                # Construir URL manualmente si no existe el link
-                logging.warning("⚠️ Link no encontrado, construyendo URL manualmente")
-                if api['is_dentalink']:
-                    tratamientos_link = f"{api['base']}pacientes/{id_paciente}/tratamientos"
-                else:
-                    # Medilink usa "atenciones"
-                    tratamientos_link = f"{api['base']}pacientes/{id_paciente}/atenciones"
-            
-            logging.info(f"🔗 Consultando tratamientos/atenciones: {tratamientos_link}")
+            log_detalle(f"🔗 Consultando tratamientos/atenciones: {tratamientos_link}")
             
             # 3. Obtener tratamientos
-            resp_tratamientos = requests.get(tratamientos_link, headers=api['headers'])
-            logging.info(f"📊 Status tratamientos en {api['name']}: {resp_tratamientos.status_code}")
-            logging.info(f"🔗 Endpoint usado: {tratamientos_link}")
+            resp_tratamientos = http_get(tratamientos_link, headers=api['headers'])
+            log_detalle(f"📊 Status tratamientos en {api['name']}: {resp_tratamientos.status_code}")
             
             if resp_tratamientos.status_code != 200:
                 logging.warning(f"⚠️ Error al obtener tratamientos: Status {resp_tratamientos.status_code}")
                 continue
             
             tratamientos_data = resp_tratamientos.json().get("data", [])
-            logging.info(f"📋 Tratamientos encontrados en {api['name']}: {len(tratamientos_data)}")
+            anotar_registro(api=api['name'], id_paciente=id_paciente, tratamientos=len(tratamientos_data))
+            
+            # 4. Obtener en paralelo las citas de los tratamientos (los más recientes si hay límite)
+            detalle = detalle_activo()
+            futuros_citas = {
+                i: _pool_tratamientos.submit(copy_context().run, _citas_tratamiento, tratamientos_data[i], api['headers'], detalle)
+                for i in indices_tratamientos_a_expandir(tratamientos_data, max_tratamientos)
+            }
             
-            # 4. Filtrar campos relevantes de tratamientos y obtener citas
+            # 5. Filtrar campos relevantes de tratamientos
             tratamientos_filtrados = []
-            for tratamiento in tratamientos_data:
-                # Obtener hora_inicio desde las citas del tratamiento
-                hora_inicio = None
-                citas_info = []
-                
-                # Buscar link de citas en los links del tratamiento
-                citas_link = None
-                for link in tratamiento.get("links", []):
-                    if link.get("rel") == "citas":
-                        citas_link = link.get("href")
-                        break
-                
-                if citas_link:
-                    try:
-                        logging.info(f"🔗 Consultando citas del tratamiento {tratamiento.get('id')}: {citas_link}")
-                        resp_citas = requests.get(citas_link, headers=api['headers'])
-                        
-                        if resp_citas.status_code == 200:
-                            citas_data = resp_citas.json().get("data", [])
-                            logging.info(f"📅 Citas encontradas para tratamiento {tratamiento.get('id')}: {len(citas_data)}")
-                            
-                            # Obtener todas las citas y sus horas
-                            for cita in citas_data:
-                                cita_info = {
-                                    "id_cita": cita.get("id"),
-                                    "fecha": cita.get("fecha"),
-                                    "hora_inicio": cita.get("hora_inicio"),
-                                    "hora_termino": cita.get("hora_termino"),
-                                    "estado": cita.get("estado"),
-                                    "estado_anulacion": cita.get("estado_anulacion")
-                                }
-                                citas_info.append(cita_info)
-                            
-                            # Si hay citas, usar la hora de la primera cita no anulada
-                            for cita in citas_data:
-                                if cita.get("estado_anulacion", 0) == 0:  # Cita no anulada
-                                    hora_inicio = cita.get("hora_inicio")
-                                    break
-                            
-                            if hora_inicio:
-                                logging.info(f"✅ Hora de inicio obtenida para tratamiento {tratamiento.get('id')}: {hora_inicio}")
-                        else:
-                            logging.warning(f"⚠️ Error al obtener citas del tratamiento {tratamiento.get('id')}: {resp_citas.status_code}")
-                    except Exception as e:
-                        logging.warning(f"⚠️ Error consultando citas del tratamiento {tratamiento.get('id')}: {e}")
-                
-                # Adaptar campos según la API
-                if api['is_dentalink']:
-                    tratamiento_filtrado = {
-                        "id": tratamiento.get("id"),
-                        "nombre": tratamiento.get("nombre"),
-                        "fecha": tratamiento.get("fecha"),
-                        "hora_inicio": hora_inicio,
-                        "id_dentista": tratamiento.get("id_dentista"),
-                        "nombre_dentista": tratamiento.get("nombre_dentista"),
-                        "id_sucursal": tratamiento.get("id_sucursal"),
-                        "nombre_sucursal": tratamiento.get("nombre_sucursal"),
-                        "finalizado": tratamiento.get("finalizado"),
-                        "bloqueado": tratamiento.get("bloqueado"),
-                        "total": tratamiento.get("total"),
-                        "abonado": tratamiento.get("abonado"),
-                        "deuda": tratamiento.get("deuda"),
-                        "citas": citas_info  # Incluir todas las citas del tratamiento
-                    }
-                else:
-                    # Medilink usa id_profesional y tiene tipo_atencion
-                    tratamiento_filtrado = {
-                        "id": tratamiento.get("id"),
-                        "nombre": tratamiento.get("nombre"),
-                        "tipo_atencion": tratamiento.get("tipo_atencion"),  # Campo exclusivo de Medilink
-                        "fecha": tratamiento.get("fecha"),
-                        "hora_inicio": hora_inicio,
-                        "id_profesional": tratamiento.get("id_profesional"),  # Medilink usa id_profesional
-                        "nombre_profesional": tratamiento.get("nombre_profesional"),  # Medilink usa nombre_profesional
-                        "id_sucursal": tratamiento.get("id_sucursal"),
-                        "nombre_sucursal": tratamiento.get("nombre_sucursal"),
-                        "finalizado": tratamiento.get("finalizado"),
-                        "bloqueado": tratamiento.get("bloqueado"),
-                        "total": tratamiento.get("total"),
-                        "abonado": tratamiento.get("abonado"),
-                        "deuda": tratamiento.get("deuda"),
-                        "citas": citas_info  # Incluir todas las citas del tratamiento
-                    }
-                tratamientos_filtrados.append(tratamiento_filtrado)
+            for i, tratamiento in enumerate(tratamientos_data):
+                hora_inicio, citas_info = futuros_citas[i].result() if i in futuros_citas else (None, [])
+                tratamientos_filtrados.append(tratamiento_filtrado(tratamiento, api['is_dentalink'], hora_inicio, citas_info))
             
-            # 5. Preparar respuesta
-            return {
+            # 6. Preparar respuesta
+            respuesta = {
                 "paciente": {
                     "id": id_paciente,
                     "nombre": nombre_completo,
@@ -1612,6 +3292,9 @@ def get_patient_treatments(rut: str) -> Dict[str, Any]:
                 "total_tratamientos": len(tratamientos_filtrados),
                 "api_utilizada": api['name']
             }
+            if len(futuros_citas) < len(tratamientos_data):
+                respuesta["tratamientos_con_citas"] = len(futuros_citas)
+            return respuesta
             
         except Exception as e:
             logging.warning(f"⚠️ Error obteniendo tratamientos en {api['name']}: {e}")
@@ -1630,7 +3313,13 @@ def endpoint_get_patient_treatments():
     if not rut:
         return jsonify({"error": "RUT es requerido"}), 400
     
-    resultado = get_patient_treatments(rut)
+    max_tratamientos = data.get("max_tratamientos", TRATAMIENTOS_MAX_EXPANDIDOS)
+    try:
+        max_tratamientos = max(0, int(max_tratamientos or 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "max_tratamientos debe ser un número entero"}), 400
+    
+    resultado = get_patient_treatments(rut, max_tratamientos)
     
     if "error" in resultado:
         return jsonify(resultado), 404
@@ -1644,17 +3333,63 @@ def endpoint_get_patient_treatments():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Endpoint de verificación de salud del servicio"""
+    circuitos = estado_circuitos()
     return jsonify({
-        "status": "ok",
+        "status": "ok" if all(c["estado"] == "cerrado" for c in circuitos.values()) else "degradado",
         "service": "Dentalink API Template",
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": datetime.utcnow().isoformat(),
+        "circuitos": circuitos,
+        "presupuesto_peticion_s": PRESUPUESTO_PETICION
     })
 
+@app.route('/cache/profesionales/invalidar', methods=['POST'])
+def endpoint_invalidar_cache_profesionales():
+    """Fuerza que la próxima consulta vuelva a descargar los profesionales"""
+    invalidar_cache_profesionales()
+    return jsonify({"mensaje": "Caché de profesionales invalidada"})
+
+@app.route('/cache/pacientes/invalidar', methods=['POST'])
+def endpoint_invalidar_cache_pacientes():
+    """Descarta los pacientes en memoria (solo los de un RUT si se envía "rut")"""
+    data = request.get_json(silent=True) or {}
+    invalidar_cache_pacientes(data.get("rut"))
+    return jsonify({"mensaje": "Caché de pacientes invalidada"})
+
+@app.route('/cache/sucursales/refrescar', methods=['POST'])
+def endpoint_refrescar_sucursales():
+    """Vuelve a descargar el listado de sucursales (por ejemplo, tras crear una nueva)"""
+    return jsonify({"mensaje": "Mapa de sucursales actualizado", "sucursales": refrescar_sucursales()})
+
+@app.route('/ghl/cola', methods=['GET'])
+def endpoint_metricas_cola_ghl():
+    """Profundidad de la cola de sincronización GHL y del dead letter"""
+    try:
+        return jsonify(metricas_cola_ghl())
+    except sqlite3.Error as e:
+        return jsonify({"error": f"No se pudo leer la cola GHL: {e}"}), 500
+
+@app.route('/ghl/cola/reintentar', methods=['POST'])
+def endpoint_reencolar_dead_letter_ghl():
+    """Devuelve a la cola los trabajos del dead letter (todos, o solo los de "ids")"""
+    data = request.get_json(silent=True) or {}
+    ids = [extraer_id(valor) for valor in data.get("ids") or []]
+    if None in ids:
+        return jsonify({"error": "ids debe contener solo IDs numéricos"}), 400
+    
+    try:
+        reencolados = reencolar_dead_letter_ghl(ids)
+    except sqlite3.Error as e:
+        return jsonify({"error": f"No se pudo leer la cola GHL: {e}"}), 500
+    return jsonify({"reencolados": reencolados})
+
 @app.route('/config', methods=['GET'])
 def get_config():
     """Endpoint para obtener configuración actual"""
     return jsonify({
         "sucursales_dentalink": SUCURSALES_DENTALINK,
+        "rutas_aprendidas": obtener_rutas_aprendidas(),
+        "hedging_horarios": HEDGING_HORARIOS,
+        "latencia_horarios": estadisticas_latencia(),
         "medilink_configured": bool(MEDILINK_TOKEN),
         "dentalink_configured": bool(DENTALINK_TOKEN),
         "ghl_configured": bool(GHL_ACCESS_TOKEN)
@@ -1696,8 +3431,11 @@ def create_user_and_schedule():
     if faltantes:
         return jsonify({"error": f"Faltan campos obligatorios: {', '.join(faltantes)}"}), 400
     
+    # Paciente, profesional y sucursal resueltos se reutilizan en todo el flujo
+    contexto = ContextoAgendamiento()
+    
     # 1. Crear o buscar paciente
-    resultado_paciente = create_user(nombre, apellidos, rut, telefono, email, id_sucursal)
+    resultado_paciente = create_user(nombre, apellidos, rut, telefono, email, id_sucursal, contexto)
     if "error" in resultado_paciente:
         return jsonify(resultado_paciente), 400
     
@@ -1705,7 +3443,7 @@ def create_user_and_schedule():
     
     # 2. Agendar cita
     resultado_cita = schedule_appointment(id_paciente, id_profesional, id_sucursal, fecha, 
-                                        hora_inicio, user_id, tiempo_cita, comentario)
+                                        hora_inicio, user_id, tiempo_cita, comentario, contexto)
     
     if "error" in resultado_cita:
         return jsonify(resultado_cita), 400
@@ -1717,6 +3455,36 @@ def create_user_and_schedule():
         "cita": resultado_cita
     })
 
+# ============================
+# ARRANQUE DE TAREAS EN SEGUNDO PLANO
+# ============================
+# Nada arranca al importar: los benchmarks, la versión ASGI y el proceso padre
+# del reloader de Flask importan este módulo y no deben levantar workers ni
+# crear la cola SQLite. Cada punto de entrada llama a iniciar_segundo_plano()
+
+_segundo_plano_iniciado = False
+_segundo_plano_lock = threading.Lock()
+
+def iniciar_segundo_plano() -> None:
+    """Arranca workers GHL, refresco de sucursales y precarga del calendar (idempotente)"""
+    global _segundo_plano_iniciado
+    if not GHL_ACCESS_TOKEN:
+        return
+    with _segundo_plano_lock:
+        if _segundo_plano_iniciado:
+            return
+        _segundo_plano_iniciado = True
+    
+    iniciar_workers_ghl()
+    iniciar_cache_sucursales()
+    threading.Thread(target=precargar_calendar_ghl, name="ghl-calendar", daemon=True).start()
+
+@app.before_request
+def _asegurar_segundo_plano():
+    # Bajo un servidor WSGI (gunicorn, etc.) no se ejecuta __main__: arrancar con la primera petición
+    if not _segundo_plano_iniciado:
+        iniciar_segundo_plano()
+
 if __name__ == '__main__':
     logging.info("🚀 Iniciando servidor Dentalink API Template")
     
@@ -1726,4 +3494,9 @@ if __name__ == '__main__':
     if not DENTALINK_TOKEN:
         logging.warning("⚠️ DENTALINK_TOKEN no configurado")
     
+    # Con debug, el reloader ejecuta este bloque en el proceso padre y en el hijo;
+    # solo el hijo (WERKZEUG_RUN_MAIN) atiende peticiones y debe arrancar las tareas
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        iniciar_segundo_plano()
+
     app.run(debug=True, host='0.0.0.0', port=3000)
@@ -0,0 +1,1116 @@
+"""
+Variante ASGI de la plantilla de API para Dentalink/Medilink
+
+Mismas rutas y mismos contratos JSON que dentalinkymedilink.py (Flask), pero sobre
+FastAPI y un cliente httpx asíncrono compartido: un solo worker mantiene cientos de
+llamadas a Medilink/Dentalink/GHL en vuelo en lugar de bloquear un hilo por llamada.
+
+La lógica sin I/O (filtros de horarios, rutas aprendidas, cachés de profesionales y de
+pacientes, payloads, registro por petición) se importa de dentalinkymedilink.py; aquí
+solo se reescriben las funciones que hacen llamadas HTTP.
+
+Rutas:
+- /search_availability, /search_user, /create_user, /schedule_appointment,
+  /cancel_appointment, /get_patient_treatments, /create_user_and_schedule, /health,
+  /ghl/cola, /ghl/cola/reintentar
+
+Uso (desde apis-en-python/):
+    uvicorn dentalinkymedilink_asgi:app --host 0.0.0.0 --port 3000
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+import pytz
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import dentalinkymedilink as dm
+
+# ============================
+# CLIENTE HTTP ASÍNCRONO
+# ============================
+
+# Conexiones simultáneas del worker (todas las APIs comparten el mismo cliente)
+HTTP_MAX_CONEXIONES = int(os.getenv('HTTP_MAX_CONEXIONES', '200'))
+HTTP_STATUS_REINTENTABLES = (502, 503, 504)
+
+_cliente_http: Optional[httpx.AsyncClient] = None
+
+def obtener_cliente_http() -> httpx.AsyncClient:
+    """Cliente keep-alive compartido; se crea al iniciar la app o en el primer uso"""
+    global _cliente_http
+    if _cliente_http is None:
+        _cliente_http = httpx.AsyncClient(
+            timeout=httpx.Timeout(dm.HTTP_READ_TIMEOUT, connect=dm.HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONEXIONES, max_keepalive_connections=HTTP_MAX_CONEXIONES)
+        )
+    return _cliente_http
+
+async def http_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Ejecuta una petición por el cliente compartido. Solo los GET se reintentan (ante
+    502/503/504 o error de conexión), hasta HTTP_GET_RETRIES veces con backoff. Cada
+    intento pasa por el circuit breaker y el presupuesto de la petición, igual que en Flask.
+
+    Raises:
+        dm.UpstreamOmitido: si el circuito del backend está abierto o el presupuesto se agotó
+    """
+    breaker = dm.breaker_de_url(url)
+    inicio = time.monotonic()
+    try:
+        for intento in range(dm.HTTP_GET_RETRIES + 1):
+            ultimo_intento = method != "GET" or intento == dm.HTTP_GET_RETRIES
+            timeout_conexion, timeout_lectura, recortado = dm.timeout_con_presupuesto()
+            if breaker and not breaker.permitir():
+                dm.sumar_registro("llamadas_omitidas")
+                raise dm.UpstreamOmitido(f"Circuito abierto para {breaker.nombre}")
+
+            exito = None  # None: el intento no dice nada de la salud del backend
+            try:
+                response = await obtener_cliente_http().request(
+                    method, url, timeout=httpx.Timeout(timeout_lectura, connect=timeout_conexion), **kwargs
+                )
+                exito = response.status_code < 500
+            except httpx.TimeoutException:
+                # Un timeout recortado por el presupuesto no es culpa del backend
+                exito = None if recortado else False
+                if ultimo_intento:
+                    raise
+            except httpx.TransportError:
+                exito = False
+                if ultimo_intento:
+                    raise
+            else:
+                if ultimo_intento or response.status_code not in HTTP_STATUS_REINTENTABLES:
+                    return response
+            finally:
+                if breaker:
+                    breaker.registrar(exito)
+            await asyncio.sleep(0.5 * 2 ** intento)
+    finally:
+        dm.sumar_registro("llamadas_upstream")
+        dm.sumar_registro("tiempo_upstream_ms", (time.monotonic() - inicio) * 1000)
+
+async def http_get(url: str, **kwargs) -> httpx.Response:
+    return await http_request("GET", url, **kwargs)
+
+async def http_post(url: str, **kwargs) -> httpx.Response:
+    return await http_request("POST", url, **kwargs)
+
+async def http_put(url: str, **kwargs) -> httpx.Response:
+    return await http_request("PUT", url, **kwargs)
+
+@asynccontextmanager
+async def lifespan(app):
+    logging.info("🚀 Iniciando servidor Dentalink API Template (ASGI)")
+    if not dm.MEDILINK_TOKEN:
+        logging.warning("⚠️ MEDILINK_TOKEN no configurado")
+    if not dm.DENTALINK_TOKEN:
+        logging.warning("⚠️ DENTALINK_TOKEN no configurado")
+    dm.iniciar_segundo_plano()
+    obtener_cliente_http()
+    try:
+        yield
+    finally:
+        await obtener_cliente_http().aclose()
+
+app = FastAPI(title="Dentalink API Template", lifespan=lifespan)
+
+# ============================
+# REGISTRO POR PETICIÓN
+# ============================
+
+@app.middleware("http")
+async def registrar_peticion(request: Request, call_next):
+    """Misma línea JSON de resumen por petición que la versión Flask"""
+    body = await request.body()
+    try:
+        body_json = json.loads(body) if body else None
+    except ValueError:
+        body_json = None
+
+    registro = {
+        "ruta": request.url.path,
+        "metodo": request.method,
+        "detalle": dm.detalle_pedido(request.headers.get('X-Log-Detalle', ''), body_json),
+        "llamadas_upstream": 0,
+        "tiempo_upstream_ms": 0.0
+    }
+    inicio = time.monotonic()
+    token = dm.iniciar_registro(registro)
+    token_presupuesto = dm.iniciar_presupuesto()
+    try:
+        response = await call_next(request)
+        registro["status"] = response.status_code
+        return response
+    except Exception as e:
+        registro["error"] = repr(e)
+        raise
+    finally:
+        dm.finalizar_presupuesto(token_presupuesto)
+        dm.finalizar_registro(token)
+        registro.setdefault("status", 500)
+        registro["duracion_ms"] = round((time.monotonic() - inicio) * 1000, 1)
+        registro["tiempo_upstream_ms"] = round(registro["tiempo_upstream_ms"], 1)
+        logging.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+async def _leer_json(request: Request) -> Optional[Dict[str, Any]]:
+    """Body JSON de la petición, o None si viene vacío o no es JSON"""
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def _respuesta(resultado: Dict[str, Any], status_error: int = 400) -> JSONResponse:
+    """200 con el resultado, o status_error si trae "error" (igual que los endpoints Flask)"""
+    return JSONResponse(resultado, status_code=status_error if "error" in resultado else 200)
+
+_SIN_DATOS = {"error": "No se proporcionaron datos"}
+
+# ============================
+# URL DE HORARIOS DISPONIBLES
+# ============================
+
+async def consultar_horarios_disponibles(api_base: str, headers_api: Dict, **kwargs) -> Tuple[Optional[httpx.Response], Optional[str]]:
+    """
+    GET a horariosdisponibles usando la variante de URL (con o sin "/" final) que ya
+    funcionó para esta API; la tabla de variantes se comparte con la versión Flask.
+
+    Returns:
+        tuple: (response o None, url que respondió o None)
+    """
+    recordada = dm.variante_horarios_recordada(api_base)
+
+    variantes = [f"{api_base}horariosdisponibles/", f"{api_base}horariosdisponibles"]
+    urls_to_try = ([recordada] + [url for url in variantes if url != recordada]) if recordada else variantes
+    response = None
+
+    for url_horarios in urls_to_try:
+        try:
+            dm.log_detalle(f"🌐 Intentando URL: {url_horarios}")
+            response = await http_get(url_horarios, headers=headers_api, **kwargs)
+            dm.log_detalle(f"📊 Status Code: {response.status_code}")
+
+            if response.status_code != 404:
+                if url_horarios != recordada:
+                    dm.recordar_variante_horarios(api_base, url_horarios)
+                return response, url_horarios
+        except (httpx.HTTPError, dm.UpstreamOmitido) as e:
+            logging.error(f"❌ Error al conectar con {url_horarios}: {e}")
+
+        if url_horarios == recordada:
+            # La variante recordada dejó de responder: volver a probar ambas
+            dm.olvidar_variante_horarios(api_base)
+
+    return response, None
+
+# ============================
+# CACHÉ DE PROFESIONALES
+# ============================
+
+# Una sola descarga de /dentistas a la vez por worker (la caché es la de dentalinkymedilink)
+_dentistas_carga_lock = asyncio.Lock()
+
+async def _descargar_dentistas() -> Optional[Dict[int, Dict[str, Any]]]:
+    """Descarga /dentistas de Dentalink indexado por ID. Retorna None si la API falla."""
+    try:
+        prof_resp = await http_get(f"{dm.DENTALINK_API_URL}dentistas", headers=dm.DENTALINK_HEADERS)
+        if prof_resp.status_code != 200:
+            logging.warning(f"⚠️ No se pudieron obtener dentistas de Dentalink: {prof_resp.status_code}")
+            return None
+        return {dentista.get("id"): dm.datos_profesional(dentista) for dentista in prof_resp.json().get("data", [])}
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo dentistas de Dentalink: {e}")
+        return None
+
+async def _descargar_profesional_medilink(id_profesional: int) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Consulta profesionales/{id} en Medilink; (respuesta definitiva, datos o None)"""
+    try:
+        prof_resp = await http_get(f"{dm.MEDILINK_API_URL}profesionales/{id_profesional}", headers=dm.MEDILINK_HEADERS)
+        if prof_resp.status_code == 200:
+            return True, dm.datos_profesional(prof_resp.json().get("data", {}))
+        if prof_resp.status_code == 404:
+            return True, None
+        logging.warning(f"⚠️ No se pudo obtener profesional {id_profesional} de Medilink: {prof_resp.status_code}")
+    except Exception as e:
+        logging.warning(f"⚠️ Error obteniendo profesional {id_profesional} de Medilink: {e}")
+    return False, None
+
+async def resolver_profesionales(ids_profesionales: List[int], es_dentalink: bool) -> Dict[int, Optional[Dict[str, Any]]]:
+    """Versión asíncrona de dm.resolver_profesionales (Medilink: IDs faltantes en paralelo)"""
+    resultado, faltantes = dm.profesionales_en_cache(es_dentalink, list(dict.fromkeys(ids_profesionales)))
+    if not faltantes:
+        return resultado
+
+    if es_dentalink:
+        async with _dentistas_carga_lock:
+            # Otra petición pudo haber descargado /dentistas mientras se esperaba el lock
+            encontrados, faltantes = dm.profesionales_en_cache(True, faltantes)
+            resultado.update(encontrados)
+            if faltantes:
+                dm.sumar_registro("profesionales_descargados", len(faltantes))
+                directorio = await _descargar_dentistas()
+                if directorio is not None:
+                    directorio.update({id_prof: None for id_prof in faltantes if id_prof not in directorio})
+                    dm.guardar_profesionales(True, directorio)
+                    resultado.update({id_prof: directorio[id_prof] for id_prof in faltantes})
+        return resultado
+
+    dm.sumar_registro("profesionales_descargados", len(faltantes))
+    respuestas = await asyncio.gather(*(_descargar_profesional_medilink(id_prof) for id_prof in faltantes))
+    descargados = {
+        id_prof: datos for id_prof, (definitivo, datos) in zip(faltantes, respuestas) if definitivo
+    }
+    dm.guardar_profesionales(False, descargados)
+    resultado.update(descargados)
+    return resultado
+
+async def obtener_profesionales(ids_profesionales: List[int], usa_dentalink: bool) -> Dict[int, Dict[str, Any]]:
+    """{id: {"nombre", "intervalo"}} buscando primero en la API indicada y los faltantes en la alternativa"""
+    profesionales = {
+        id_prof: datos for id_prof, datos in (await resolver_profesionales(ids_profesionales, usa_dentalink)).items() if datos
+    }
+    faltantes = [id_prof for id_prof in ids_profesionales if id_prof not in profesionales]
+    if faltantes:
+        dm.log_detalle(f"🔄 Buscando {len(faltantes)} profesionales en API alternativa...")
+        profesionales.update({
+            id_prof: datos for id_prof, datos in (await resolver_profesionales(faltantes, not usa_dentalink)).items() if datos
+        })
+    return profesionales
+
+# ============================
+# FUNCIÓN 1: BUSCAR DISPONIBILIDAD
+# ============================
+
+async def _consultar_api_horarios(api_config: Dict[str, Any], ids_profesionales: List[int], id_sucursal: int,
+                                  fecha_inicio_dt: datetime, fecha_fin_dt: datetime) -> Tuple[Optional[httpx.Response], Optional[str]]:
+    """Consulta horariosdisponibles en una API y registra su latencia si respondió"""
+    dm.log_detalle(f"🔄 Consultando horarios en {api_config['name']}")
+    parametros = dm.parametros_horarios(api_config['is_dentalink'], ids_profesionales, id_sucursal,
+                                        fecha_inicio_dt, fecha_fin_dt)
+    dm.log_detalle(f"📋 Parámetros para {api_config['name']}: {parametros}")
+
+    inicio = time.monotonic()
+    respuesta_api, url_api = await consultar_horarios_disponibles(api_config['base'], api_config['headers'], **parametros)
+    if respuesta_api is not None:
+        dm.registrar_latencia(api_config['name'], time.monotonic() - inicio)
+    return respuesta_api, url_api
+
+async def _intentos_secuenciales(apis_a_probar: List[Dict[str, Any]], *argumentos) -> AsyncIterator[Tuple[Dict, Optional[httpx.Response], Optional[str], bool]]:
+    """Consulta las APIs en orden; la siguiente solo se consulta si el consumidor sigue iterando"""
+    for api_config in apis_a_probar:
+        yield (api_config, *await _consultar_api_horarios(api_config, *argumentos), False)
+
+async def _intentos_con_hedging(apis_a_probar: List[Dict[str, Any]], *argumentos) -> AsyncIterator[Tuple[Dict, Optional[httpx.Response], Optional[str], bool]]:
+    """
+    Consulta la API principal y, si no responde dentro de su umbral de latencia, también la
+    alternativa. Mismo orden de entrega que dm.intentos_con_hedging.
+    """
+    principal, alternativa = apis_a_probar
+    tarea_principal = asyncio.ensure_future(_consultar_api_horarios(principal, *argumentos))
+    umbral = dm.umbral_hedging(principal['name'])
+
+    terminadas, _ = await asyncio.wait({tarea_principal}, timeout=umbral)
+    if terminadas:
+        # La principal respondió a tiempo: mismo flujo que el modo secuencial
+        yield (principal, *tarea_principal.result(), False)
+        yield (alternativa, *await _consultar_api_horarios(alternativa, *argumentos), False)
+        return
+
+    dm.sumar_registro("hedges")
+    dm.log_detalle(f"⏱️ {principal['name']} no respondió en {umbral * 1000:.0f}ms, consultando también {alternativa['name']}")
+    tarea_alternativa = asyncio.ensure_future(_consultar_api_horarios(alternativa, *argumentos))
+
+    configuraciones = {tarea_principal: principal, tarea_alternativa: alternativa}
+    resultados = {}
+    pendientes = set(configuraciones)
+    while pendientes:
+        terminadas, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+        for tarea in [tarea for tarea in configuraciones if tarea in terminadas]:
+            api_config = configuraciones[tarea]
+            resultados[api_config['name']] = (api_config, *tarea.result())
+            if dm.tiene_horarios(resultados[api_config['name']][1]):
+                if api_config is alternativa:
+                    dm.sumar_registro("hedges_ganados")
+                yield (*resultados[api_config['name']], api_config is alternativa)
+                return
+
+    for api_config in apis_a_probar:
+        yield (*resultados[api_config['name']], False)
+
+async def _consultar_horarios_ventana(ids_profesionales: List[int], id_sucursal: int, fecha_inicio_dt: datetime,
+                                      fecha_fin_dt: datetime) -> Tuple[Optional[Dict], Optional[str], Optional[str]]:
+    """
+    Versión asíncrona de dm.consultar_horarios_ventana.
+
+    Returns:
+        tuple: (horarios_data o None, api usada, mensaje de error si el endpoint no existe en ninguna API)
+    """
+    apis_a_probar = dm.apis_en_orden(id_sucursal)
+    argumentos = (ids_profesionales, id_sucursal, fecha_inicio_dt, fecha_fin_dt)
+    if dm.HEDGING_HORARIOS and len(apis_a_probar) == 2:
+        intentos = _intentos_con_hedging(apis_a_probar, *argumentos)
+    else:
+        intentos = _intentos_secuenciales(apis_a_probar, *argumentos)
+
+    # Ruta aprendida que contradice la configuración: si responde vacío se verifica la alternativa
+    verificar_ruta = len(apis_a_probar) == 2 and dm.ruta_contradice_configuracion(id_sucursal)
+    respuesta_vacia = None
+
+    response = None
+    url_usado = None
+    api_usada = None
+    api_respuesta = None
+    gano_por_hedging = False
+
+    async for api_config, respuesta_api, url_api, por_hedging in intentos:
+        if respuesta_api is not None:
+            response = respuesta_api
+            api_respuesta = api_config
+            gano_por_hedging = por_hedging
+        if url_api:
+            url_usado = url_api
+            api_usada = api_config['name']
+            dm.log_detalle(f"✅ Endpoint encontrado en {api_usada}")
+        else:
+            logging.warning(f"⚠️ Endpoint no encontrado en {api_config['name']}")
+
+        if response is not None and response.status_code < 400:
+            if not (verificar_ruta and respuesta_vacia is None and api_config is apis_a_probar[0]
+                    and not dm.tiene_horarios(response)):
+                break
+            dm.log_detalle(f"🧭 Ruta aprendida de la sucursal {id_sucursal} sin horarios, verificando {apis_a_probar[1]['name']}")
+            respuesta_vacia = (response, url_usado, api_usada, api_respuesta, gano_por_hedging)
+
+    if respuesta_vacia is not None and not dm.tiene_horarios(response):
+        # La alternativa tampoco trajo horarios: queda la respuesta de la ruta aprendida
+        response, url_usado, api_usada, api_respuesta, gano_por_hedging = respuesta_vacia
+
+    if response is None or response.status_code == 404:
+        logging.error("❌ Endpoint horariosdisponibles no encontrado en ninguna API")
+        return None, None, "Endpoint horariosdisponibles no encontrado en ninguna API (Dentalink v1 ni Medilink v5)"
+
+    dm.log_detalle(f"✅ URL exitosa: {url_usado} (API: {api_usada})")
+
+    if response.status_code != 200:
+        logging.error(f"❌ Status code no exitoso en horariosdisponibles: {response.status_code}")
+        dm.log_detalle(f"📄 Response text: {response.text[:500]}")
+        return None, api_usada, None
+
+    try:
+        horarios_data = response.json().get("data", {})
+    except json.JSONDecodeError as e:
+        logging.error(f"❌ Error parseando JSON: {e}")
+        return None, api_usada, None
+
+    # Una respuesta vacía no confirma la ruta y una que ganó solo por latencia no la cambia
+    if horarios_data and not gano_por_hedging:
+        await asyncio.to_thread(dm.registrar_ruta, api_respuesta["is_dentalink"], id_sucursal,
+                                [int(id_prof) for id_prof in (horarios_data or {}) if str(id_prof).isdigit()])
+
+    dm.log_detalle(f"📊 Cantidad de profesionales con horarios: {len(horarios_data) if horarios_data else 0}")
+    return horarios_data or None, api_usada, None
+
+async def search_availability(ids_profesionales: List[int], id_sucursal: int, fecha_inicio: str = None, tiempo_cita: int = None) -> Dict[str, Any]:
+    """Busca disponibilidad de profesionales (mismo resultado que dm.search_availability)"""
+    dm.anotar_registro(id_sucursal=id_sucursal, profesionales=len(ids_profesionales or []),
+                       fecha_inicio=fecha_inicio, tiempo_cita=tiempo_cita)
+
+    # Validaciones
+    if not ids_profesionales:
+        logging.error("❌ Error: No se proporcionaron IDs de profesionales")
+        return {"error": "Se requiere al menos un ID de profesional"}
+
+    if not id_sucursal:
+        logging.error("❌ Error: No se proporcionó ID de sucursal")
+        return {"error": "Se requiere ID de sucursal"}
+
+    usa_dentalink = dm.determinar_api_por_sucursal(id_sucursal)[2]
+    dm.anotar_registro(api=dm.obtener_nombre_api(id_sucursal))
+
+    profesionales_info = dm.nombres_con_fallback(ids_profesionales, await obtener_profesionales(ids_profesionales, usa_dentalink))
+
+    tz_santiago = pytz.timezone("America/Santiago")
+    hora_actual = datetime.now(tz_santiago)
+    if not fecha_inicio:
+        fecha_inicio = hora_actual.strftime("%Y-%m-%d")
+    fecha_inicio_dt = datetime.strptime(fecha_inicio, "%Y-%m-%d")
+
+    # Búsqueda iterativa hasta 4 semanas
+    for intento_actual in range(1, dm.SEMANAS_BUSQUEDA + 1):
+        dm.sumar_registro("semanas_consultadas")
+        fecha_fin_dt = fecha_inicio_dt + timedelta(days=6)  # 1 semana
+
+        horarios_data, api_usada, error = await _consultar_horarios_ventana(ids_profesionales, id_sucursal,
+                                                                            fecha_inicio_dt, fecha_fin_dt)
+        if error:
+            return {"error": error}
+
+        if horarios_data:
+            disponibilidad_final = dm.disponibilidad_semana(horarios_data, profesionales_info, hora_actual, tiempo_cita)
+            if disponibilidad_final:
+                resultado = {
+                    "disponibilidad": disponibilidad_final,
+                    "fecha_desde": fecha_inicio_dt.strftime('%Y-%m-%d'),
+                    "fecha_hasta": fecha_fin_dt.strftime('%Y-%m-%d'),
+                    "api_utilizada": api_usada if api_usada else dm.obtener_nombre_api(id_sucursal)
+                }
+                dm.anotar_registro(api=resultado["api_utilizada"], semana_encontrada=intento_actual)
+                return resultado
+        else:
+            dm.log_detalle(f"⚠️ No hay datos de horarios en la respuesta para intento {intento_actual}")
+
+        # Avanzar a la siguiente semana
+        fecha_inicio_dt += timedelta(days=7)
+
+    return {
+        "mensaje": "No se encontró disponibilidad en las próximas 4 semanas",
+        "disponibilidad": []
+    }
+
+async def search_availability_multisucursal(ids_profesionales: List[int], ids_sucursales: List[int], fecha_inicio: str = None,
+                                           tiempo_cita: int = None) -> Dict[str, Any]:
+    """Busca disponibilidad en varias sucursales a la vez; un resultado por sucursal en el orden recibido"""
+    ids_sucursales = list(dict.fromkeys(ids_sucursales))  # sin duplicados, manteniendo el orden
+    if not ids_sucursales:
+        return {"error": "Se requiere al menos un ID de sucursal"}
+
+    respuestas = await asyncio.gather(
+        *(search_availability(ids_profesionales, id_sucursal, fecha_inicio, tiempo_cita) for id_sucursal in ids_sucursales),
+        return_exceptions=True
+    )
+
+    resultados = []
+    for id_sucursal, resultado in zip(ids_sucursales, respuestas):
+        if isinstance(resultado, Exception):
+            logging.error(f"❌ Error buscando disponibilidad en sucursal {id_sucursal}: {resultado}")
+            resultado = {"error": f"Error buscando disponibilidad: {str(resultado)}"}
+        resultados.append({"id_sucursal": id_sucursal, **resultado})
+
+    con_disponibilidad = sum(1 for resultado in resultados if resultado.get("disponibilidad"))
+    dm.anotar_registro(id_sucursal=ids_sucursales, api=[resultado.get("api_utilizada") for resultado in resultados],
+                       semana_encontrada=None, sucursales_con_disponibilidad=con_disponibilidad)
+
+    return {
+        "sucursales": resultados,
+        "sucursales_con_disponibilidad": con_disponibilidad
+    }
+
+@app.post('/search_availability')
+async def endpoint_search_availability(request: Request):
+    """Acepta "id_sucursal" o "ids_sucursales" / "id_sucursal" como lista, igual que la versión Flask"""
+    data = await _leer_json(request)
+    if not data:
+        return JSONResponse(_SIN_DATOS, status_code=400)
+
+    ids_profesionales = data.get("ids_profesionales", [])
+    fecha_inicio = data.get("fecha_inicio")
+    tiempo_cita = data.get("tiempo_cita")
+
+    ids_sucursales = data.get("ids_sucursales")
+    if ids_sucursales is None and isinstance(data.get("id_sucursal"), list):
+        ids_sucursales = data.get("id_sucursal")
+
+    if ids_sucursales is not None:
+        if not isinstance(ids_sucursales, list):
+            ids_sucursales = [ids_sucursales]
+        ids_extraidos = [dm.extraer_id(valor) for valor in ids_sucursales]
+        if None in ids_extraidos:
+            return JSONResponse({"error": "ids_sucursales debe contener solo IDs numéricos"}, status_code=400)
+        return _respuesta(await search_availability_multisucursal(ids_profesionales, ids_extraidos, fecha_inicio, tiempo_cita))
+
+    id_sucursal = dm.extraer_id(data.get("id_sucursal"))
+    return _respuesta(await search_availability(ids_profesionales, id_sucursal, fecha_inicio, tiempo_cita))
+
+# ============================
+# FUNCIÓN 2: BUSCAR PACIENTE
+# ============================
+
+# Orden por defecto cuando no hay sucursal: Medilink primero, luego Dentalink
+APIS_MEDILINK_PRIMERO = [
+    {"name": "Medilink v5", "base": dm.MEDILINK_API_URL, "headers": dm.MEDILINK_HEADERS, "is_dentalink": False},
+    {"name": "Dentalink v1", "base": dm.DENTALINK_API_URL, "headers": dm.DENTALINK_HEADERS, "is_dentalink": True}
+]
+
+async def buscar_paciente(rut: str, api: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Busca un paciente por RUT en una API usando la caché compartida (ver dm.buscar_paciente)"""
+    rut_formateado = dm.formatear_rut(rut)
+    en_cache, paciente = dm.paciente_en_cache(rut_formateado, api['is_dentalink'])
+    if en_cache:
+        return paciente
+
+    dm.sumar_registro("pacientes_consultados")
+    try:
+        filtro = json.dumps({"rut": {"eq": rut_formateado}})
+        response = await http_get(f"{api['base']}pacientes", headers=api['headers'], params={"q": filtro})
+        dm.log_detalle(f"📊 Status búsqueda paciente en {api['name']}: {response.status_code}")
+        if response.status_code != 200:
+            return None
+        pacientes = response.json().get("data", [])
+    except Exception as e:
+        logging.warning(f"⚠️ Error al buscar paciente en {api['name']}: {e}")
+        return None
+
+    paciente = dm.datos_paciente(pacientes[0]) if pacientes else None
+    dm.guardar_paciente(rut_formateado, api['is_dentalink'], paciente)
+    return paciente
+
+async def search_user(rut: str, id_sucursal: int = None, contexto: dm.ContextoAgendamiento = None) -> Dict[str, Any]:
+    """Busca un paciente por RUT en Medilink/Dentalink (mismo resultado que dm.search_user)"""
+    logging.info(f"🔍 Buscando paciente con RUT: {rut}")
+
+    rut_formateado = dm.formatear_rut(rut)
+    apis = dm.apis_en_orden(id_sucursal)[:1] if id_sucursal else dm.apis_disponibles(APIS_MEDILINK_PRIMERO)
+
+    for api in apis:
+        paciente = await buscar_paciente(rut_formateado, api)
+        if paciente:
+            logging.info(f"✅ Paciente encontrado en {api['name']} con ID {paciente['id']}")
+            if contexto:
+                contexto.registrar_paciente(paciente, api)
+            return {
+                "id": paciente["id"],
+                "nombre": f"{paciente['nombre']} {paciente['apellidos']}".strip(),
+                "celular": paciente["celular"],
+                "email": paciente["email"],
+                "rut": paciente["rut"]
+            }
+
+    return {"error": f"Paciente con RUT {rut_formateado} no encontrado"}
+
+@app.post('/search_user')
+async def endpoint_search_user(request: Request):
+    data = await _leer_json(request)
+    if not data:
+        return JSONResponse(_SIN_DATOS, status_code=400)
+
+    rut = data.get("rut")
+    if not rut:
+        return JSONResponse({"error": "RUT es requerido"}, status_code=400)
+
+    return _respuesta(await search_user(rut, dm.extraer_id(data.get("id_sucursal"))), status_error=404)
+
+# ============================
+# FUNCIÓN 3: CREAR PACIENTE
+# ============================
+
+async def create_user(nombre: str, apellidos: str, rut: str, telefono: str = "", email: str = "", id_sucursal: int = None,
+                      contexto: dm.ContextoAgendamiento = None) -> Dict[str, Any]:
+    """Crea un paciente en Medilink/Dentalink (mismo resultado que dm.create_user)"""
+    logging.info(f"👤 Creando paciente: {nombre} {apellidos}")
+
+    if not all([nombre, apellidos, rut]):
+        return {"error": "Nombre, apellidos y RUT son requeridos"}
+
+    rut_formateado = dm.formatear_rut(rut)
+
+    # Verificar si el paciente ya existe
+    paciente_existente = await search_user(rut_formateado, id_sucursal, contexto)
+    if "id" in paciente_existente:
+        return {
+            "id": paciente_existente["id"],
+            "mensaje": "Paciente ya existe"
+        }
+
+    apis_a_intentar = dm.apis_en_orden(id_sucursal) if id_sucursal else dm.apis_disponibles(APIS_MEDILINK_PRIMERO)
+
+    payload_paciente = {
+        "nombre": nombre,
+        "apellidos": apellidos,
+        "rut": rut_formateado,
+        "celular": telefono,
+        "email": email
+    }
+
+    errores = []
+
+    for api in apis_a_intentar:
+        try:
+            logging.info(f"🔄 Intentando crear paciente en {api['name']}")
+            response = await http_post(f"{api['base']}pacientes/", headers=api['headers'], json=payload_paciente)
+
+            if response.status_code == 201:
+                paciente_data = response.json().get("data", {})
+                id_paciente = paciente_data.get('id')
+                logging.info(f"✅ Paciente creado exitosamente en {api['name']} con ID {id_paciente}")
+                if id_paciente:
+                    dm.guardar_paciente(rut_formateado, api['is_dentalink'], {**payload_paciente, **paciente_data})
+                    if contexto:
+                        contexto.registrar_paciente({**payload_paciente, **paciente_data}, api)
+                return {
+                    "id": id_paciente,
+                    "mensaje": f"Paciente creado exitosamente en {api['name']}",
+                    "api_utilizada": api['name']
+                }
+            elif response.status_code == 400 and "existe" in response.text.lower():
+                logging.info(f"⚠️ Paciente duplicado detectado en {api['name']}, buscando...")
+                dm.invalidar_cache_pacientes(rut_formateado)  # La caché pudo tenerlo como no encontrado
+                paciente_existente = await search_user(rut_formateado, id_sucursal, contexto)
+                if "id" in paciente_existente:
+                    return {
+                        "id": paciente_existente["id"],
+                        "mensaje": "Paciente ya existía"
+                    }
+            else:
+                logging.warning(f"⚠️ Error en {api['name']}: {response.status_code}")
+                errores.append(f"{api['name']}: {response.status_code} - {response.text[:200]}")
+
+        except Exception as e:
+            logging.error(f"❌ Error en {api['name']}: {e}")
+            errores.append(f"{api['name']}: {str(e)}")
+
+    return {
+        "error": "No se pudo crear el paciente en ninguna API",
+        "detalles": errores
+    }
+
+@app.post('/create_user')
+async def endpoint_create_user(request: Request):
+    data = await _leer_json(request)
+    if not data:
+        return JSONResponse(_SIN_DATOS, status_code=400)
+
+    resultado = await create_user(data.get("nombre"), data.get("apellidos"), data.get("rut"),
+                                  data.get("telefono", ""), data.get("email", ""), dm.extraer_id(data.get("id_sucursal")))
+    return _respuesta(resultado)
+
+# ============================
+# FUNCIÓN 4: AGENDAR CITA
+# ============================
+
+async def schedule_appointment(id_paciente: int, id_profesional: int, id_sucursal: int, fecha: str,
+                               hora_inicio: str, user_id: str, tiempo_cita: int = None,
+                               comentario: str = "", contexto: dm.ContextoAgendamiento = None) -> Dict[str, Any]:
+    """Agenda una cita en Medilink/Dentalink (mismo resultado que dm.schedule_appointment)"""
+    logging.info(f"📅 Agendando cita para paciente {id_paciente} con profesional {id_profesional}")
+
+    contexto = contexto or dm.ContextoAgendamiento()
+    apis_a_intentar = contexto.ordenar_apis(dm.apis_en_orden(id_sucursal, id_profesional))
+
+    duracion = None
+    if tiempo_cita:
+        duracion = tiempo_cita
+        logging.info(f"⏱️ Usando duración especificada: {duracion} min")
+    else:
+        for api in apis_a_intentar:
+            profesional = (await resolver_profesionales([id_profesional], api['is_dentalink'])).get(id_profesional)
+            if profesional:
+                contexto.profesional = profesional  # También da el nombre para GHL
+            if profesional and profesional.get("intervalo"):
+                duracion = profesional["intervalo"]
+                logging.info(f"✅ Intervalo encontrado en {api['name']}: {duracion} min")
+                break
+
+        if not duracion:
+            logging.error(f"❌ No se pudo determinar la duración de la cita para profesional {id_profesional}")
+            return {"error": "No se pudo determinar la duración de la cita. Especifica tiempo_cita o verifica que el profesional tenga intervalo configurado."}
+
+    errores = []
+
+    for api in apis_a_intentar:
+        try:
+            payload_cita = dm.payload_cita_api(api['is_dentalink'], id_paciente, id_profesional, id_sucursal,
+                                               fecha, hora_inicio, duracion, comentario)
+            logging.info(f"🔄 Intentando agendar cita en {api['name']}")
+            logging.info(f"📋 Payload: {payload_cita}")
+
+            response = await http_post(f"{api['base']}citas/", headers=api['headers'], json=payload_cita)
+
+            if response.status_code == 201:
+                id_cita = response.json().get("data", {}).get("id")
+                logging.info(f"✅ Cita creada exitosamente en {api['name']} con ID {id_cita}")
+                await asyncio.to_thread(dm.registrar_ruta, api['is_dentalink'], id_sucursal, [id_profesional])
+
+                # Integración con GHL vía la cola persistente de dentalinkymedilink (workers en hilos)
+                if dm.GHL_ACCESS_TOKEN:
+                    await asyncio.to_thread(dm.encolar_sincronizacion_ghl, dm.datos_sincronizacion_ghl(
+                        user_id, fecha, hora_inicio, duracion, id_profesional, id_sucursal, contexto))
+                else:
+                    logging.warning("⚠️ GHL_ACCESS_TOKEN no configurado; se omite integración GHL")
+
+                return {
+                    "id_cita": id_cita,
+                    "mensaje": f"Cita agendada exitosamente en {api['name']}",
+                    "api_utilizada": api['name']
+                }
+
+            logging.warning(f"⚠️ Error en {api['name']}: {response.status_code}")
+            errores.append(f"{api['name']}: {response.status_code} - {response.text[:200]}")
+
+        except Exception as e:
+            logging.error(f"❌ Error en {api['name']}: {e}")
+            errores.append(f"{api['name']}: {str(e)}")
+
+    return {
+        "error": "No se pudo agendar la cita en ninguna API",
+        "detalles": errores
+    }
+
+@app.post('/schedule_appointment')
+async def endpoint_schedule_appointment(request: Request):
+    data = await _leer_json(request)
+    if not data:
+        return JSONResponse(_SIN_DATOS, status_code=400)
+
+    campos_obligatorios = ["id_paciente", "id_profesional", "id_sucursal", "fecha", "hora_inicio", "user_id"]
+    faltantes = [campo for campo in campos_obligatorios if not data.get(campo)]
+    if faltantes:
+        return JSONResponse({"error": f"Faltan campos obligatorios: {', '.join(faltantes)}"}, status_code=400)
+
+    resultado = await schedule_appointment(
+        dm.extraer_id(data.get("id_paciente")), dm.extraer_id(data.get("id_profesional")),
+        dm.extraer_id(data.get("id_sucursal")), data.get("fecha"), data.get("hora_inicio"),
+        data.get("user_id"), data.get("tiempo_cita"), data.get("comentario", "")
+    )
+    return _respuesta(resultado)
+
+# ============================
+# FUNCIÓN 5: CANCELAR CITA
+# ============================
+
+async def cancel_appointment(rut: str = None, id_cita: int = None) -> Dict[str, Any]:
+    """Cancela por ID de cita o, si solo viene el RUT, la próxima cita futura del paciente"""
+    logging.info(f"❌ Cancelando cita - RUT: {rut}, ID Cita: {id_cita}")
+
+    if not rut and not id_cita:
+        return {"error": "Se requiere RUT del paciente o ID de cita"}
+
+    if id_cita:
+        return await _cancelar_cita_por_id(id_cita)
+    return await _cancelar_proxima_cita_por_rut(rut)
+
+async def _cancelar_cita_por_id(id_cita: int) -> Dict[str, Any]:
+    """Cancela una cita por ID probando Dentalink y luego Medilink (ver dm.cancelar_cita_por_id)"""
+    apis = dm.apis_disponibles(list(reversed(APIS_MEDILINK_PRIMERO)))
+    errores = []
+
+    for api in apis:
+        try:
+            url_cita = f"{api['base']}citas/{id_cita}"
+
+            logging.info(f"🔍 Buscando cita {id_cita} en {api['name']}")
+            resp_get = await http_get(url_cita, headers=api['headers'])
+
+            if resp_get.status_code in (400, 404):
+                # No existe aquí o la API no es compatible con esta cita (está en la otra)
+                logging.info(f"⚠️ Cita {id_cita} no encontrada en {api['name']} ({resp_get.status_code})")
+                continue
+
+            if resp_get.status_code != 200:
+                error_msg = f"{api['name']} GET: {resp_get.status_code}"
+                logging.warning(f"⚠️ Error obteniendo cita en {api['name']}: {error_msg}")
+                errores.append(error_msg)
+                continue
+
+            try:
+                cita_data = resp_get.json().get("data", {})
+                logging.info(f"✅ Cita {id_cita} encontrada en {api['name']}")
+            except ValueError:
+                logging.warning(f"⚠️ Error parseando respuesta de {api['name']}")
+                continue
+
+            logging.info(f"🔄 Intentando cancelar cita en {api['name']}")
+            resp_cancel = await http_put(url_cita, headers=api['headers'], json=dm.payload_cancelacion(api['is_dentalink']))
+
+            if resp_cancel.status_code == 200:
+                logging.info(f"✅ Cita {id_cita} cancelada exitosamente en {api['name']}")
+                return {
+                    "mensaje": "Cita cancelada exitosamente",
+                    "id_cita": id_cita,
+                    "fecha": cita_data.get("fecha"),
+                    "hora_inicio": cita_data.get("hora_inicio"),
+                    "api_utilizada": api['name']
+                }
+            elif resp_cancel.status_code == 400:
+                # La cita existe pero esta API no puede cancelarla: intentar con la otra
+                logging.warning(f"⚠️ {api['name']} no puede cancelar esta cita (error 400) - Intentando con la otra API")
+                errores.append(f"{api['name']} PUT: Incompatibilidad (400)")
+            else:
+                error_msg = f"{api['name']} PUT: {resp_cancel.status_code}"
+                logging.warning(f"⚠️ Error cancelando en {api['name']}: {error_msg} - {resp_cancel.text[:200]}")
+                errores.append(error_msg)
+
+        except Exception as e:
+            logging.warning(f"⚠️ Error en {api['name']}: {e}")
+            errores.append(f"{api['name']}: Exception - {str(e)}")
+
+    return {
+        "error": f"No se pudo cancelar la cita {id_cita} en ninguna API",
+        "detalles": errores
+    }
+
+async def _proxima_cita_en_api(api: Dict[str, Any], rut_formateado: str, fecha_actual: str, hora_actual_str: str) -> Optional[Dict]:
+    """Busca el paciente en una API y retorna su cita futura activa más próxima, o None"""
+    try:
+        paciente = await buscar_paciente(rut_formateado, api)
+        if not paciente:
+            return None
+
+        citas_link = next((l["href"] for l in paciente.get("links", []) if l.get("rel") == "citas"), None)
+        if not citas_link:
+            return None
+
+        resp_citas = await http_get(citas_link, headers=api['headers'])
+        if resp_citas.status_code != 200:
+            return None
+
+        return dm.proxima_cita_futura(resp_citas.json().get("data", []), fecha_actual, hora_actual_str)
+
+    except Exception as e:
+        logging.warning(f"⚠️ Error buscando en {api['name']}: {e}")
+        return None
+
+async def _cancelar_proxima_cita_por_rut(rut: str) -> Dict[str, Any]:
+    """Cancela la próxima cita futura de un paciente buscando en ambas APIs a la vez"""
+    rut_formateado = dm.formatear_rut(rut)
+
+    hora_actual = datetime.now(pytz.timezone("America/Santiago"))
+    fecha_actual = hora_actual.strftime("%Y-%m-%d")
+    hora_actual_str = hora_actual.strftime("%H:%M:%S")
+
+    apis = dm.apis_disponibles(APIS_MEDILINK_PRIMERO)
+    candidatas = await asyncio.gather(
+        *(_proxima_cita_en_api(api, rut_formateado, fecha_actual, hora_actual_str) for api in apis)
+    )
+
+    # Quedarse con la más próxima; en empate gana Medilink (primera de la lista)
+    cita_encontrada = None
+    api_cita = None
+    for api, cita_candidata in zip(apis, candidatas):
+        if cita_candidata and (not cita_encontrada or
+            (cita_candidata["fecha"], cita_candidata["hora_inicio"]) <
+            (cita_encontrada["fecha"], cita_encontrada["hora_inicio"])):
+            cita_encontrada = cita_candidata
+            api_cita = api
+
+    if not cita_encontrada:
+        return {"mensaje": "No se encontraron citas futuras activas para cancelar"}
+
+    id_cita = cita_encontrada["id"]
+    logging.info(f"🔄 Intentando cancelar cita {id_cita} encontrada en {api_cita['name']}")
+
+    # Primero la API que encontró la cita, luego la otra
+    apis_cancelacion = [api_cita] + [api for api in apis if api['name'] != api_cita['name']]
+    errores_cancelacion = []
+
+    for api_cancel in apis_cancelacion:
+        try:
+            logging.info(f"🔄 Intentando cancelar en {api_cancel['name']}")
+            resp_cancel = await http_put(f"{api_cancel['base']}citas/{id_cita}", headers=api_cancel['headers'],
+                                         json=dm.payload_cancelacion(api_cancel['is_dentalink']))
+
+            if resp_cancel.status_code == 200:
+                logging.info(f"✅ Cita cancelada exitosamente en {api_cancel['name']}")
+                return {
+                    "mensaje": "Cita cancelada exitosamente",
+                    "id_cita": id_cita,
+                    "fecha": cita_encontrada["fecha"],
+                    "hora_inicio": cita_encontrada["hora_inicio"],
+                    "api_utilizada": api_cancel['name']
+                }
+            elif resp_cancel.status_code == 400:
+                error_msg = f"{api_cancel['name']}: Incompatibilidad (400)"
+                logging.warning(f"⚠️ {error_msg} - Intentando con otra API")
+                errores_cancelacion.append(error_msg)
+            else:
+                error_msg = f"{api_cancel['name']}: {resp_cancel.status_code}"
+                logging.warning(f"⚠️ Error en {api_cancel['name']}: {error_msg}")
+                errores_cancelacion.append(error_msg)
+
+        except Exception as e:
+            logging.error(f"❌ Error cancelando en {api_cancel['name']}: {e}")
+            errores_cancelacion.append(f"{api_cancel['name']}: {str(e)}")
+
+    return {
+        "error": f"No se pudo cancelar la cita {id_cita}",
+        "detalles": errores_cancelacion
+    }
+
+@app.post('/cancel_appointment')
+async def endpoint_cancel_appointment(request: Request):
+    data = await _leer_json(request)
+    if not data:
+        return JSONResponse(_SIN_DATOS, status_code=400)
+
+    return _respuesta(await cancel_appointment(data.get("rut"), dm.extraer_id(data.get("id_cita"))))
+
+# ============================
+# FUNCIÓN 6: OBTENER TRATAMIENTOS DE PACIENTE
+# ============================
+
+async def _citas_tratamiento(tratamiento: Dict, headers_api: Dict, limite: asyncio.Semaphore) -> Tuple[Optional[str], List[Dict]]:
+    """Consulta el link "citas" de un tratamiento; (hora de la primera cita no anulada, citas resumidas)"""
+    citas_link = dm.link_citas_tratamiento(tratamiento)
+    if not citas_link:
+        return None, []
+
+    try:
+        async with limite:
+            resp_citas = await http_get(citas_link, headers=headers_api)
+        if resp_citas.status_code != 200:
+            logging.warning(f"⚠️ Error al obtener citas del tratamiento {tratamiento.get('id')}: {resp_citas.status_code}")
+            return None, []
+        citas_data = resp_citas.json().get("data", [])
+        dm.sumar_registro("citas", len(citas_data))
+        return dm.resumen_citas(citas_data)
+    except Exception as e:
+        logging.warning(f"⚠️ Error consultando citas del tratamiento {tratamiento.get('id')}: {e}")
+        return None, []
+
+async def get_patient_treatments(rut: str, max_tratamientos: int = dm.TRATAMIENTOS_MAX_EXPANDIDOS) -> Dict[str, Any]:
+    """Tratamientos/atenciones de un paciente por RUT (mismo resultado que dm.get_patient_treatments)"""
+    rut_formateado = dm.formatear_rut(rut)
+
+    for api in dm.apis_disponibles(APIS_MEDILINK_PRIMERO):
+        try:
+            paciente = await buscar_paciente(rut_formateado, api)
+            if not paciente:
+                continue
+
+            id_paciente = paciente.get("id")
+            nombre_completo = f"{paciente.get('nombre', '')} {paciente.get('apellidos', '')}".strip()
+
+            resp_tratamientos = await http_get(dm.link_tratamientos_paciente(paciente, api), headers=api['headers'])
+            if resp_tratamientos.status_code != 200:
+                logging.warning(f"⚠️ Error al obtener tratamientos: Status {resp_tratamientos.status_code}")
+                continue
+
+            tratamientos_data = resp_tratamientos.json().get("data", [])
+            dm.anotar_registro(api=api['name'], id_paciente=id_paciente, tratamientos=len(tratamientos_data))
+
+            # Citas de los tratamientos a la vez, como mucho TRATAMIENTOS_POOL_SIZE en vuelo
+            limite = asyncio.Semaphore(dm.TRATAMIENTOS_POOL_SIZE)
+            indices = dm.indices_tratamientos_a_expandir(tratamientos_data, max_tratamientos)
+            citas = dict(zip(indices, await asyncio.gather(
+                *(_citas_tratamiento(tratamientos_data[i], api['headers'], limite) for i in indices)
+            )))
+
+            tratamientos_filtrados = [
+                dm.tratamiento_filtrado(tratamiento, api['is_dentalink'], *citas.get(i, (None, [])))
+                for i, tratamiento in enumerate(tratamientos_data)
+            ]
+
+            respuesta = {
+                "paciente": {
+                    "id": id_paciente,
+                    "nombre": nombre_completo,
+                    "rut": rut_formateado,
+                    "email": paciente.get("email", ""),
+                    "celular": paciente.get("celular", "")
+                },
+                "tratamientos": tratamientos_filtrados,
+                "total_tratamientos": len(tratamientos_filtrados),
+                "api_utilizada": api['name']
+            }
+            if len(citas) < len(tratamientos_data):
+                respuesta["tratamientos_con_citas"] = len(citas)
+            return respuesta
+
+        except Exception as e:
+            logging.warning(f"⚠️ Error obteniendo tratamientos en {api['name']}: {e}")
+
+    return {"error": f"Paciente con RUT {rut_formateado} no encontrado o sin tratamientos"}
+
+@app.post('/get_patient_treatments')
+async def endpoint_get_patient_treatments(request: Request):
+    data = await _leer_json(request)
+    if not data:
+        return JSONResponse(_SIN_DATOS, status_code=400)
+
+    rut = data.get("rut")
+    if not rut:
+        return JSONResponse({"error": "RUT es requerido"}, status_code=400)
+
+    try:
+        max_tratamientos = max(0, int(data.get("max_tratamientos", dm.TRATAMIENTOS_MAX_EXPANDIDOS) or 0))
+    except (TypeError, ValueError):
+        return JSONResponse({"error": "max_tratamientos debe ser un número entero"}, status_code=400)
+
+    return _respuesta(await get_patient_treatments(rut, max_tratamientos), status_error=404)
+
+# ============================
+# ENDPOINTS ADICIONALES
+# ============================
+
+@app.get('/ghl/cola')
+async def endpoint_metricas_cola_ghl():
+    """Profundidad de la cola de sincronización GHL y del dead letter"""
+    try:
+        return await asyncio.to_thread(dm.metricas_cola_ghl)
+    except sqlite3.Error as e:
+        return JSONResponse({"error": f"No se pudo leer la cola GHL: {e}"}, status_code=500)
+
+@app.post('/ghl/cola/reintentar')
+async def endpoint_reencolar_dead_letter_ghl(request: Request):
+    """Devuelve a la cola los trabajos del dead letter (todos, o solo los de "ids")"""
+    data = await _leer_json(request) or {}
+    ids = [dm.extraer_id(valor) for valor in data.get("ids") or []]
+    if None in ids:
+        return JSONResponse({"error": "ids debe contener solo IDs numéricos"}, status_code=400)
+
+    try:
+        reencolados = await asyncio.to_thread(dm.reencolar_dead_letter_ghl, ids)
+    except sqlite3.Error as e:
+        return JSONResponse({"error": f"No se pudo leer la cola GHL: {e}"}, status_code=500)
+    return {"reencolados": reencolados}
+
+@app.get('/health')
+async def health_check():
+    circuitos = dm.estado_circuitos()
+    return {
+        "status": "ok" if all(c["estado"] == "cerrado" for c in circuitos.values()) else "degradado",
+        "service": "Dentalink API Template",
+        "timestamp": datetime.utcnow().isoformat(),
+        "circuitos": circuitos,
+        "presupuesto_peticion_s": dm.PRESUPUESTO_PETICION
+    }
+
+# ============================
+# FUNCIÓN COMPLETA: CREAR PACIENTE Y AGENDAR
+# ============================
+
+@app.post('/create_user_and_schedule')
+async def create_user_and_schedule(request: Request):
+    """Crea (o busca) un paciente y agenda una cita compartiendo un ContextoAgendamiento"""
+    data = await _leer_json(request)
+    if not data:
+        return JSONResponse(_SIN_DATOS, status_code=400)
+
+    campos_obligatorios = ["nombre", "apellidos", "rut", "id_profesional", "id_sucursal", "fecha", "hora_inicio", "user_id"]
+    faltantes = [campo for campo in campos_obligatorios if not data.get(campo)]
+    if faltantes:
+        return JSONResponse({"error": f"Faltan campos obligatorios: {', '.join(faltantes)}"}, status_code=400)
+
+    id_sucursal = dm.extraer_id(data.get("id_sucursal"))
+    contexto = dm.ContextoAgendamiento()
+
+    # 1. Crear o buscar paciente
+    resultado_paciente = await create_user(data.get("nombre"), data.get("apellidos"), data.get("rut"),
+                                           data.get("telefono", ""), data.get("email", ""), id_sucursal, contexto)
+    if "error" in resultado_paciente:
+        return JSONResponse(resultado_paciente, status_code=400)
+
+    # 2. Agendar cita
+    resultado_cita = await schedule_appointment(resultado_paciente["id"], dm.extraer_id(data.get("id_profesional")),
+                                                id_sucursal, data.get("fecha"), data.get("hora_inicio"),
+                                                data.get("user_id"), data.get("tiempo_cita"),
+                                                data.get("comentario", ""), contexto)
+    if "error" in resultado_cita:
+        return JSONResponse(resultado_cita, status_code=400)
+
+    # 3. Respuesta combinada
+    return {
+        "mensaje": "Paciente creado/encontrado y cita agendada exitosamente",
+        "paciente": resultado_paciente,
+        "cita": resultado_cita
+    }
@@ -3,11 +3,13 @@ import json
 import math
 import logging
 import time
+import threading
 import uuid
 import requests
 from typing import Optional, Union
 from contextlib import asynccontextmanager
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from zoneinfo import ZoneInfo
 from dateutil.relativedelta import relativedelta
 from fastapi import FastAPI, Request
@@ -169,7 +171,121 @@ def get_access_token() -> str:
 # ─── GHL helpers ──────────────────────────────────────────────
 
 
-def ghl_request(method: str, path: str, version: str, **kwargs) -> requests.Response:
+# GHL admite unas 100 peticiones cada 10 segundos por location: todas las llamadas
+# pasan por un token bucket, con prioridad para las interactivas y pausa ante un 429.
+GHL_RATE_LIMIT = 100
+GHL_RATE_WINDOW = 10       # segundos
+GHL_RATE_MAX_WAIT = 20     # segundos que una llamada espera turno antes de desistir
+GHL_429_RETRIES = 1
+
+
+class GhlRateLimitExceeded(Exception):
+    """No hubo turno para llamar a GHL dentro de GHL_RATE_MAX_WAIT."""
+
+
+class GhlTokenBucket:
+    """Token bucket de una location con prioridad para las llamadas interactivas."""
+
+    def __init__(self, capacity: int, window: float):
+        self.capacity = capacity
+        self.refill_per_s = capacity / window
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._ghl_remaining: Optional[int] = None  # último X-RateLimit-Remaining informado por GHL
+        self._waiting = {True: 0, False: 0}        # llamadas en espera: interactivas / segundo plano
+        self._counters = {"llamadas": 0, "con_espera": 0, "sin_turno": 0, "respuestas_429": 0}
+        self._condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_s)
+        self._updated = now
+
+    def acquire(self, interactive: bool, max_wait: float) -> bool:
+        deadline = time.monotonic() + max_wait
+        waited = False
+        with self._condition:
+            self._waiting[interactive] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    yields = not interactive and self._waiting[True] > 0
+                    if now >= self._paused_until and self._tokens >= 1 and not yields:
+                        self._tokens -= 1
+                        self._counters["llamadas"] += 1
+                        if waited:
+                            self._counters["con_espera"] += 1
+                        return True
+                    if now >= deadline:
+                        self._counters["sin_turno"] += 1
+                        return False
+
+                    if now < self._paused_until:
+                        wait = self._paused_until - now
+                    elif yields:
+                        wait = deadline - now  # despierta cuando una interactiva toma su token
+                    else:
+                        wait = (1 - self._tokens) / self.refill_per_s
+                    waited = True
+                    self._condition.wait(min(wait, deadline - now))
+            finally:
+                self._waiting[interactive] -= 1
+                self._condition.notify_all()
+
+    def record_response(self, response: requests.Response) -> None:
+        with self._condition:
+            remaining = response.headers.get("X-RateLimit-Remaining")
+            if remaining is not None and remaining.isdigit():
+                self._ghl_remaining = int(remaining)
+                self._refill(time.monotonic())
+                self._tokens = min(self._tokens, float(self._ghl_remaining))
+            if response.status_code == 429:
+                self._counters["respuestas_429"] += 1
+                pause = retry_after_seconds(response)
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+                self._tokens = 0.0
+                logger.warning(f"  <- GHL 429: llamadas pausadas {pause:.1f}s")
+
+    def metrics(self) -> dict:
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "tokens_disponibles": int(self._tokens),
+                "capacidad": self.capacity,
+                "restante_ghl": self._ghl_remaining,
+                "pausado_s": round(max(0.0, self._paused_until - now), 1),
+                "en_espera": {"interactivas": self._waiting[True], "segundo_plano": self._waiting[False]},
+                **self._counters,
+            }
+
+
+def retry_after_seconds(response: requests.Response) -> float:
+    value = response.headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return GHL_RATE_WINDOW
+
+
+_ghl_buckets: dict[str, GhlTokenBucket] = {}
+_ghl_buckets_lock = threading.Lock()
+
+
+def ghl_bucket(location_id: str) -> GhlTokenBucket:
+    with _ghl_buckets_lock:
+        if location_id not in _ghl_buckets:
+            _ghl_buckets[location_id] = GhlTokenBucket(GHL_RATE_LIMIT, GHL_RATE_WINDOW)
+        return _ghl_buckets[location_id]
+
+
+def ghl_request(method: str, path: str, version: str, interactive: bool = True, **kwargs) -> requests.Response:
     url = f"{GHL_BASE_URL}{path}"
     headers = {
         "Accept": "application/json",
@@ -180,8 +296,15 @@ def ghl_request(method: str, path: str, version: str, **kwargs) -> requests.Resp
 
     logger.info(f"  -> GHL {method.upper()} {path}")
 
+    bucket = ghl_bucket(GHL_LOCATION_ID)
     start = time.time()
-    response = requests.request(method, url, headers=headers, timeout=30, **kwargs)
+    for _ in range(GHL_429_RETRIES + 1):
+        if not bucket.acquire(interactive, GHL_RATE_MAX_WAIT):
+            raise GhlRateLimitExceeded(f"Sin turno para llamar a GHL tras {GHL_RATE_MAX_WAIT}s")
+        response = requests.request(method, url, headers=headers, timeout=30, **kwargs)
+        bucket.record_response(response)
+        if response.status_code != 429:
+            break
     elapsed = round((time.time() - start) * 1000)
 
     logger.info(f"  <- GHL {method.upper()} {path} | status={response.status_code} | {elapsed}ms")
@@ -740,6 +863,14 @@ def obtener_cita_mas_proxima(body: ObtenerCitaMasProximaRequest):
         })
 
 
+
+@app.get("/ghl/limite")
+def ghl_rate_limit_metrics():
+    with _ghl_buckets_lock:
+        buckets = dict(_ghl_buckets)
+    return {"status": 200, "message": {location_id: bucket.metrics() for location_id, bucket in buckets.items()}}
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,10 +1,14 @@
 from flask import Flask, request, jsonify
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import pytz
 import logging
 import json
 import locale
+import threading
+import time
+from concurrent.futures import Future
 
 app = Flask(__name__)
 
@@ -78,6 +82,262 @@ CALENDARIOS_PROFESIONALES = {
     9: "q0XPdcw0XxfUrPSF2Cfi"   # Gladys Fuentes
 }
 
+# ================= LÍMITE DE PETICIONES A GHL =================
+# GHL admite unas 100 peticiones cada 10 segundos por location. Todas las llamadas
+# pasan por ghl_request, que reparte ese presupuesto con un token bucket: las
+# llamadas interactivas tienen prioridad sobre las de segundo plano y un 429 pausa
+# el cubo durante el Retry-After que indique GHL.
+GHL_LIMITE_PETICIONES = 100
+GHL_LIMITE_VENTANA = 10           # segundos
+GHL_LIMITE_ESPERA_MAXIMA = 20     # segundos que una llamada espera turno antes de desistir
+GHL_REINTENTOS_429 = 1
+
+class LimiteGHLExcedido(Exception):
+    """No hubo turno para llamar a GHL dentro de GHL_LIMITE_ESPERA_MAXIMA."""
+
+class CuboTokensGHL:
+    """Token bucket de una location con prioridad para las llamadas interactivas."""
+
+    def __init__(self, capacidad, ventana):
+        self.capacidad = capacidad
+        self.recarga_por_s = capacidad / ventana
+        self._tokens = float(capacidad)
+        self._actualizado = time.monotonic()
+        self._pausado_hasta = 0.0
+        self._restante_ghl = None              # último X-RateLimit-Remaining informado por GHL
+        self._esperando = {True: 0, False: 0}  # llamadas en espera: interactivas / segundo plano
+        self._contadores = {"llamadas": 0, "con_espera": 0, "sin_turno": 0, "respuestas_429": 0}
+        self._condicion = threading.Condition()
+
+    def _recargar(self, ahora):
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._actualizado) * self.recarga_por_s)
+        self._actualizado = ahora
+
+    def tomar(self, interactiva, espera_maxima):
+        """Espera un token. Retorna False si no lo consiguió dentro de espera_maxima."""
+        limite = time.monotonic() + espera_maxima
+        espero = False
+        with self._condicion:
+            self._esperando[interactiva] += 1
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._recargar(ahora)
+                    cede = not interactiva and self._esperando[True] > 0
+                    if ahora >= self._pausado_hasta and self._tokens >= 1 and not cede:
+                        self._tokens -= 1
+                        self._contadores["llamadas"] += 1
+                        if espero:
+                            self._contadores["con_espera"] += 1
+                        return True
+                    if ahora >= limite:
+                        self._contadores["sin_turno"] += 1
+                        return False
+
+                    if ahora < self._pausado_hasta:
+                        espera = self._pausado_hasta - ahora
+                    elif cede:
+                        espera = limite - ahora  # despierta cuando una interactiva toma su token
+                    else:
+                        espera = (1 - self._tokens) / self.recarga_por_s
+                    espero = True
+                    self._condicion.wait(min(espera, limite - ahora))
+            finally:
+                self._esperando[interactiva] -= 1
+                self._condicion.notify_all()
+
+    def registrar_respuesta(self, response):
+        """Ajusta el cubo con los headers de GHL; en un 429 lo pausa según Retry-After."""
+        with self._condicion:
+            restante = response.headers.get("X-RateLimit-Remaining")
+            if restante is not None and restante.isdigit():
+                self._restante_ghl = int(restante)
+                self._recargar(time.monotonic())
+                self._tokens = min(self._tokens, float(self._restante_ghl))
+            if response.status_code == 429:
+                self._contadores["respuestas_429"] += 1
+                pausa = segundos_retry_after(response)
+                self._pausado_hasta = max(self._pausado_hasta, time.monotonic() + pausa)
+                self._tokens = 0.0
+                logging.warning(f"[ghl_request] GHL respondió 429: llamadas pausadas {pausa:.1f}s")
+
+    def metricas(self):
+        with self._condicion:
+            ahora = time.monotonic()
+            self._recargar(ahora)
+            return {
+                "tokens_disponibles": int(self._tokens),
+                "capacidad": self.capacidad,
+                "restante_ghl": self._restante_ghl,
+                "pausado_s": round(max(0.0, self._pausado_hasta - ahora), 1),
+                "en_espera": {"interactivas": self._esperando[True], "segundo_plano": self._esperando[False]},
+                **self._contadores
+            }
+
+def segundos_retry_after(response):
+    """Segundos del header Retry-After (número o fecha HTTP); sin header, una ventana completa."""
+    valor = response.headers.get("Retry-After")
+    if valor:
+        try:
+            return max(0.0, float(valor))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return GHL_LIMITE_VENTANA
+
+_cubos_ghl = {}
+_cubos_ghl_lock = threading.Lock()
+
+def cubo_ghl(location_id):
+    with _cubos_ghl_lock:
+        if location_id not in _cubos_ghl:
+            _cubos_ghl[location_id] = CuboTokensGHL(GHL_LIMITE_PETICIONES, GHL_LIMITE_VENTANA)
+        return _cubos_ghl[location_id]
+
+def ghl_request(method, url, interactiva=True, location_id=GHL_LOCATION_ID, **kwargs):
+    """
+    Petición a GHL que respeta el límite de la location. Ante un 429 espera el
+    Retry-After y reintenta hasta GHL_REINTENTOS_429 veces.
+    Lanza LimiteGHLExcedido si no hubo turno a tiempo.
+    """
+    cubo = cubo_ghl(location_id)
+    for _ in range(GHL_REINTENTOS_429 + 1):
+        if not cubo.tomar(interactiva, GHL_LIMITE_ESPERA_MAXIMA):
+            raise LimiteGHLExcedido(f"Sin turno para llamar a GHL tras {GHL_LIMITE_ESPERA_MAXIMA}s")
+        response = requests.request(method, url, **kwargs)
+        cubo.registrar_respuesta(response)
+        if response.status_code != 429:
+            break
+    return response
+
+@app.errorhandler(LimiteGHLExcedido)
+def limite_ghl_excedido(e):
+    logging.warning(f"[ghl_request] {e}")
+    return jsonify({"error": "Límite de peticiones a GHL alcanzado, intente nuevamente"}), 429, {
+        "Retry-After": str(GHL_LIMITE_VENTANA)
+    }
+
+@app.route('/ghl/limite', methods=['GET'])
+def metricas_limite_ghl():
+    """Presupuesto restante de cada location usada por este proceso."""
+    with _cubos_ghl_lock:
+        cubos = dict(_cubos_ghl)
+    return jsonify({location_id: cubo.metricas() for location_id, cubo in cubos.items()})
+
+# ================= ACTUALIZACIONES DE CONTACTOS AGRUPADAS =================
+# Una misma reserva puede disparar varios PUT /contacts/{id} en pocos segundos
+# (crear-cita, actualizar-cita). Si el contacto no tiene un PUT en curso, el cambio se
+# envía de inmediato; los que llegan mientras hay uno en curso se combinan durante la
+# ventana y salen en un solo PUT al terminar. Los PUT de un contacto nunca se solapan,
+# así el último valor escrito es el que queda en GHL.
+CONTACTO_VENTANA_SEGUNDOS = 0.5
+
+_lotes_contactos = {}         # contact_id -> {"payload", "futuros", "vencido"}
+_contactos_enviando = set()   # contact_id con un PUT en curso
+_lotes_contactos_lock = threading.Lock()
+
+def _clave_custom_field(campo):
+    return campo.get("key") or campo.get("id")
+
+def fusionar_payload_contacto(base, cambios):
+    """Aplica `cambios` sobre `base`: customFields por key/id, el resto reemplazado (gana el último)."""
+    fusion = dict(base)
+    for campo, valor in cambios.items():
+        if campo != "customFields":
+            fusion[campo] = valor
+            continue
+        custom_fields = {_clave_custom_field(c): c for c in fusion.get("customFields", [])}
+        for custom_field in valor:
+            custom_fields.pop(_clave_custom_field(custom_field), None)
+            custom_fields[_clave_custom_field(custom_field)] = custom_field
+        fusion["customFields"] = list(custom_fields.values())
+    return fusion
+
+def actualizar_contacto(contact_id, cambios):
+    """
+    Envía los cambios del contacto, o los suma al lote pendiente si ya hay un PUT en curso.
+    Retorna un Future con la respuesta del PUT (ya resuelto si se envió de inmediato).
+    """
+    futuro = Future()
+    with _lotes_contactos_lock:
+        lote = _lotes_contactos.get(contact_id)
+        inmediato = lote is None and contact_id not in _contactos_enviando
+        if inmediato:
+            lote = {"payload": fusionar_payload_contacto({}, cambios), "futuros": [futuro], "vencido": False}
+            _contactos_enviando.add(contact_id)
+        else:
+            nuevo = lote is None
+            if nuevo:
+                lote = _lotes_contactos[contact_id] = {"payload": {}, "futuros": [], "vencido": False}
+            lote["payload"] = fusionar_payload_contacto(lote["payload"], cambios)
+            lote["futuros"].append(futuro)
+
+    if inmediato:
+        _enviar_contacto(contact_id, lote)
+        siguiente = _terminar_envio_contacto(contact_id)
+        if siguiente is not None:
+            # El lote que se juntó durante el PUT sale en otro hilo: esta petición no lo espera
+            threading.Thread(target=_enviar_lotes_contacto, args=(contact_id, siguiente), daemon=True).start()
+    elif nuevo:
+        temporizador = threading.Timer(CONTACTO_VENTANA_SEGUNDOS, _vaciar_contacto, args=(contact_id,))
+        temporizador.daemon = True
+        temporizador.start()
+    return futuro
+
+def _vaciar_contacto(contact_id):
+    """Al vencer la ventana envía el lote, salvo que siga el PUT anterior (lo envía ese hilo)."""
+    with _lotes_contactos_lock:
+        lote = _lotes_contactos.get(contact_id)
+        if lote is None:
+            return
+        if contact_id in _contactos_enviando:
+            lote["vencido"] = True
+            return
+        del _lotes_contactos[contact_id]
+        _contactos_enviando.add(contact_id)
+    _enviar_lotes_contacto(contact_id, lote)
+
+def _enviar_lotes_contacto(contact_id, lote):
+    """Envía el lote y, uno tras otro, los que vencieron mientras tanto."""
+    while lote is not None:
+        _enviar_contacto(contact_id, lote)
+        lote = _terminar_envio_contacto(contact_id)
+
+def _terminar_envio_contacto(contact_id):
+    """Tras un PUT: retorna el lote que venció mientras tanto (sigue reservado) o libera el contacto."""
+    with _lotes_contactos_lock:
+        siguiente = _lotes_contactos.get(contact_id)
+        if siguiente is None or not siguiente["vencido"]:
+            _contactos_enviando.discard(contact_id)
+            return None
+        del _lotes_contactos[contact_id]
+        return siguiente
+
+def _enviar_contacto(contact_id, lote):
+    if len(lote["futuros"]) > 1:
+        logging.info(f"[actualizar_contacto] {len(lote['futuros'])} actualizaciones de {contact_id} en un solo PUT")
+    logging.debug(f"[actualizar_contacto] Payload contacto {contact_id}: {lote['payload']}")
+    try:
+        response = ghl_request(
+            "PUT",
+            f"{GHL_BASE_URL}/contacts/{contact_id}",
+            headers={
+                "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
+                "Version": API_VERSION,
+                "Content-Type": "application/json",
+                "Location-Id": GHL_LOCATION_ID
+            },
+            json=lote["payload"]
+        )
+    except Exception as e:
+        for futuro in lote["futuros"]:
+            futuro.set_exception(e)
+        return
+    for futuro in lote["futuros"]:
+        futuro.set_result(response)
+
 def get_millis_for_day_range(start_date_str, days=7):
     tz = pytz.timezone(TIMEZONE)
     logging.debug(f"[get_millis_for_day_range] Input date string: {start_date_str}")
@@ -108,7 +368,7 @@ def get_user_info(user_id):
     logging.debug(f"[get_user_info] URL: {url}")
 
     try:
-        response = requests.get(url, headers=headers)
+        response = ghl_request("GET", url, headers=headers)
         logging.info(f"[get_user_info] Response status: {response.status_code}")
 
         if response.status_code == 200:
@@ -136,7 +396,7 @@ def get_calendar_info(calendar_id):
     logging.debug(f"[get_calendar_info] Headers: {headers}")
 
     try:
-        response = requests.get(url, headers=headers)
+        response = ghl_request("GET", url, headers=headers)
         logging.info(f"[get_calendar_info] Response status: {response.status_code}")
 
         if response.status_code == 200:
@@ -366,7 +626,7 @@ def _get_free_slots_for_professional(
     logging.debug(f"[available-times] Headers: {headers}")
     logging.debug(f"[available-times] Params: {params}")
 
-    response = requests.get(url, headers=headers, params=params)
+    response = ghl_request("GET", url, headers=headers, params=params)
 
     logging.info(f"[available-times] GHL response status: {response.status_code}")
     logging.debug(f"[available-times] GHL response headers: {dict(response.headers)}")
@@ -557,15 +817,7 @@ def crear_cita():
 
         if update_contact_payload:
             try:
-                requests.put(
-                    f"{GHL_BASE_URL}/contacts/{data['user_id']}",
-                    headers={
-                        "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
-                        "Version": API_VERSION,
-                        "Content-Type": "application/json"
-                    },
-                    json=update_contact_payload
-                )
+                actualizar_contacto(data['user_id'], update_contact_payload).result()
             except Exception as e:
                 logging.error(f"[crear-cita] Error actualizando contacto: {e}")
 
@@ -590,7 +842,8 @@ def crear_cita():
     logging.debug(f"[crear-cita] Payload enviado a GHL: {payload}")
 
     # ================= CREAR CITA =================
-    response = requests.post(
+    response = ghl_request(
+        "POST",
         f"{GHL_BASE_URL}/calendars/events/appointments",
         headers={
             "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
@@ -659,21 +912,14 @@ def actualizar_cita():
         if 'user_id' not in data:
             return jsonify({"error": "user_id es requerido"}), 400
 
-        requests.put(
-            f"{GHL_BASE_URL}/contacts/{data['user_id']}",
-            headers={
-                "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
-                "Version": API_VERSION,
-                "Content-Type": "application/json",
-                "Location-Id": GHL_LOCATION_ID
-            },
-            json=payload_contacto
-        )
+        actualizar_contacto(data['user_id'], payload_contacto).result()
 
     # ================= (OPCIONAL) REAFIRMAR CITA =================
     # Esto no cambia nada, pero deja la acción ligada a la cita
-    requests.put(
+    ghl_request(
+        "PUT",
         f"{GHL_BASE_URL}/calendars/events/appointments/{event_id}",
+        interactiva=False,
         headers={
             "Authorization": f"Bearer {GHL_ACCESS_TOKEN}",
             "Version": API_VERSION,
@@ -701,7 +947,7 @@ def obtener_cita_por_evento(event_id):
         "Location-Id": GHL_LOCATION_ID
     }
 
-    response = requests.get(url, headers=headers)
+    response = ghl_request("GET", url, headers=headers)
 
     if response.status_code != 200:
         raise Exception(response.text)
@@ -723,7 +969,7 @@ def eliminar_cita():
         "Accept": "application/json"
     }
 
-    response = requests.delete(url, headers=headers)
+    response = ghl_request("DELETE", url, headers=headers)
 
     print("\n--- RESPUESTA GHL ELIMINAR CITA ---")
     print(response.status_code)
@@ -761,7 +1007,7 @@ def get_custom_field_id(field_key):
         "Location-Id": GHL_LOCATION_ID
     }
 
-    response = requests.get(url, headers=headers)
+    response = ghl_request("GET", url, headers=headers)
 
     if response.status_code != 200:
         raise Exception("No se pudieron obtener los custom fields")
@@ -791,7 +1037,7 @@ def obtener_citas_contacto():
         "Accept": "application/json"
     }
     logging.debug(f"[citas-contacto] URL: {url}, headers: {headers}")
-    response = requests.get(url, headers=headers)
+    response = ghl_request("GET", url, headers=headers)
     logging.info(f"[citas-contacto] GHL response status: {response.status_code}")
     logging.debug(f"[citas-contacto] GHL response text: {response.text}")
     if response.status_code != 200: